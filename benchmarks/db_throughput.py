@@ -0,0 +1,55 @@
+"""
+Concurrent-request throughput of the blocking session (old get_db) against the AsyncSession (new get_db).
+
+Each simulated request runs one query that takes QUERY_SECONDS on the server, the way a slow sales
+listing does. Run with: python -m benchmarks.db_throughput [requests] [concurrency]
+"""
+import asyncio
+import sys
+import time
+
+from sqlalchemy import text
+
+from settings.database import SessionLocal, AsyncSessionLocal, async_engine
+
+QUERY_SECONDS = 0.05
+querystring = text("select pg_sleep(:seconds);")
+
+
+async def blocking_request():
+	db = SessionLocal()
+	try:
+		db.execute(querystring, {"seconds": QUERY_SECONDS})
+	finally:
+		db.close()
+
+
+async def async_request():
+	async with AsyncSessionLocal() as db:
+		await db.execute(querystring, {"seconds": QUERY_SECONDS})
+
+
+async def run(request, requests: int, concurrency: int) -> float:
+	semaphore = asyncio.Semaphore(concurrency)
+
+	async def bounded():
+		async with semaphore:
+			await request()
+
+	start = time.perf_counter()
+	await asyncio.gather(*[bounded() for _ in range(requests)])
+	return requests / (time.perf_counter() - start)
+
+
+async def main(requests: int, concurrency: int):
+	before = await run(blocking_request, requests, concurrency)
+	after = await run(async_request, requests, concurrency)
+	await async_engine.dispose()
+	print(f"requests={requests} concurrency={concurrency} query={QUERY_SECONDS}s")
+	print(f"sync session : {before:8.1f} req/s")
+	print(f"async session: {after:8.1f} req/s ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+	asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+	                 int(sys.argv[2]) if len(sys.argv) > 2 else 10))
@@ -0,0 +1,87 @@
+"""
+Saving IMAGES uploads of MB megabytes each at once, the way ProductRepository.add_images used to
+(await image.read(), then a blocking write inside the event loop) and streamed through
+ProductFile.save_upload. Each mode runs in a process of its own, so the peak RSS it reports is
+its own. The uploads are spooled to disk first, as starlette does with anything past 1MB, and
+saved into a temporary MEDIA_URL. The event loop lag is the longest a 10 ms timer was late.
+Run with: python -m benchmarks.image_upload [images] [mb]
+"""
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from starlette.datastructures import UploadFile
+
+import models
+import settings
+
+CHUNK = 1024 * 1024
+
+
+def uploads(images: int, mb: int):
+	files = []
+	for i in range(images):
+		file = tempfile.SpooledTemporaryFile(max_size=CHUNK)
+		for _ in range(mb):
+			file.write(os.urandom(CHUNK))
+		files.append(UploadFile(file, filename=f"{i}.png"))
+	return files
+
+
+async def buffered(images):
+	async def save(image):
+		return models.ProductFile.save(name=image.filename, content=await image.read(), product_id=1)
+
+	return await asyncio.gather(*[save(image) for image in images])
+
+
+async def streamed(images):
+	return await asyncio.gather(*[models.ProductFile.save_upload(image, product_id=1) for image in images])
+
+
+async def lag_while(run, images) -> float:
+	lag, done = 0.0, False
+
+	async def tick():
+		nonlocal lag
+		while not done:
+			start = time.perf_counter()
+			await asyncio.sleep(0.01)
+			lag = max(lag, time.perf_counter() - start - 0.01)
+
+	ticker = asyncio.create_task(tick())
+	await asyncio.sleep(0)
+	await run(images)
+	done = True
+	await ticker
+	return lag
+
+
+def measure(mode: str, images: int, mb: int):
+	settings.MEDIA_URL = tempfile.mkdtemp()
+	files = uploads(images, mb)
+	for file in files:
+		file.file.seek(0)
+	before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	start = time.perf_counter()
+	lag = asyncio.run(lag_while(buffered if mode == "buffered" else streamed, files))
+	elapsed = time.perf_counter() - start
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	print(f"{mode:<10} {elapsed:>8.2f}s  peak rss +{(peak - before) / 1024:>7.0f} MB  loop lag {lag * 1000:>7.0f} ms")
+
+
+def main(images: int, mb: int):
+	print(f"{images} uploads of {mb} MB at once")
+	for mode in ("buffered", "streamed"):
+		subprocess.run([sys.executable, "-m", "benchmarks.image_upload", "--mode", mode, str(images), str(mb)], check=True)
+
+
+if __name__ == "__main__":
+	if sys.argv[1:2] == ["--mode"]:
+		measure(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+	else:
+		main(int(sys.argv[1]) if len(sys.argv) > 1 else 50, int(sys.argv[2]) if len(sys.argv) > 2 else 10)
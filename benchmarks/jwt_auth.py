@@ -0,0 +1,60 @@
+"""
+Cost of the auth dependencies of one request (JWTBearer then get_current_user) when every
+token is decoded twice, as before the verified token cache, on the first request of a
+token and on its repeat requests. Run with: python -m benchmarks.jwt_auth [requests]
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime, timedelta
+
+from jose import jwt
+from starlette.requests import Request
+
+from settings.jwt_config import (ALGORITHM, JWT_ISSUER, JWT_SECRET, get_current_user, oauth2_scheme,
+                                 verified_tokens)
+
+
+def access_token(id: int) -> str:
+	# tokens are issued by the account service with its own user payload
+	user = {"id": id, "user_id": id, "user_type": "Staff", "first_name": "Ada", "last_name": "Obi",
+	        "email": "ada@shop.ng"}
+	payload = {"exp": datetime.utcnow() + timedelta(hours=1), "user": user, "iss": JWT_ISSUER}
+	return jwt.encode(payload, JWT_SECRET, ALGORITHM)
+
+
+def request_with(token: str) -> Request:
+	return Request({"type": "http", "method": "GET", "path": "/products/", "query_string": b"",
+	                "headers": [(b"authorization", f"Bearer {token}".encode())]})
+
+
+async def authenticate(request: Request, forget: bool = False):
+	token = await oauth2_scheme(request)
+	if forget:
+		verified_tokens.clear()
+	return await get_current_user(token)
+
+
+async def run(requests: int, mode: str) -> float:
+	tokens = [access_token(i) for i in range(requests)] if mode == "first" else [access_token(1)]
+	requests_ = [request_with(tokens[i % len(tokens)]) for i in range(requests)]
+	verified_tokens.clear()
+	if mode == "repeat":
+		await authenticate(requests_[0])
+	start = time.perf_counter()
+	for request in requests_:
+		if mode == "uncached":
+			verified_tokens.clear()
+		await authenticate(request, forget=mode == "uncached")
+	return time.perf_counter() - start
+
+
+async def main(requests: int):
+	for mode, label in (("uncached", "two decodes (no cache)"), ("first", "first request of a token"),
+	                    ("repeat", "repeat requests of a token")):
+		elapsed = await run(requests, mode)
+		print(f"{label:<28} {elapsed / requests * 1e6:8.1f} us/request")
+
+
+if __name__ == "__main__":
+	asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,79 @@
+"""
+Latency of ProductRepository.get_all(search=...) on a seeded catalog.
+
+Seeds `products` the first time (1M rows by default) with names built from a few hundred
+brand and product words plus a few thousand variant words, then times each search term
+with the count skipped and with an exact count.
+Run with: python -m benchmarks.product_search [products] [runs]
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+from sqlalchemy import text
+
+from settings.database import create_db, engine, AsyncSessionLocal, async_engine
+from repositories.products import ProductRepository
+
+TERMS = ["milo", "peak milk", "indomie chick", "golden spag", "n", "bak 500", "zzzz"]
+
+BRANDS = ["milo", "peak", "indomie", "golden", "dangote", "nestle", "cadbury", "honeywell", "mama", "power"]
+NOUNS = ["milk", "chicken", "penny", "spaghetti", "noodles", "sugar", "rice", "cocoa", "flour", "oil"]
+SYLLABLES = ["ba", "ko", "ri", "lu", "me", "sa", "ti", "no", "de", "gu", "fa", "zi", "po", "ya", "we", "chi"]
+
+SEED = """
+insert into products (name, description, brand_id, inventory_id, price, quantity)
+select
+	(%(brands)s::text[])[n %% %(brand_count)s + 1] || ' ' ||
+	(%(nouns)s::text[])[(n / %(brand_count)s) %% %(noun_count)s + 1] || ' ' ||
+	(%(variants)s::text[])[((n * 7919) %% %(variant_count)s + 1)::int] || ' ' || (n %% 20 + 1) * 50 || 'g',
+	'pack of ' || (n %% 50 + 1) || ' ' || (%(variants)s::text[])[((n * 104729) %% %(variant_count)s + 1)::int],
+	1, 1, (n %% 1000) + 0.5, n %% 100
+from generate_series(1::bigint, %(products)s) as n
+"""
+
+
+def vocabulary(words: list, size: int) -> list:
+	# real words first, then made up ones so every token is as rare as in a real catalog
+	made_up = [a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES if a != b != c]
+	return (words + [word for word in made_up if word not in words])[:size]
+
+
+def seed(products: int):
+	create_db()
+	with engine.begin() as conn:
+		if conn.execute(text("select count(*) from products")).scalar() >= products:
+			return
+		conn.execute(text("insert into brands (name, description) select 'Bench', 'benchmark brand' "
+		                  "where not exists (select 1 from brands where id = 1)"))
+		conn.execute(text("insert into inventories (name, description, date_of_acquisition, location) "
+		                  "select 'Bench', 'benchmark inventory', now(), 'Lagos' "
+		                  "where not exists (select 1 from inventories where id = 1)"))
+		brands, nouns, variants = vocabulary(BRANDS, 200), vocabulary(NOUNS[::-1], 500), vocabulary([], 3000)
+		conn.exec_driver_sql(SEED, {"products": products, "brands": brands, "brand_count": len(brands),
+		                            "nouns": nouns, "noun_count": len(nouns),
+		                            "variants": variants, "variant_count": len(variants)})
+	with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+		# flushes the gin pending list left by the bulk insert
+		conn.exec_driver_sql("vacuum analyze products")
+
+
+async def run(runs: int):
+	async with AsyncSessionLocal() as db:
+		repo = ProductRepository(db)
+		for term in TERMS:
+			for include_count in (False, True):
+				timings = []
+				for _ in range(runs):
+					start = time.perf_counter()
+					result = await repo.get_all(limit=20, search=term, include_count=include_count)
+					timings.append((time.perf_counter() - start) * 1000)
+				print(f"{term!r:22} count={str(include_count):5} hits={len(result['results']):3} "
+				      f"p50={statistics.median(timings):7.2f}ms max={max(timings):7.2f}ms")
+	await async_engine.dispose()
+
+
+if __name__ == "__main__":
+	seed(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
+	asyncio.run(run(int(sys.argv[2]) if len(sys.argv) > 2 else 20))
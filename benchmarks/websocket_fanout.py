@@ -0,0 +1,82 @@
+"""
+Broadcast to 10k local websocket connections, 1% of them slow (SLOW_SECONDS per frame), with the
+old sequential send loop and with ConnectionManager.broadcast, which queues for each
+connection's writer task. Reports how long the broadcaster is blocked and when the fast and the
+slow clients have everything. Run with: python -m benchmarks.websocket_fanout [connections] [messages]
+"""
+import asyncio
+import json
+import sys
+import time
+
+from consumer import Connection, ConnectionManager
+from schemas.users import UserBase
+
+SLOW_SECONDS = 0.02
+SLOW_EVERY = 100
+
+
+class LocalSocket:
+
+	def __init__(self, delay: float):
+		self.delay = delay
+		self.received = 0
+
+	async def send_text(self, message: str):
+		await asyncio.sleep(self.delay)
+		self.received += 1
+
+	async def send_json(self, data: dict):
+		await self.send_text(json.dumps(data))
+
+
+def sockets(connections: int):
+	return [LocalSocket(SLOW_SECONDS if i % SLOW_EVERY == 0 else 0) for i in range(connections)]
+
+
+async def wait_for(clients, messages: int, start: float) -> float:
+	while any(client.received < messages for client in clients):
+		await asyncio.sleep(0.001)
+	return time.perf_counter() - start
+
+
+async def sequential(connections: int, messages: int):
+	clients = sockets(connections)
+	start = time.perf_counter()
+	for i in range(messages):
+		for client in clients:
+			await client.send_json({"channel": "general", "event": "stock", "data": {"i": i}})
+	elapsed = time.perf_counter() - start
+	return elapsed, elapsed, elapsed
+
+
+async def fanned_out(connections: int, messages: int):
+	clients = sockets(connections)
+	manager = ConnectionManager()
+	for i, client in enumerate(clients):
+		user = UserBase(id=i, first_name="", last_name="", email="", customer_id=i, staff_id=None, admin_id=None)
+		connection = Connection(client, user, ["general"])
+		connection.writer = asyncio.create_task(connection.write())
+		manager.channels.setdefault("general", set()).add(connection)
+	start = time.perf_counter()
+	for i in range(messages):
+		manager.broadcast("general", {"channel": "general", "event": "stock", "data": {"i": i}})
+	blocked = time.perf_counter() - start
+	fast = await wait_for([c for c in clients if not c.delay], messages, start)
+	slow = await wait_for([c for c in clients if c.delay], messages, start)
+	for connection in manager.channels["general"]:
+		connection.writer.cancel()
+	return blocked, fast, slow
+
+
+async def main(connections: int, messages: int):
+	print(f"{connections} connections, {messages} messages, every {SLOW_EVERY}th client takes {SLOW_SECONDS}s a frame")
+	print(f"{'':<12} {'broadcaster blocked':>20} {'fast clients done':>18} {'slow clients done':>18}")
+	for label, run in (("sequential", sequential), ("fanned out", fanned_out)):
+		blocked, fast, slow = await run(connections, messages)
+		print(f"{label:<12} {blocked:>19.3f}s {fast:>17.3f}s {slow:>17.3f}s")
+
+
+if __name__ == "__main__":
+	asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+	                 int(sys.argv[2]) if len(sys.argv) > 2 else 5))
@@ -0,0 +1,71 @@
+"""
+A flash sale burst (EVENTS stock events over about a second) to local websocket connections in
+each framing a client can negotiate. Counts frames and bytes sent and the CPU spent encoding on
+the server and decoding on the clients. Run with: python -m benchmarks.websocket_framing [connections]
+"""
+import asyncio
+import json
+import sys
+import time
+
+import msgpack
+
+from consumer import Connection, ConnectionManager
+from schemas.users import UserBase
+
+EVENTS = 500
+SPACING = 0.002
+DECODERS = {"json": json.loads, "msgpack": msgpack.unpackb}
+
+
+class LocalSocket:
+
+	def __init__(self, encoding: str):
+		self.decode = DECODERS[encoding]
+		self.frames = 0
+		self.bytes = 0
+		self.decoding = 0.0
+
+	async def send_text(self, frame: str):
+		await self.send_bytes(frame.encode())
+
+	async def send_bytes(self, frame: bytes):
+		start = time.process_time()
+		self.decode(frame)
+		self.decoding += time.process_time() - start
+		self.frames += 1
+		self.bytes += len(frame)
+
+
+async def run(connections: int, encoding: str, batch_ms: int):
+	manager = ConnectionManager()
+	clients = [LocalSocket(encoding) for _ in range(connections)]
+	for i, client in enumerate(clients):
+		user = UserBase(id=i, first_name="", last_name="", email="", customer_id=i, staff_id=None, admin_id=None)
+		connection = Connection(client, user, ["general"], encoding=encoding, batch_interval=batch_ms / 1000)
+		connection.writer = asyncio.create_task(connection.write())
+		manager.channels.setdefault("general", set()).add(connection)
+	start = time.process_time()
+	for i in range(EVENTS):
+		manager.broadcast("general", {"channel": "general", "sender": 12, "event": "stock",
+		                              "data": {"product_id": i % 50, "quantity": 1000 - i, "price": 1500.0}})
+		await asyncio.sleep(SPACING)
+	await asyncio.sleep(batch_ms / 1000 + 0.05)
+	cpu = time.process_time() - start
+	for connection in manager.channels["general"]:
+		connection.writer.cancel()
+	decoding = sum(client.decoding for client in clients)
+	return sum(client.frames for client in clients), sum(client.bytes for client in clients), cpu - decoding, decoding
+
+
+async def main(connections: int):
+	print(f"{connections} connections, {EVENTS} events {SPACING * 1000:.0f} ms apart")
+	print(f"{'framing':<26} {'frames':>9} {'MB':>8} {'server cpu':>11} {'client cpu':>11}")
+	for encoding, batch_ms in (("json", 0), ("msgpack", 0), ("json", 50), ("msgpack", 50)):
+		frames, size, server, clients = await run(connections, encoding, batch_ms)
+		label = f"{encoding}, " + (f"batch_ms={batch_ms}" if batch_ms else "frame per event")
+		print(f"{label:<26} {frames:>9} {size / 1e6:>8.2f} {server:>10.2f}s {clients:>10.2f}s")
+
+
+if __name__ == "__main__":
+	asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
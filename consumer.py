@@ -1,10 +1,20 @@
-from typing import Tuple, List
+import asyncio
+import json
+import logging
+import re
+import sys
+import time
+from collections import deque, Counter
+from typing import Awaitable, Callable, Tuple, List, Dict, Set, Optional, Union
 
-from fastapi import APIRouter
+import msgpack
+from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from starlette.websockets import WebSocket, WebSocketDisconnect
-from schemas.inventory import Inventory
-from settings.jwt_config import get_current_user
+
+import settings
+from schemas.users import UserBase
+from settings.jwt_config import decode_access_token, get_staff_user
 
 router = APIRouter(prefix="/ws", tags=['websocket'])
 
@@ -18,12 +28,16 @@ class Payload(BaseModel):
 
 def is_authenticated(scope):
 	token = scope['path_params']['token']
-	user = get_current_user(token)
-	user = Inventory(**user)
+	user = decode_access_token(token)
 	return user_channels(user)
 
 
-def user_channels(user: Inventory) -> Tuple[List[str], Inventory]:
+def is_channel(channel: str) -> bool:
+	# subscribers may be on another worker, so channels are recognised by name
+	return channel == "general" or re.fullmatch(r"user_\d+", channel) is not None
+
+
+def user_channels(user: UserBase) -> Tuple[List[str], UserBase]:
 	channels = ["general", f"user_{user.id}"]
 	# if not user.is_admin:
 	# 	channels.append("broadcast")
@@ -32,45 +46,336 @@ def user_channels(user: Inventory) -> Tuple[List[str], Inventory]:
 	return channels, user
 
 
+# frame encodings a client can ask for with ?encoding=, json frames are text and msgpack ones binary
+ENCODERS = {"json": json.dumps, "msgpack": msgpack.packb}
+
+
+class Message:
+	"""a message queued for many connections, encoded at most once per encoding"""
+	__slots__ = ("channel", "data", "frames")
+
+	def __init__(self, channel: Optional[str], data: Union[dict, str]):
+		self.channel = channel
+		self.data = data
+		self.frames = dict()
+
+	@classmethod
+	def reply(cls, text: str) -> "Message":
+		# replies to the sender are plain text for json clients, as they always were
+		message = cls(None, text)
+		message.frames["json"] = text
+		return message
+
+	def frame(self, encoding: str) -> Union[str, bytes]:
+		frame = self.frames.get(encoding)
+		if frame is None:
+			frame = self.frames[encoding] = ENCODERS[encoding](self.data)
+		return frame
+
+
+def json_batch(channels: Dict[str, List[Message]]) -> str:
+	return '{"channels":{' + ",".join(f'{json.dumps(channel)}:[{",".join(message.frame("json") for message in messages)}]'
+	                                  for channel, messages in channels.items()) + "}}"
+
+
+def msgpack_batch(channels: Dict[str, List[Message]]) -> bytes:
+	packer = msgpack.Packer()
+	parts = [packer.pack_map_header(1), packer.pack("channels"), packer.pack_map_header(len(channels))]
+	for channel, messages in channels.items():
+		parts.append(packer.pack(channel))
+		parts.append(packer.pack_array_header(len(messages)))
+		parts.extend(message.frame("msgpack") for message in messages)
+	return b"".join(parts)
+
+
+# batch frames are put together from the frames the messages already have, nothing is encoded twice
+BATCHERS = {"json": json_batch, "msgpack": msgpack_batch}
+
+
+def protocol(websocket: WebSocket) -> dict:
+	"""
+	the framing a client opted into on connect: ?encoding=json|msgpack and ?batch_ms=N, which
+	has the client's events sent every N milliseconds as one {"channels": {channel: [events]}}
+	frame instead of one frame each, and ?heartbeat=1 for application level pings
+	"""
+	encoding = websocket.query_params.get("encoding", "json")
+	try:
+		batch_ms = int(websocket.query_params.get("batch_ms", 0))
+	except ValueError:
+		batch_ms = 0
+	if batch_ms:
+		batch_ms = min(max(batch_ms, settings.WS_BATCH_MIN_MS), settings.WS_BATCH_MAX_MS)
+	return {"encoding": encoding if encoding in ENCODERS else "json", "batch_interval": batch_ms / 1000,
+	        "heartbeat": websocket.query_params.get("heartbeat") in ("1", "true")}
+
+
+class Connection:
+	"""
+	one socket and its outbound queue, drained by a writer task of its own so a slow client
+	only ever delays itself. when the queue is full the slow consumer policy applies:
+	"coalesce" replaces the queued message of the same channel and event (or the oldest one)
+	with the new one, "disconnect" drops the client
+	"""
+
+	def __init__(self, websocket: WebSocket, user: UserBase, channels: List[str],
+	             encoding: str = "json", batch_interval: float = 0, heartbeat: bool = False,
+	             on_failure: Callable[["Connection"], Awaitable] = None):
+		self.websocket = websocket
+		self.user = user
+		self.channels = channels
+		self.encoding = encoding
+		self.batch_interval = batch_interval
+		self.pending = deque()
+		self.ready = asyncio.Event()
+		self.writer: Optional[asyncio.Task] = None
+		# called when the writer cannot send anymore, the manager evicts the connection
+		self.on_failure = on_failure
+		self.dropped = 0
+		# pinged by the manager and evicted when idle, clients opt in with ?heartbeat=1
+		self.heartbeat = heartbeat
+		# last time the client sent anything, pongs included
+		self.last_seen = time.monotonic()
+
+	def offer(self, message: Message, key: tuple = None) -> bool:
+		"""queues a message without waiting, False when the client is too slow to keep"""
+		if len(self.pending) >= settings.WS_QUEUE_SIZE:
+			if settings.WS_SLOW_CONSUMER_POLICY == "disconnect":
+				return False
+			self.coalesce(key)
+		self.pending.append((key, message))
+		self.ready.set()
+		return True
+
+	def coalesce(self, key: tuple):
+		self.dropped += 1
+		if key is not None:
+			for index, (queued, _) in enumerate(self.pending):
+				if queued == key:
+					del self.pending[index]
+					return
+		self.pending.popleft()
+
+	async def send(self, frame: Union[str, bytes]):
+		if isinstance(frame, bytes):
+			await self.websocket.send_bytes(frame)
+		else:
+			await self.websocket.send_text(frame)
+
+	def encode(self, message: Message) -> Optional[Union[str, bytes]]:
+		try:
+			return message.frame(self.encoding)
+		except (TypeError, ValueError, OverflowError) as e:
+			# a message that cannot be encoded is dropped, the connection keeps going
+			logging.error(f"dropping a websocket message of channel {message.channel} for user {self.user.id}, "
+			              f"it cannot be encoded as {self.encoding}: {e!r}")
+			self.dropped += 1
+			return None
+
+	async def write(self):
+		try:
+			while True:
+				if not self.pending:
+					self.ready.clear()
+					await self.ready.wait()
+					continue
+				if self.batch_interval:
+					await asyncio.sleep(self.batch_interval)
+					await self.write_batch()
+					continue
+				_, message = self.pending.popleft()
+				frame = self.encode(message)
+				if frame is not None:
+					await self.send(frame)
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			logging.info(f"websocket writer of user {self.user.id} stopped: {e}")
+			# nothing reaches the client anymore, it should not stay subscribed
+			if self.on_failure is not None:
+				asyncio.create_task(self.on_failure(self))
+
+	async def write_batch(self):
+		pending, self.pending = self.pending, deque()
+		channels = dict()
+		for _, message in pending:
+			frame = self.encode(message)
+			if frame is None:
+				continue
+			if message.channel is None:
+				await self.send(frame)
+			else:
+				channels.setdefault(message.channel, []).append(message)
+		if channels:
+			await self.send(BATCHERS[self.encoding](channels))
+
+	def footprint(self) -> int:
+		"""
+		estimated bytes of the python objects kept for this connection. messages are shared
+		between connections and the user with the token cache, so neither is counted
+		"""
+		scope = getattr(self.websocket, "scope", dict())
+		objects = [self, self.__dict__, self.pending, self.ready, self.channels, *self.channels,
+		           *self.pending, self.websocket, vars(self.websocket), scope, *scope.get("headers", ()),
+		           *(value for header in scope.get("headers", ()) for value in header)]
+		if self.writer:
+			objects += [self.writer, self.writer.get_coro(), self.writer.get_coro().cr_frame]
+		# an entry in the users and channels sets
+		return sum(sys.getsizeof(item) for item in objects) + (len(self.channels) + 1) * 16
+
+	async def close(self, code: int = 1000):
+		if self.writer:
+			self.writer.cancel()
+		try:
+			await asyncio.wait_for(self.websocket.close(code=code), timeout=settings.WS_CLOSE_TIMEOUT)
+		except Exception:
+			pass
+
+
 class ConnectionManager:
 	def __init__(self):
-		self.users = dict()
-		self.channels = dict()
+		# user id -> that user's connections, a user may be connected from several devices
+		self.users: Dict[int, Set[Connection]] = dict()
+		self.channels: Dict[str, Set[Connection]] = dict()
+		# carries messages to the connections of other workers, see services/channel_bus.py
+		self.bus = None
+		self.heartbeat: Optional[asyncio.Task] = None
 
-	async def connect(self, websocket: WebSocket):
-		channels, user = is_authenticated(websocket.scope)
-		self.users[user.id] = websocket
-		for channel in channels:
-			if channel not in self.channels:
-				self.channels[channel] = set()
-			self.channels[channel].add(user.id)
+	async def connect(self, websocket: WebSocket) -> Optional[Connection]:
+		try:
+			channels, user = is_authenticated(websocket.scope)
+		except HTTPException:
+			await websocket.close(code=1008)
+			return None
 		await websocket.accept()
-
-	async def disconnect(self, websocket: WebSocket):
-		channels, user = is_authenticated(websocket.scope)
-		del self.users[user.id]
+		connection = Connection(websocket, user, channels, on_failure=self.evict, **protocol(websocket))
+		connection.writer = asyncio.create_task(connection.write())
+		self.users.setdefault(user.id, set()).add(connection)
 		for channel in channels:
-			if channel in self.channels:
-				self.channels[channel].remove(user.id)
+			self.channels.setdefault(channel, set()).add(connection)
+		if connection.heartbeat and self.heartbeat is None and settings.WS_HEARTBEAT_INTERVAL:
+			self.heartbeat = asyncio.create_task(self.beat())
+		return connection
+
+	async def disconnect(self, connection: Connection):
+		if connection.writer:
+			connection.writer.cancel()
+		connections = self.users.get(connection.user.id, set())
+		connections.discard(connection)
+		if not connections:
+			self.users.pop(connection.user.id, None)
+		for channel in connection.channels:
+			subscribers = self.channels.get(channel)
+			if subscribers is None:
+				continue
+			subscribers.discard(connection)
+			if not subscribers:
+				del self.channels[channel]
 
-	async def notify(self, websocket: WebSocket):
-		data = await websocket.receive_json()
+	def broadcast(self, channel: str, data: dict) -> int:
+		"""
+		queues data for every connection of the channel and returns how many got it. the
+		message is serialized once per encoding in use, delivery is left to each connection's writer
+		"""
+		message = Message(channel, data)
+		key = (channel, data.get("event"))
+		delivered = 0
+		for connection in list(self.channels.get(channel, ())):
+			if connection.offer(message, key):
+				delivered += 1
+			else:
+				logging.warning(f"dropping slow websocket client of user {connection.user.id}")
+				asyncio.create_task(self.evict(connection))
+		return delivered
+
+	def publish(self, channel: str, data: dict) -> int:
+		"""broadcasts to this worker's connections and, through the bus, to every other worker's"""
+		if self.bus is not None:
+			self.bus.publish(channel, data)
+		return self.broadcast(channel, data)
+
+	async def evict(self, connection: Connection, code: int = 1013):
+		await self.disconnect(connection)
+		await connection.close(code=code)
+
+	def connections(self) -> List[Connection]:
+		return [connection for connections in self.users.values() for connection in connections]
+
+	async def beat(self):
+		"""
+		pings the connections that opted into heartbeats each WS_HEARTBEAT_INTERVAL seconds and
+		evicts the ones that sent nothing, not even a pong, for WS_IDLE_TIMEOUT seconds. the others
+		are kept alive by the server's protocol level pings
+		"""
+		while True:
+			await asyncio.sleep(settings.WS_HEARTBEAT_INTERVAL)
+			ping = Message(None, {"event": "ping"})
+			idle_since = time.monotonic() - settings.WS_IDLE_TIMEOUT
+			for connection in self.connections():
+				if not connection.heartbeat:
+					continue
+				if settings.WS_IDLE_TIMEOUT and connection.last_seen < idle_since:
+					logging.info(f"evicting idle websocket client of user {connection.user.id}")
+					asyncio.create_task(self.evict(connection, code=1001))
+				elif not connection.offer(ping):
+					asyncio.create_task(self.evict(connection))
+
+	async def stop(self):
+		if self.heartbeat:
+			self.heartbeat.cancel()
+			await asyncio.gather(self.heartbeat, return_exceptions=True)
+			self.heartbeat = None
+
+	def stats(self, largest: int = 10) -> dict:
+		connections = self.connections()
+		sample = connections[:100]
+		per_connection = sum(connection.footprint() for connection in sample) // len(sample) if sample else 0
+		channels = sorted(self.channels.items(), key=lambda item: len(item[1]), reverse=True)
+		return {
+			"connections": len(connections),
+			"users": len(self.users),
+			"channels": len(self.channels),
+			"largest_channels": {channel: len(subscribers) for channel, subscribers in channels[:largest]},
+			"encodings": dict(Counter(connection.encoding for connection in connections)),
+			"batched": sum(1 for connection in connections if connection.batch_interval),
+			"queued_messages": sum(len(connection.pending) for connection in connections),
+			"dropped_messages": sum(connection.dropped for connection in connections),
+			"estimated_bytes_per_connection": per_connection,
+			"estimated_bytes": per_connection * len(connections),
+		}
+
+	async def notify(self, connection: Connection):
+		data = await connection.websocket.receive_json()
+		connection.last_seen = time.monotonic()
+		# heartbeat frames carry no channel, events named ping on a channel are broadcast as usual
+		if "channel" not in data and data.get("event") in ("ping", "pong"):
+			if data["event"] == "ping":
+				connection.offer(Message(None, {"event": "pong"}))
+			return
 		channel = data['channel']
-		if channel not in self.channels:
-			await websocket.send_text("Invalid channel")
+		if not is_channel(channel):
+			connection.offer(Message.reply("Invalid channel"))
 			return
-		for user in self.channels[channel]:
-			await self.users[user].send_json(data)
+		self.publish(channel, data)
 
 
 manager = ConnectionManager()
 
 
+@router.get("/stats")
+async def websocket_stats(user: UserBase = Depends(get_staff_user)):
+	# channel names carry user ids
+	return manager.stats()
+
+
 @router.websocket("/{token}/")
 async def websocket_endpoint(websocket: WebSocket, token: str):
-	await manager.connect(websocket)
+	connection = await manager.connect(websocket)
+	if connection is None:
+		return
 	try:
 		while True:
-			await manager.notify(websocket)
+			await manager.notify(connection)
 	except WebSocketDisconnect:
-		await manager.disconnect(websocket)
+		pass
+	finally:
+		await manager.disconnect(connection)
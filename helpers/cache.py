@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class TTLCache:
+	"""
+	bounded in-process cache, entries expire after `ttl` seconds and the least recently
+	used entry is evicted once `maxsize` is reached. safe to share between threads.
+	"""
+	missing = object()
+
+	def __init__(self, maxsize: int = 1024, ttl: float = 60):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key: Hashable, default=None):
+		with self.lock:
+			entry = self.entries.get(key, self.missing)
+			if entry is self.missing:
+				return default
+			expires_at, value = entry
+			if expires_at < time.monotonic():
+				del self.entries[key]
+				return default
+			self.entries.move_to_end(key)
+			return value
+
+	def set(self, key: Hashable, value: Any, ttl: float = None):
+		with self.lock:
+			self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+
+	def delete(self, key: Hashable):
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def invalidate(self, predicate: Callable[[Hashable], bool]):
+		with self.lock:
+			for key in [key for key in self.entries if predicate(key)]:
+				del self.entries[key]
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+import settings
+
+
+class CircuitOpenError(Exception):
+	pass
+
+
+class CircuitBreaker:
+	"""
+	guards calls to a dependency that may be down. failure_threshold failures in a row open it,
+	then calls fail at once instead of waiting on timeouts. after reset_timeout seconds one trial
+	call is let through (half open), its success closes the breaker and its failure opens it again.
+	an error is a failure when is_failure says so, any error by default. the others are answers of a
+	dependency that is up, like refused requests. safe to share between threads.
+	"""
+
+	def __init__(self, name: str, failure_threshold: int = None, reset_timeout: float = None,
+	             is_failure: Callable[[Exception], bool] = None):
+		self.name = name
+		self.is_failure = is_failure or (lambda error: True)
+		self.failure_threshold = failure_threshold or settings.BREAKER_FAILURE_THRESHOLD
+		self.reset_timeout = settings.BREAKER_RESET_TIMEOUT if reset_timeout is None else reset_timeout
+		self.failures = 0
+		self.opened_at = None
+		self.trial = False
+		self.lock = threading.Lock()
+
+	@property
+	def state(self) -> str:
+		if self.opened_at is None:
+			return "closed"
+		return "half open" if self.trial else "open"
+
+	def allow(self) -> bool:
+		with self.lock:
+			if self.opened_at is None:
+				return True
+			if not self.trial and time.monotonic() - self.opened_at >= self.reset_timeout:
+				self.trial = True
+				return True
+			return False
+
+	def success(self):
+		with self.lock:
+			if self.opened_at is not None:
+				logging.warning(f"{self.name} circuit closed")
+			self.failures = 0
+			self.opened_at = None
+			self.trial = False
+
+	def failure(self):
+		with self.lock:
+			self.failures += 1
+			if self.trial or self.failures >= self.failure_threshold:
+				if self.opened_at is None:
+					logging.error(f"{self.name} circuit open after {self.failures} failures")
+				self.opened_at = time.monotonic()
+				self.trial = False
+
+	def call(self, function: Callable, *args, **kwargs):
+		if not self.allow():
+			raise CircuitOpenError(f"{self.name} is unavailable")
+		try:
+			result = function(*args, **kwargs)
+		except Exception as e:
+			if self.is_failure(e):
+				self.failure()
+			else:
+				self.success()
+			raise
+		self.success()
+		return result
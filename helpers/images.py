@@ -0,0 +1,25 @@
+"""
+Rendering of product image variants. Runs in worker processes, keep the imports light.
+"""
+import io
+from typing import Dict
+
+from PIL import Image, ImageOps
+
+
+def render_variants(content: bytes, sizes: Dict[str, int], quality: int) -> Dict[str, bytes]:
+	"""
+	WebP copies of an image, one per name in sizes, scaled down to fit that many pixels on
+	their longer side. images smaller than a size are not scaled up
+	"""
+	with Image.open(io.BytesIO(content)) as image:
+		image = ImageOps.exif_transpose(image)
+		image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+		variants = dict()
+		for name, size in sizes.items():
+			variant = image.copy()
+			variant.thumbnail((size, size), Image.LANCZOS)
+			output = io.BytesIO()
+			variant.save(output, "WEBP", quality=quality, method=4)
+			variants[name] = output.getvalue()
+		return variants
@@ -1,7 +1,10 @@
+import base64
+import json
 import logging
-from typing import List, Any
+from enum import Enum
+from typing import List, Any, Optional
 
-from fastapi import Query, Depends
+from fastapi import Query, Depends, HTTPException
 from starlette.responses import JSONResponse, Response
 
 from helpers.exceptions import AuthorizationError, ValidationError, NotFoundError, AuthenticationError
@@ -31,12 +34,57 @@ class FailureResponse:
 items = [f"Item {i}" for i in range(1, 1001)]
 
 
+class CountStrategy(str, Enum):
+	exact = "exact"
+	# planner statistics for unfiltered lists, exact otherwise
+	estimated = "estimated"
+	# exact count kept per filter signature for settings.COUNT_CACHE_TTL seconds
+	cached = "cached"
+
+
 # Define a dependency function that returns the pagination parameters
 def pagination_params(
 		page: int = Query(1, gt=0),
-		per_page: int = Query(10, gt=0)
+		per_page: int = Query(10, gt=0),
+		after: str = Query(None, description="cursor returned as next_cursor by the previous page"),
+		include_count: bool = Query(True, description="set to false to skip counting the results"),
+		count_strategy: CountStrategy = Query(None, description="how the total count is computed, "
+		                                                        "defaults to settings.DEFAULT_COUNT_STRATEGY")
 ):
-	return {"page": page, "per_page": per_page}
+	return {"page": page, "per_page": per_page, "after": decode_cursor(after) if after else None,
+	        "include_count": include_count, "count_strategy": count_strategy}
+
+
+def encode_cursor(values: dict) -> str:
+	data = json.dumps(values, separators=(",", ":"), default=str).encode()
+	return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+	try:
+		values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+	except ValueError:
+		values = None
+	if not isinstance(values, dict):
+		raise HTTPException(status_code=400, detail="Invalid cursor")
+	return values
+
+
+def next_cursor(results: List[Any], limit: int, fields: tuple) -> Optional[str]:
+	if not results or len(results) < limit:
+		return None
+	last = results[-1]
+	if hasattr(last, "keys"):
+		return encode_cursor({field: last[field] for field in fields})
+	return encode_cursor({field: getattr(last, field) for field in fields})
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+	if not if_none_match:
+		return False
+	if if_none_match.strip() == "*":
+		return True
+	return etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
 
 
 def paginated_list(page: int, per_page: int, items: List[Any]):
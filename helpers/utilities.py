@@ -1,55 +1,24 @@
 import asyncio
-import json
 import logging
-from typing import List
-
-import boto3
-import websockets
-from decouple import config
+from typing import BinaryIO, Callable, List, Optional, Union
 
 import settings
-from settings.jwt_config import create_access_token
+from helpers.circuit_breaker import CircuitBreaker, CircuitOpenError
+from services.spool import Spool
+from services.storage import Storage, LocalStorage, S3Storage, upload_pool, s3_unavailable
+from services.ws_publisher import publisher
 
 
 class WebSocketUtil:
-
-	@staticmethod
-	async def websocket_client(url, payload):
-		async with websockets.connect(url) as websocket:
-			await websocket.send(payload)
-			await websocket.recv()
-
-	@staticmethod
-	def get_or_create_eventloop():
-		try:
-			return asyncio.get_event_loop()
-		except RuntimeError as ex:
-			if "There is no current event loop in thread" in str(ex):
-				loop = asyncio.new_event_loop()
-				asyncio.set_event_loop(loop)
-				return asyncio.get_event_loop()
-
-	@staticmethod
-	def send_websocket(user, payload):
-		try:
-			token = create_access_token(user)
-			url = f"ws://{config('WEBSOCKET_URL', 'localhost')}:8000/ws/{token}/"
-			loop = WebSocketUtil.get_or_create_eventloop()
-			loop.run_until_complete(WebSocketUtil.websocket_client(url, payload))
-		except Exception as e:
-			logging.critical(e)
+	"""sync entry points of services.ws_publisher, async code can await publisher.publish_async"""
 
 	@staticmethod
 	def send_ws_single_channel(user, channel: str, event: str, data: dict):
-		payload = json.dumps(dict(channel=channel, event=event, data=data, sender=user.id))
-		WebSocketUtil.send_websocket(user, payload)
+		publisher.publish(channel, event, data, sender=user.id)
 
 	@staticmethod
 	def send_ws_multiple_channels(user, channels: List[str], event: str, data: dict):
-		payload = json.dumps(
-			dict(channels=channels, event=event, data=data, sender=user.id)
-		)
-		WebSocketUtil.send_websocket(user, payload)
+		publisher.publish_many([publisher.message(channel, event, data, sender=user.id) for channel in channels])
 
 
 class FileSaver:
@@ -57,56 +26,109 @@ class FileSaver:
 
 	def __init__(self, upload_type: str):
 		self.upload_type = upload_type
+		self.storage: Optional[Storage] = None
+		# s3 calls fail fast while s3 is unavailable or throttling, the uploads and deletes are spooled
+		# and replayed in order once it is back. while the spool holds anything new ones queue behind
+		# them. urls are known upfront, a spooled file serves after its replay
+		self.breaker = CircuitBreaker("s3", is_failure=s3_unavailable)
+		self.spool = None
+		# replays the spooled deletes of files that have owners, see services/blobs.py
+		self.replay_owned_delete: Optional[Callable[[List[str], List[str], Callable[[List[str]], None]], None]] = None
+		if upload_type == "file":
+			self.storage = LocalStorage()
+		elif upload_type == "AWS":
+			self.storage = S3Storage(settings.AWS_S3_BUCKET_NAME)
+			self.spool = Spool("s3")
+			self.spool.start_replay(self.replay)
+
+	def url(self, folder: str, name: str) -> str:
+		if self.storage is None:
+			raise Exception("This upload type is invalid")
+		return self.storage.url(self.storage.key(folder, name))
+
+	def save(self, folder: str, name: str, content: Union[bytes, BinaryIO]) -> str:
+		if self.storage is None:
+			raise Exception("This upload type is invalid")
+		key = self.storage.key(folder, name)
+		self.store({"action": "put", "key": key}, content)
+		return self.storage.url(key)
+
+	async def save_upload(self, folder: str, name: str, file: BinaryIO) -> str:
+		"""
+		save for uploads. the file is copied in chunks on the upload pool, so the event loop never
+		waits on the disk or s3 and an upload takes UPLOAD_CHUNK_SIZE of memory, not its size
+		"""
+		return await self.save_async(folder, name, file)
+
+	async def save_async(self, folder: str, name: str, content: Union[bytes, BinaryIO]) -> str:
+		return await asyncio.get_running_loop().run_in_executor(upload_pool, self.save, folder, name, content)
+
+	def read(self, url: str) -> bytes:
+		if self.storage is None:
+			raise Exception("This upload type is invalid")
+		key = self.storage.key_of(url)
+		if self.spool is None:
+			return self.storage.get(key)
+		return self.breaker.call(self.storage.get, key)
+
+	async def read_async(self, url: str) -> bytes:
+		return await asyncio.get_running_loop().run_in_executor(upload_pool, self.read, url)
+
+	def delete(self, url: str):
+		self.delete_many([url])
+
+	def delete_many(self, urls: List[str], owners: List[str] = None) -> bool:
+		"""
+		one request per 1000 files on s3. owners are the urls the files belong to, one per url. a
+		spooled delete of owned files goes through replay_owned_delete. returns False when spooled
+		"""
+		if self.storage is None:
+			raise Exception("This upload type is invalid")
+		if not urls:
+			return True
+		meta = {"action": "delete", "keys": [self.storage.key_of(url) for url in urls]}
+		if owners:
+			meta["owners"] = owners
+		return self.store(meta)
+
+	async def delete_async(self, urls: List[str], owners: List[str] = None) -> bool:
+		return await asyncio.get_running_loop().run_in_executor(upload_pool, self.delete_many, urls, owners)
+
+	def store(self, meta: dict, content: Union[bytes, BinaryIO] = b"") -> bool:
+		"""applies meta now and returns True, or spools it and returns False"""
+		if self.spool is None:
+			self.apply(meta, content)
+			return True
+		# a record leaves the spool once it was sent, so this also waits out the one being replayed
+		if len(self.spool):
+			self.spool.put(meta, content)
+			return False
+		try:
+			self.breaker.call(self.apply, meta, content)
+			return True
+		except Exception as e:
+			if not isinstance(e, CircuitOpenError) and not s3_unavailable(e):
+				raise
+			logging.warning(f"spooling s3 {meta['action']} of {meta.get('key') or meta['keys']}: {e!r}")
+			self.spool.put(meta, content)
+			return False
 
-	def save(self, folder: str, name: str, content: bytes):
-		if self.upload_type == "file":
-			return self.__save_media_to_folder(folder, name, content)
-		elif self.upload_type == "AWS":
-			return self.__save_media_to_aws(folder, name, content)
-		raise Exception("This upload type is invalid")
-
-
-	def delete(self, url):
-		if self.upload_type == "file":
-			return self.__remove_media_from_folder(url)
-		elif self.upload_type == "AWS":
-			return self.__remove_media_from_aws(url)
-		raise Exception("This upload type is invalid")
-
-	@staticmethod
-	def __save_media_to_folder(folder: str, name: str, content: bytes) -> str:
-		import os
-
-		folder_path = os.path.join(settings.MEDIA_URL, folder)
-		if not os.path.exists(folder_path):
-			os.makedirs(folder_path)
-		full_path = os.path.join(folder_path, name)
-		with open(full_path, 'wb') as file:
-			file.write(content)
-		return full_path
-
-	@staticmethod
-	def __remove_media_from_folder(url: str):
-		import os
-		print("url: ",url)
-		if os.path.exists(url):
-			os.remove(url)
-		return
-
-
-	@staticmethod
-	def __save_media_to_aws(folder: str, name: str, content: bytes):
-		import os
-		file_path = os.path.join(settings.MEDIA_URL, folder, name)
-		s3 = boto3.client('s3', aws_access_key_id=settings.AWS_ACCESS_KEY
-		                  , aws_secret_access_key=settings.AWS_SECRET_KEY)
-		s3.put_object(Body=content, Bucket=settings.AWS_S3_BUCKET_NAME, Key=file_path)
-		s3_url = f"https://{settings.AWS_S3_BUCKET_NAME}.s3.amazonaws.com/{file_path}"
-		return s3_url
-
-	@staticmethod
-	def __remove_media_from_aws(url:str):
-		s3 = boto3.client('s3', aws_access_key_id=settings.AWS_ACCESS_KEY
-		                  , aws_secret_access_key=settings.AWS_SECRET_KEY)
-		s3.delete_object(Bucket=settings.AWS_S3_BUCKET_NAME, Key=url)
-		return
\ No newline at end of file
+	def replay(self, meta: dict, body: bytes):
+		try:
+			if meta.get("owners") and self.replay_owned_delete:
+				self.replay_owned_delete(meta["owners"], meta["keys"], lambda keys: self.breaker.call(
+					self.apply, {"action": "delete", "keys": keys}, b""))
+			else:
+				self.breaker.call(self.apply, meta, body)
+		except Exception as e:
+			if isinstance(e, CircuitOpenError) or s3_unavailable(e):
+				raise
+			# s3 refused it and would again, the records behind it go on
+			logging.error(f"dropping spooled s3 {meta['action']} of {meta.get('key') or meta['keys']}: {e!r}")
+
+	def apply(self, meta: dict, content: Union[bytes, BinaryIO]):
+		if meta["action"] == "put":
+			self.storage.put(meta["key"], content)
+		else:
+			# records spooled before deletes were batched have a single key
+			self.storage.delete(meta.get("keys") or [meta["key"]])
@@ -1,4 +1,6 @@
-from fastapi import FastAPI
+import asyncio
+
+from fastapi import Depends, FastAPI
 from fastapi.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.trustedhost import TrustedHostMiddleware
@@ -11,6 +13,15 @@ from settings.database import create_db
 from middlewares import LoggingMiddleware
 import sentry_sdk
 from services.rabbit_mq_service.main import rabbit_mq_service
+from services.outbox import outbox_relay
+from services.cache import detail_cache
+from services.channel_bus import ChannelBus, create_backend
+from services.ws_publisher import publisher
+from services.suggestions import build_suggestion_index, refresh_suggestion_index
+from schemas.users import UserBase
+from settings.jwt_config import get_staff_user
+from signals import signal_tasks
+from repositories.helpers import table_versions
 
 sentry_sdk.init(
 	dsn="",
@@ -28,8 +39,68 @@ middlewares = [
 
 create_db()
 rabbit_mq_service.consume_in_background()
+outbox_relay.start(rabbit_mq_service.publisher)
 app = FastAPI(middleware=middlewares)
 
+
+@app.on_event("startup")
+async def load_suggestions():
+	await build_suggestion_index()
+	if settings.SUGGEST_REFRESH_INTERVAL:
+		app.state.suggestion_refresher = asyncio.create_task(refresh_suggestion_index())
+
+
+@app.on_event("startup")
+async def start_channel_bus():
+	if settings.WS_BUS_BACKEND != "none":
+		consumer.manager.bus = ChannelBus(create_backend(), consumer.manager.broadcast)
+		await consumer.manager.bus.start()
+	publisher.attach(asyncio.get_running_loop(), consumer.manager)
+
+
+@app.on_event("startup")
+async def attach_detail_cache():
+	# rabbitmq consumer threads invalidate cached details on this loop
+	detail_cache.attach(asyncio.get_running_loop())
+
+
+@app.on_event("startup")
+async def start_table_versions():
+	await table_versions.start()
+
+
+@app.on_event("shutdown")
+async def stop_table_versions():
+	await table_versions.stop()
+
+
+@app.on_event("startup")
+async def start_signal_tasks():
+	signal_tasks.start()
+
+
+@app.on_event("shutdown")
+async def stop_signal_tasks():
+	await signal_tasks.stop()
+
+
+@app.on_event("shutdown")
+async def stop_channel_bus():
+	publisher.detach()
+	if consumer.manager.bus is not None:
+		await consumer.manager.bus.stop()
+
+
+@app.on_event("shutdown")
+async def stop_heartbeat():
+	await consumer.manager.stop()
+
+
+@app.get("/cache/stats")
+async def cache_stats(user: UserBase = Depends(get_staff_user)):
+	return detail_cache.stats()
+
+
 @app.get("/sentry-debug")
 async def trigger_error():
 	division_by_zero = 1 / 0
@@ -1,6 +1,10 @@
+import uuid
 from datetime import datetime
+from typing import List, Optional
 
-from sqlalchemy import ForeignKey, String, Text, Column, Integer, Float, DateTime, Boolean
+from fastapi import UploadFile
+from sqlalchemy import ForeignKey, String, Text, Column, Integer, Float, DateTime, Boolean, Computed, Index, func, BigInteger, JSON
+from sqlalchemy.dialects.postgresql import TSVECTOR, JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 import settings
@@ -10,6 +14,16 @@ from settings.database import Base
 file_saver = FileSaver(settings.UPLOAD_TYPE)
 
 
+def search_vector(*weighted_columns: tuple):
+	"""
+	generated tsvector over (column, weight) pairs, backs the `search` query parameter.
+	deferred so regular selects do not ship it
+	"""
+	expression = " || ".join(f"setweight(to_tsvector('{settings.SEARCH_CONFIG}', coalesce({column}, '')), '{weight}')"
+	                         for column, weight in weighted_columns)
+	return mapped_column(TSVECTOR, Computed(expression, persisted=True), deferred=True)
+
+
 
 class BaseFile(Base):
 	__abstract__ = True
@@ -22,17 +36,37 @@ class BaseFile(Base):
 		file_record = cls(name=name, url=url, **kwargs)
 		return file_record
 
+	@staticmethod
+	def storage_name(name: str) -> str:
+		# uploads of one request are saved concurrently, the timestamp alone could repeat
+		extension = name.split(".")[-1]
+		return f"prod_image_{datetime.now().timestamp()}_{uuid.uuid4().hex[:8]}.{extension}"
+
 	@classmethod
 	def save(cls, name, content, **kwargs):
-		extension = name.split(".")[-1]
-		name = f"prod_image_{datetime.now().timestamp()}.{extension}"
+		name = cls.storage_name(name)
 		url = file_saver.save(folder=cls.upload_to, name=name, content=content)
 		return cls.create(name, url, **kwargs)
 
+	@classmethod
+	async def save_upload(cls, upload: UploadFile, **kwargs):
+		"""save for an UploadFile, streamed to storage without reading it into memory"""
+		name = cls.storage_name(upload.filename)
+		url = await file_saver.save_upload(folder=cls.upload_to, name=name, file=upload.file)
+		return cls.create(name, url, **kwargs)
+
+
+	def urls(self) -> List[str]:
+		return [self.url, *(getattr(self, "variants", None) or {}).values()]
 
 	def delete_file(self):
 		print("actual_url: ", self.url)
-		return file_saver.delete(self.url)
+		return file_saver.delete_many(self.urls())
+
+	@staticmethod
+	async def delete_files(instances: list):
+		"""deletes the files of many records, in batches on s3"""
+		await file_saver.delete_async([url for instance in instances for url in instance.urls()])
 
 
 
@@ -45,6 +79,9 @@ class Inventory(Base):
 	date_of_acquisition: Mapped[datetime] = mapped_column(DateTime(timezone=True))
 	location: Mapped[str] = mapped_column(String(100))
 	products = relationship("Product", back_populates="inventory", cascade="all, delete-orphan")
+	search_vector = search_vector(("name", "A"), ("location", "B"), ("description", "C"))
+
+	__table_args__ = (Index("ix_inventories_search_vector", "search_vector", postgresql_using="gin"),)
 
 	def __repr__(self) -> str:
 		return f"Inventory(id={self.id!r}, name={self.name!r}"
@@ -65,6 +102,9 @@ class Product(Base):
 	quantity: Mapped[int] = mapped_column(Integer())
 	images = relationship("ProductFile", back_populates="product", cascade="all, delete-orphan")
 	orders = relationship("Order", back_populates="product", cascade="all, delete-orphan")
+	search_vector = search_vector(("name", "A"), ("description", "B"))
+
+	__table_args__ = (Index("ix_products_search_vector", "search_vector", postgresql_using="gin"),)
 
 
 class ProductFile(BaseFile):
@@ -72,6 +112,8 @@ class ProductFile(BaseFile):
 
 	upload_to = "products"
 	product_id: Mapped[int] = Column(Integer, ForeignKey('products.id'))
+	# variant name -> url of the resized WebP copies, see services/images.py
+	variants: Mapped[Optional[dict]] = mapped_column(JSONB, nullable=True)
 	product = relationship("Product", back_populates="images")
 
 
@@ -79,9 +121,12 @@ class Brand(Base):
 	__tablename__ = "brands"
 
 	id: Mapped[int] = mapped_column(primary_key=True)
-	name: Mapped[str] = mapped_column(String(length=100))
+	name: Mapped[str] = mapped_column(String(length=100), unique=True)
 	description: Mapped[str] = mapped_column(Text())
 	products = relationship("Product", back_populates="brand", cascade="all, delete-orphan")
+	search_vector = search_vector(("name", "A"), ("description", "B"))
+
+	__table_args__ = (Index("ix_brands_search_vector", "search_vector", postgresql_using="gin"),)
 
 
 
@@ -125,4 +170,35 @@ class Sale(Base):
 	customer_id: Mapped[int] = Column(Integer, ForeignKey("customers.id"))
 	customer = relationship("Customer", back_populates="sales")
 	location:Mapped[str] = mapped_column(Text())
-	orders = relationship("Order", back_populates="sale",  cascade="all, delete-orphan")
\ No newline at end of file
+	orders = relationship("Order", back_populates="sale",  cascade="all, delete-orphan")
+
+
+class ProcessedMessage(Base):
+	"""ids of the broker messages already applied, see services/rabbit_mq_service/inventory_events.py"""
+	__tablename__ = "processed_messages"
+
+	id: Mapped[str] = mapped_column(String(length=100), primary_key=True)
+	processed_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+	# old ids are pruned by age
+	__table_args__ = (Index("ix_processed_messages_processed_at", "processed_at"),)
+
+
+class OutboxEvent(Base):
+	"""events waiting to be published to other services, see services/outbox.py"""
+	__tablename__ = "outbox"
+
+	id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+	message_id: Mapped[str] = mapped_column(String(length=32), default=lambda: uuid.uuid4().hex)
+	event: Mapped[str] = mapped_column(String(length=100))
+	payload: Mapped[dict] = mapped_column(JSON)
+	created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+class Blob(Base):
+	"""stored file shared by the records with the same content, see services/blobs.py"""
+	__tablename__ = "blobs"
+
+	url: Mapped[str] = mapped_column(String(length=256), primary_key=True)
+	refcount: Mapped[int] = mapped_column(Integer, default=0)
+	created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,193 @@
+"""
+Read models queried by the repositories: products_view, sales_view and orders_view.
+
+With settings.READ_MODEL_MODE = "view" they are plain views over the write tables.
+With "table" they are denormalized tables of the same name, kept current by statement
+level triggers on the write tables that re-derive only the affected rows from the
+`<name>_source` views. Listing sales then reads one row per sale no matter how many
+orders it holds, the aggregation is paid once when an order changes.
+"""
+from sqlalchemy import Connection, text
+
+import settings
+
+SOURCES = {
+	"products_view": """
+		select p.id, p.name, p.description, p.brand_id, p.inventory_id, p.price, p.quantity,
+		       b.name as brand, i.name as inventory,
+		       array(select f.url from product_files f where f.product_id = p.id order by f.id) as images,
+		       array(select f.variants->>'thumbnail' from product_files f where f.product_id = p.id order by f.id) as thumbnails,
+		       p.search_vector
+		from products p
+		left join brands b on b.id = p.brand_id
+		left join inventories i on i.id = p.inventory_id
+	""",
+	"sales_view": """
+		select s.id, s.paid, s.date_ordered, s.date_paid, s.customer_id, c.name as customer, s.location,
+		       count(o.id) as orders_count, coalesce(sum(o.quantity * p.price), 0) as total_amount
+		from sales s
+		left join customers c on c.id = s.customer_id
+		left join orders o on o.sale_id = s.id
+		left join products p on p.id = o.product_id
+		group by s.id, c.name
+	""",
+	"orders_view": """
+		select o.id, o.sale_id, o.product_id, o.quantity, p.name as product, p.price,
+		       o.quantity * p.price as total_price, o.delivered, o.date_delivered, o.staff_id, st.name as staff
+		from orders o
+		left join products p on p.id = o.product_id
+		left join staffs st on st.id = o.staff_id
+	""",
+}
+
+# write table -> (read model, ids of the read model rows touched by {rows}, columns whose update matters)
+DEPENDENCIES = {
+	"products": [
+		("products_view", "select id from {rows}", None),
+		("orders_view", "select o.id from orders o join {rows} r on r.id = o.product_id", ("name", "price")),
+		("sales_view", "select distinct o.sale_id from orders o join {rows} r on r.id = o.product_id", ("price",)),
+	],
+	"brands": [("products_view", "select p.id from products p join {rows} r on r.id = p.brand_id", ("name",))],
+	"inventories": [("products_view", "select p.id from products p join {rows} r on r.id = p.inventory_id", ("name",))],
+	"product_files": [("products_view", "select product_id from {rows}", ("url", "product_id", "variants"))],
+	"customers": [("sales_view", "select s.id from sales s join {rows} r on r.id = s.customer_id", ("name",))],
+	"sales": [("sales_view", "select id from {rows}", None)],
+	"orders": [
+		("orders_view", "select id from {rows}", None),
+		("sales_view", "select sale_id from {rows}", ("sale_id", "product_id", "quantity")),
+	],
+	"staffs": [("orders_view", "select o.id from orders o join {rows} r on r.id = o.staff_id", ("name",))],
+}
+
+INDEXES = {
+	"view": [
+		"create index if not exists ix_products_name_id on products (name, id)",
+		"create index if not exists ix_product_files_product_id on product_files (product_id)",
+		"create index if not exists ix_orders_sale_id on orders (sale_id)",
+		"create index if not exists ix_orders_product_id on orders (product_id)",
+	],
+	"table": [
+		"create index if not exists ix_products_view_name_id on products_view (name, id)",
+		"create index if not exists ix_products_view_brand_id on products_view (brand_id)",
+		"create index if not exists ix_products_view_inventory_id on products_view (inventory_id)",
+		"create index if not exists ix_products_view_search_vector on products_view using gin (search_vector)",
+		"create index if not exists ix_orders_view_sale_id on orders_view (sale_id)",
+		"create index if not exists ix_orders_product_id on orders (product_id)",
+		"create index if not exists ix_orders_staff_id on orders (staff_id)",
+	],
+}
+
+# rows of a read model are locked while they are derived again, so two writers refreshing the same
+# row take turns and the second one reads what the first committed. rows gone from the source are
+# deleted, the others upserted
+REFRESH_FUNCTION = """
+create or replace function refresh_read_model(model text, ids int[]) returns void language plpgsql as $$
+declare
+	row_id int;
+	assignments text;
+begin
+	if ids is null or cardinality(ids) = 0 then
+		return;
+	end if;
+	foreach row_id in array (select array_agg(distinct id order by id) from unnest(ids) as id) loop
+		perform pg_advisory_xact_lock(hashtext(model), row_id);
+	end loop;
+	select string_agg(format('%I = excluded.%I', attname, attname), ', ' order by attnum) into assignments
+	from pg_attribute where attrelid = model::regclass and attnum > 0 and not attisdropped and attname <> 'id';
+	execute format('delete from %I m where m.id = any($1) and not exists (select from %I s where s.id = m.id)',
+	               model, model || '_source') using ids;
+	execute format('insert into %I select * from %I where id = any($1) on conflict (id) do update set %s',
+	               model, model || '_source', assignments) using ids;
+end $$;
+"""
+
+
+def relkind(conn: Connection, name: str):
+	return conn.exec_driver_sql(f"select relkind from pg_class where oid = to_regclass('{name}')").scalar()
+
+
+def column_names(conn: Connection, name: str) -> list:
+	return conn.execute(text("select column_name from information_schema.columns where table_name = :name "
+	                         "order by ordinal_position"), {"name": name}).scalars().all()
+
+
+def changed_rows(columns) -> str:
+	if not columns:
+		return "new_rows"
+	new = ", ".join(f"n.{column}" for column in columns)
+	old = ", ".join(f"o.{column}" for column in columns)
+	return f"(select n.* from new_rows n join old_rows o on o.id = n.id where ({new}) is distinct from ({old}))"
+
+
+def trigger_function(table: str) -> str:
+	statements = {"INSERT": [], "UPDATE": [], "DELETE": []}
+	for model, ids, columns in DEPENDENCIES[table]:
+		statements["INSERT"].append(f"perform refresh_read_model('{model}', array({ids.format(rows='new_rows')}));")
+		statements["DELETE"].append(f"perform refresh_read_model('{model}', array({ids.format(rows='old_rows')}));")
+		statements["UPDATE"].append(f"perform refresh_read_model('{model}', array({ids.format(rows=changed_rows(columns))}));")
+		if columns:
+			# the old side matters when a row moved, e.g. an order moved to another sale
+			statements["UPDATE"].append(f"perform refresh_read_model('{model}', array({ids.format(rows='old_rows')} "
+			                            f"except {ids.format(rows='new_rows')}));")
+	body = "\n".join(f"\tif TG_OP = '{op}' then\n\t\t" + "\n\t\t".join(lines) + "\n\tend if;"
+	                 for op, lines in statements.items())
+	return f"""
+create or replace function {table}_refresh_read_models() returns trigger language plpgsql as $$
+begin
+{body}
+	return null;
+end $$;
+"""
+
+
+def drop_triggers(conn: Connection):
+	for table in DEPENDENCIES:
+		for op in ("insert", "update", "delete"):
+			conn.exec_driver_sql(f"drop trigger if exists {table}_{op}_read_models on {table}")
+
+
+def create_views(conn: Connection):
+	drop_triggers(conn)
+	for name, query in SOURCES.items():
+		if relkind(conn, name) == "r":
+			conn.exec_driver_sql(f"drop table {name}")
+		conn.exec_driver_sql(f"drop view if exists {name}_source")
+		conn.exec_driver_sql(f"drop view if exists {name}")
+		conn.exec_driver_sql(f"create view {name} as {query}")
+	for index in INDEXES["view"]:
+		conn.exec_driver_sql(index)
+
+
+def create_tables(conn: Connection, rebuild: bool = False):
+	for name, query in SOURCES.items():
+		conn.exec_driver_sql(f"drop view if exists {name}_source")
+		conn.exec_driver_sql(f"create view {name}_source as {query}")
+		kind = relkind(conn, name)
+		if kind == "v":
+			conn.exec_driver_sql(f"drop view {name}")
+		elif kind == "r" and (rebuild or column_names(conn, name) != column_names(conn, f"{name}_source")):
+			# the query gained or lost columns
+			conn.exec_driver_sql(f"drop table {name}")
+		elif kind == "r":
+			continue
+		conn.exec_driver_sql(f"create table {name} as select * from {name}_source")
+		conn.exec_driver_sql(f"alter table {name} add primary key (id)")
+	conn.execute(text(REFRESH_FUNCTION))
+	for table in DEPENDENCIES:
+		conn.exec_driver_sql(trigger_function(table))
+	drop_triggers(conn)
+	for table in DEPENDENCIES:
+		for op, rows in (("insert", "new table as new_rows"),
+		                 ("update", "new table as new_rows old table as old_rows"),
+		                 ("delete", "old table as old_rows")):
+			conn.exec_driver_sql(f"create trigger {table}_{op}_read_models after {op} on {table} "
+			                     f"referencing {rows} for each statement "
+			                     f"execute function {table}_refresh_read_models()")
+	for index in INDEXES["table"]:
+		conn.exec_driver_sql(index)
+
+
+def create_read_models(conn: Connection, rebuild: bool = False):
+	if settings.READ_MODEL_MODE == "table":
+		return create_tables(conn, rebuild=rebuild)
+	return create_views(conn)
@@ -1,5 +1,3 @@
-from sqlalchemy import or_
-
 import models
 from helpers.exceptions import ValidationError
 from .helpers import *
@@ -7,6 +5,8 @@ from repositories.products import ProductRepository
 
 
 class BrandRepository(BaseRepository):
+	cache_reads = True
+	versioned = ("brands",)
 
 	def __init__(self,*args, **kwargs):
 		super().__init__(*args, **kwargs)
@@ -17,13 +17,21 @@ class BrandRepository(BaseRepository):
 	def query_parameters(search: str = Query(default=None, title="search", description="search for brands")):
 		return {"search": search}
 
+	@exception_quieter
 	async def get_all(self, skip: int = 0, limit: int = 100,
-	                  search: str = None):
-		queryset = await self.get_queryset()
-		if search:
-			queryset = queryset.filter(or_(self.model.name.icontains(search),
-			                               self.model.description.icontains(search)))
-		return {"count": queryset.count(), "results":queryset.offset(skip).limit(limit).all()}
+	                  search: str = None, after: dict = None,
+	                  include_count: bool = True, count_strategy: CountStrategy = None):
+		async def load():
+			queryset = await self.get_queryset()
+			rank = None
+			if search:
+				queryset, rank = self.search(queryset, search)
+			results, cursor = await self.page(queryset, skip=skip, limit=limit, after=after, rank=rank)
+			count = await self.total(queryset, include_count=include_count, count_strategy=count_strategy)
+			return {"count": count, "results": [self.values(brand) for brand in results], "next_cursor": cursor}
+
+		key = ("get_all", skip, limit, search, repr(after), include_count, count_strategy)
+		return await self.cached(key, load)
 
 	@exception_quieter
 	async def delete(self, id: int, **kwargs):
@@ -31,31 +39,34 @@ class BrandRepository(BaseRepository):
 		if force is False:
 			products = await ProductRepository(db=self.db, user=self.user) \
 				.get_queryset(brand_id=id)
-			if products.count() > 0:
+			if await self.count(products) > 0:
 				raise ValidationError("This brand still has products in it and therefore cannot be deleted")
 		return await super(BrandRepository, self).delete(id)
 
 	@exception_quieter
 	async def create(self, item: BaseModel, **kwargs):
 		# check if db has a branch with that name
-		query = self.db.query(self.model).filter(self.model.name == str(item.name).title())
-		exists = query.count() > 0
+		exists = len(await self.ids_named(str(item.name).title())) > 0
 		if exists:
 			raise ValidationError(detail="A branch with this name already exists")
-		return await super(BrandRepository, self).create(item)
+		return await self.unique(super(BrandRepository, self).create(item),
+		                         detail="A branch with this name already exists")
 
 	@exception_quieter
 	async def update(self, id: int, new_data: BaseModel):
-		query = self.db.query(self.model).filter(self.model.id == id)
-		db_item = query.first()
+		db_item = await self.get(id)
 		if not db_item:
 			raise NotFoundError(detail="Branch was not found")
-		exists = self.db.query(self.model).filter(self.model.id != id, self.model.name == new_data.name).count() > 0
+		exists = any(other != id for other in await self.ids_named(new_data.name))
 		if exists:
 			raise ValidationError(detail="A branch with this name already exists")
 		await pre_save.send(db_item)
-		query.update(new_data.model_dump(), synchronize_session=False)
-		self.db.commit()
-		self.db.refresh(db_item)
+
+		async def save():
+			await self.db.execute(update(self.model).filter(self.model.id == id).values(**new_data.model_dump()))
+			await self.commit()
+
+		await self.unique(save(), detail="A branch with this name already exists")
+		await self.db.refresh(db_item)
 		await post_save.send(db_item, created=False)
-		return query.first()
\ No newline at end of file
+		return db_item
\ No newline at end of file
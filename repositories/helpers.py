@@ -1,90 +1,298 @@
-from typing import List, Optional
+import hashlib
+import re
+from collections import Counter
+from typing import Awaitable, Callable, List, Optional
 
-from fastapi import Query
+from fastapi import Query, Request, Response, HTTPException
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
+from sqlalchemy import select, update, delete, func, tuple_, text, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
+import models
 import schemas.users
-from helpers.exceptions import NotFoundError
-from helpers.response import exception_quieter, SuccessResponse
-from signals import post_save, pre_save, pre_delete
+import settings
+from helpers.cache import TTLCache
+from helpers.exceptions import NotFoundError, ValidationError
+from helpers.response import exception_quieter, SuccessResponse, next_cursor, CountStrategy, etag_matches
+from services.outbox import outbox_relay
+from signals import post_save, pre_save, pre_delete, post_bulk_save, pre_bulk_delete, signal_tasks
+from versions import TableVersions
+
+# keyed by (table, count query, params), cleared for a table whenever a repository commits to it
+count_cache = TTLCache(maxsize=settings.COUNT_CACHE_SIZE, ttl=settings.COUNT_CACHE_TTL)
+# reads of repositories with cache_reads set, keyed by (table, ...) and cleared the same way
+reference_cache = TTLCache(maxsize=settings.REFERENCE_CACHE_SIZE, ttl=settings.REFERENCE_CACHE_TTL)
+# sqlstate of unique_violation
+UNIQUE_VIOLATION = "23505"
+# commits per table, a read that raced a commit is not cached
+generations = Counter()
+
+
+def forget(table: str):
+	"""drops this worker's cached reads of a table"""
+	generations[table] += 1
+	count_cache.invalidate(lambda key: key[0] == table)
+	reference_cache.invalidate(lambda key: key[0] == table)
+
+
+# versions of the catalog tables, a write notified by another worker drops the cached reads too
+table_versions = TableVersions(on_change=forget)
 
 
 class BaseRepository:
 	model = None
-	db = None
+	# sort order of list endpoints, the last field must be unique so cursors are stable
+	ordering: tuple = ("id",)
+	db: AsyncSession = None
 	user:Optional[schemas.users.UserBase] = None
+	# small, rarely written tables keep their reads in this worker's reference_cache
+	cache_reads: bool = False
+	# tables whose writes change this repository's responses, their versions make up the etag
+	versioned: tuple = ()
+	# creates and updates are announced to other services as "<table>.created" and "<table>.updated"
+	outbox_events: bool = False
+	recorded_events: bool = False
 
 	def __init__(self, db, user=None):
 		self.db = db
 		self.user = user
 
 	async def get(self, id: int, exists=False):
-		query = self.db.query(self.model).filter(self.model.id == id)
+		query = select(self.model).filter(self.model.id == id)
 		if exists:
-			return query.count() > 0
-		return query.first()
+			return await self.count(query) > 0
+		return (await self.db.execute(query)).scalars().first()
 
 	async def get_all(self, skip: int = 0, limit: int = 100, **queries):
 		queryset = await self.get_queryset(**queries)
-		return queryset.offset(skip).limit(limit).all()
+		return await self.all(queryset.offset(skip).limit(limit))
+
+	async def cached(self, key: tuple, load: Callable[[], Awaitable]):
+		"""load() memoized under (table, *key) when the repository caches its reads"""
+		if not self.cache_reads:
+			return await load()
+		table = self.model.__tablename__
+		value = reference_cache.get((table, *key), TTLCache.missing)
+		if value is TTLCache.missing:
+			generation = generations[table]
+			value = await load()
+			if generations[table] == generation:
+				reference_cache.set((table, *key), value)
+		return value
+
+	@staticmethod
+	def values(item) -> dict:
+		"""loaded column values of an instance, which unlike the instance can outlive its session"""
+		state = inspect(item)
+		return {attr.key: state.dict[attr.key] for attr in state.mapper.column_attrs if attr.key in state.dict}
+
+	async def ids_named(self, name: str) -> List[int]:
+		# decides writes, so it is never answered from a cache another worker's write has not reached
+		query = select(self.model.id).filter(self.model.name == name)
+		return await self.all(query)
+
+	async def unique(self, write: Awaitable, detail: str):
+		"""
+		awaits a write, a concurrent writer that got the same unique value in first makes it a
+		ValidationError instead of a 500
+		"""
+		try:
+			return await write
+		except IntegrityError as e:
+			if getattr(e.orig, "sqlstate", None) != UNIQUE_VIOLATION:
+				raise
+			await self.db.rollback()
+			raise ValidationError(detail=detail)
 
 	async def get_queryset(self, queryset=None, **queries):
-		if not queryset:
-			queryset = self.db.query(self.model)
+		if queryset is None:
+			queryset = select(self.model)
 		if queries:
 			queryset = queryset.filter_by(**queries)
 		return queryset
 
+	def cursor_values(self, after: dict, fields: tuple = None) -> list:
+		fields = fields or self.ordering
+		if any(field not in after for field in fields):
+			raise ValidationError(detail="Invalid cursor")
+		return [after[field] for field in fields]
+
+	def paginate(self, queryset, skip: int = 0, limit: int = 100, after: dict = None,
+	             ordering: dict = None, descending: bool = False):
+		"""
+		orders the queryset by `ordering` (cursor field -> column, defaults to self.ordering) and
+		slices it either by offset (page mode) or by keyset when an `after` cursor is given,
+		in which case skip is ignored
+		"""
+		ordering = ordering or {field: getattr(self.model, field) for field in self.ordering}
+		columns = list(ordering.values())
+		queryset = queryset.order_by(*[column.desc() if descending else column for column in columns])
+		if after:
+			values = tuple_(*self.cursor_values(after, tuple(ordering)))
+			keyset = tuple_(*columns) < values if descending else tuple_(*columns) > values
+			return queryset.filter(keyset).limit(limit)
+		return queryset.offset(skip).limit(limit)
+
+	def next_cursor(self, results: list, limit: int):
+		return next_cursor(results, limit, self.ordering)
+
+	def search(self, queryset, search: str):
+		"""
+		full text filter on the model's search_vector, every word matches as a prefix.
+		returns the queryset with a `rank` column added and that column, or (queryset, None)
+		when there is nothing to search for
+		"""
+		tsquery = prefix_tsquery(search)
+		if not tsquery:
+			return queryset, None
+		tsquery = func.to_tsquery(settings.SEARCH_CONFIG, tsquery)
+		rank = func.ts_rank(self.model.search_vector, tsquery).label("rank")
+		return queryset.filter(self.model.search_vector.op("@@")(tsquery)).add_columns(rank), rank
+
+	async def page(self, queryset, skip: int = 0, limit: int = 100, after: dict = None, rank=None):
+		"""
+		one page of results and the cursor of the next one. search results (rank given) are
+		sorted by relevance, everything else by self.ordering
+		"""
+		if rank is None:
+			results = await self.all(self.paginate(queryset, skip=skip, limit=limit, after=after))
+			return results, self.next_cursor(results, limit)
+		ordering = {"rank": rank, "id": self.model.id}
+		queryset = self.paginate(queryset, skip=skip, limit=limit, after=after, ordering=ordering, descending=True)
+		rows = (await self.db.execute(queryset)).all()
+		cursor = next_cursor([{"rank": row.rank, "id": row[0].id} for row in rows], limit, tuple(ordering))
+		return [row[0] for row in rows], cursor
+
+	async def count(self, queryset) -> int:
+		querystring = select(func.count()).select_from(queryset.order_by(None).subquery())
+		return (await self.db.execute(querystring)).scalar_one()
+
+	async def total(self, queryset, params: dict = None, include_count: bool = True,
+	                count_strategy: CountStrategy = None) -> Optional[int]:
+		"""
+		total for a list endpoint. queryset is either a select() or a raw "select * from ..."
+		querystring with its params. returns None when the client opted out of counting
+		"""
+		if not include_count:
+			return None
+		count_strategy = count_strategy or CountStrategy(settings.DEFAULT_COUNT_STRATEGY)
+		if isinstance(queryset, str):
+			filtered = bool(params)
+			querystring = text(queryset.replace("select *", "select count(*)", 1))
+			signature = params or {}
+		else:
+			filtered = queryset.whereclause is not None
+			querystring = select(func.count()).select_from(queryset.order_by(None).subquery())
+			signature = querystring.compile().params
+		if count_strategy == CountStrategy.estimated and not filtered:
+			estimate = await self.estimated_count()
+			if estimate > 0:
+				return estimate
+		if count_strategy != CountStrategy.cached:
+			return (await self.db.execute(querystring, params)).scalar_one()
+		key = (self.model.__tablename__, str(querystring), repr(sorted(signature.items())))
+		count = count_cache.get(key)
+		if count is None:
+			count = (await self.db.execute(querystring, params)).scalar_one()
+			count_cache.set(key, count)
+		return count
+
+	async def estimated_count(self) -> int:
+		querystring = text("select reltuples::bigint from pg_class where oid = cast(:table as regclass) ;")
+		estimate = (await self.db.execute(querystring, {"table": self.model.__tablename__})).scalar()
+		return estimate or 0
+
+	def record_event(self, event: str, data: dict):
+		"""adds an event to the outbox, it is published once the current transaction commits"""
+		self.db.add(models.OutboxEvent(event=event, payload=jsonable_encoder(data)))
+		self.recorded_events = True
+
+	async def commit(self):
+		await self.db.commit()
+		# the notification of this commit arrives a moment later, until then the table has no etag
+		table_versions.touch(self.model.__tablename__)
+		# receivers deferred by signals sent in the transaction run now
+		await signal_tasks.release(self.db)
+		if self.recorded_events:
+			self.recorded_events = False
+			outbox_relay.wake()
+
+	async def all(self, queryset) -> list:
+		return list((await self.db.execute(queryset)).scalars().all())
+
 	async def create(self, item: BaseModel, **kwargs):
 		db_item = self.model(**item.model_dump())
 		await pre_save.send(db_item)
 		self.db.add(db_item)
-		self.db.commit()
-		self.db.refresh(db_item)
+		if self.outbox_events:
+			await self.db.flush()
+			data = self.values(db_item)
+			data.pop("search_vector", None)
+			self.record_event(f"{self.model.__tablename__}.created", data)
+		await self.commit()
+		await self.db.refresh(db_item)
 		await post_save.send(db_item, created=True)
 		return db_item
 
 	async def create_all(self, data_list: List[BaseModel]):
 		instances = [self.model(**data.dict()) for data in data_list]
-		self.db.bulk_save_objects(instances)
-		self.db.commit()
+		self.db.add_all(instances)
+		await self.commit()
 		return instances
 
 	async def update_all(self, ids: List[int], new_data: BaseModel):
-		query = self.db.query(self.model).filter(self.model.id.in_(ids))
-		query.update(new_data.dict(), synchronize_session=False)
-		self.db.commit()
-		return query.all()
+		await self.db.execute(update(self.model).filter(self.model.id.in_(ids)).values(**new_data.dict()))
+		await self.commit()
+		return await self.all(select(self.model).filter(self.model.id.in_(ids)))
 
 	@exception_quieter
 	async def update(self, id: int, new_data: BaseModel):
-		query = self.db.query(self.model).filter(self.model.id == id)
-		db_item = query.first()
+		db_item = await self.get(id)
 		if not db_item:
 			raise NotFoundError()
 		await pre_save.send(db_item)
-		query.update(new_data.model_dump(), synchronize_session=False)
-		self.db.commit()
-		self.db.refresh(db_item)
+		await self.db.execute(update(self.model).filter(self.model.id == id).values(**new_data.model_dump()))
+		if self.outbox_events:
+			self.record_event(f"{self.model.__tablename__}.updated", {"id": id, **new_data.model_dump()})
+		await self.commit()
+		await self.db.refresh(db_item)
 		await post_save.send(db_item, created=False)
-		return query.first()
+		return db_item
 
 	@exception_quieter
 	async def delete(self, id: int, **kwargs):
-		query = self.db.query(self.model).filter(self.model.id == id)
-		db_item = query.first()
+		db_item = await self.get(id)
 		if not db_item:
 			raise NotFoundError()
 		await pre_delete.send(sender=db_item)
-		query.delete(synchronize_session=False)
-		self.db.commit()
+		await self.db.execute(delete(self.model).filter(self.model.id == id))
+		await self.commit()
 		return SuccessResponse(status=204)
 
 	async def delete_all(self, ids: List[int]):
-		query = self.db.query(self.model).filter(self.model.id.in_(ids))
-		deleted_rows = query.delete(synchronize_session=False)
-		self.db.commit()
-		return deleted_rows
+		result = await self.db.execute(delete(self.model).filter(self.model.id.in_(ids)))
+		await self.commit()
+		return result.rowcount
+
+	@classmethod
+	async def etag(cls, request: Request, response: Response) -> Optional[str]:
+		"""
+		conditional GET dependency. answers 304 before the endpoint runs when If-None-Match
+		holds the current etag, which only changes with the url or the versioned tables.
+		while their versions are unknown the response goes without one
+		"""
+		versions = table_versions.get(cls.versioned)
+		if versions is None:
+			return None
+		signature = (request.url.path, sorted(request.query_params.multi_items()), sorted(versions.items()))
+		etag = f'"{hashlib.sha1(repr(signature).encode()).hexdigest()}"'
+		headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+		if etag_matches(request.headers.get("if-none-match"), etag):
+			raise HTTPException(status_code=304, headers=headers)
+		response.headers.update(headers)
+		return etag
 
 	@staticmethod
 	def delete_parameters(force: bool = Query(default=False,
@@ -92,15 +300,8 @@ class BaseRepository:
 		return {"force": force}
 
 
-
-
-
-
-
-
-
-
-
-
-
-
+def prefix_tsquery(search: str) -> str:
+	# "coca col" -> "coca:* & col:*", anything but word characters is dropped. words shorter than
+	# SEARCH_MIN_PREFIX match whole words only, a one letter prefix matches most of the catalog
+	return " & ".join(f"{word}:*" if len(word) >= settings.SEARCH_MIN_PREFIX else word
+	                  for word in re.findall(r"\w+", search.lower()))
@@ -1,7 +1,5 @@
 from datetime import datetime
 
-from sqlalchemy import or_
-
 import models
 from helpers.exceptions import ValidationError
 from .helpers import *
@@ -9,6 +7,9 @@ from .products import ProductRepository
 
 
 class InventoryRepository(BaseRepository):
+	cache_reads = True
+	versioned = ("inventories",)
+
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.model = models.Inventory
@@ -16,11 +17,11 @@ class InventoryRepository(BaseRepository):
 	@exception_quieter
 	async def create(self, item: BaseModel, **kwargs):
 		# check if db has an inventory with that name
-		query = self.db.query(self.model).filter(self.model.name == str(item.name).title())
-		exists = query.count() > 0
+		exists = len(await self.ids_named(str(item.name).title())) > 0
 		if exists:
 			raise ValidationError(detail="An inventory with this name already exists")
-		return await super(InventoryRepository, self).create(item)
+		return await self.unique(super(InventoryRepository, self).create(item),
+		                         detail="An inventory with this name already exists")
 
 	@staticmethod
 	def query_parameters(location: str = Query(default=None, title="location", description="filter by location"),
@@ -33,46 +34,57 @@ class InventoryRepository(BaseRepository):
 		return {"location": location, "search": search, "start_date": start_date,
 		        "end_date": end_date}
 
+	@exception_quieter
 	async def get_all(self, skip: int = 0, limit: int = 100,
 	                  location: str = None, search: str = None,
 	                  start_date: datetime = None,
-	                  end_date: datetime = None):
-		queryset = await self.get_queryset()
-		if location:
-			queryset = await self.get_queryset(queryset=queryset, location=location)
-		if search:
-			queryset = queryset.filter(or_(self.model.name.icontains(search),
-			                               self.model.location.icontains(search),
-			                               self.model.description.icontains(search)))
-		if start_date and not end_date:
-			queryset = queryset.filter(self.model.date_of_acquisition.__ge__(start_date))
-		elif not start_date and end_date:
-			queryset = queryset.filter(self.model.date_of_acquisition.__le__(end_date))
-		elif start_date and end_date:
-			queryset = queryset.filter(self.model.date_of_acquisition.between(start_date, end_date))
-		return {"result": queryset.offset(skip).limit(limit).all(), "count": queryset.count()}
+	                  end_date: datetime = None, after: dict = None,
+	                  include_count: bool = True, count_strategy: CountStrategy = None):
+		async def load():
+			queryset = await self.get_queryset()
+			if location:
+				queryset = await self.get_queryset(queryset=queryset, location=location)
+			rank = None
+			if search:
+				queryset, rank = self.search(queryset, search)
+			if start_date and not end_date:
+				queryset = queryset.filter(self.model.date_of_acquisition.__ge__(start_date))
+			elif not start_date and end_date:
+				queryset = queryset.filter(self.model.date_of_acquisition.__le__(end_date))
+			elif start_date and end_date:
+				queryset = queryset.filter(self.model.date_of_acquisition.between(start_date, end_date))
+			result, cursor = await self.page(queryset, skip=skip, limit=limit, after=after, rank=rank)
+			count = await self.total(queryset, include_count=include_count, count_strategy=count_strategy)
+			return {"result": [self.values(inventory) for inventory in result], "count": count, "next_cursor": cursor}
+
+		key = ("get_all", skip, limit, location, search, start_date, end_date, repr(after), include_count,
+		       count_strategy)
+		return await self.cached(key, load)
 
 	@exception_quieter
 	async def delete(self, id: int, **kwargs):
 		force: bool = kwargs.pop("force", False)
 		if force is False :
 			products = await ProductRepository(db=self.db, user=self.user).get_queryset(inventory_id=id)
-			if products.count() > 0:
+			if await self.count(products) > 0:
 				raise ValidationError(detail="This inventory still has products in it and therefore cannot be deleted")
 		return await super(InventoryRepository, self).delete(id)
 
 	@exception_quieter
 	async def update(self, id: int, new_data: BaseModel):
-		query = self.db.query(self.model).filter(self.model.id == id)
-		db_item = query.first()
+		db_item = await self.get(id)
 		if not db_item:
 			raise NotFoundError(detail="Inventory was not found")
-		exists = self.db.query(self.model).filter(self.model.id != id, self.model.name == new_data.name).count() > 0
+		exists = any(other != id for other in await self.ids_named(new_data.name))
 		if exists:
 			raise ValidationError(detail="An inventory with this name already exists")
 		await pre_save.send(db_item)
-		query.update(new_data.model_dump(), synchronize_session=False)
-		self.db.commit()
-		self.db.refresh(db_item)
+
+		async def save():
+			await self.db.execute(update(self.model).filter(self.model.id == id).values(**new_data.model_dump()))
+			await self.commit()
+
+		await self.unique(save(), detail="An inventory with this name already exists")
+		await self.db.refresh(db_item)
 		await post_save.send(db_item, created=False)
-		return query.first()
+		return db_item
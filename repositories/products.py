@@ -1,18 +1,33 @@
 from fastapi import UploadFile
 from sqlalchemy import text
+from sqlalchemy.orm import selectinload
 
 import models
+import settings
 from helpers.exceptions import ValidationError
 from .helpers import *
 from schemas import products as schemas
+from services import blobs
 
 
 class ProductRepository(BaseRepository):
+	ordering = ("name", "id")
+	# products_view columns sent to clients, search_vector stays in the database
+	columns = "id, name, description, brand_id, inventory_id, price, quantity, brand, inventory, images, thumbnails"
+	rank = "ts_rank(search_vector, to_tsquery(:config, :search))"
+	# products_view joins brands, inventories and product_files
+	versioned = ("products", "product_files", "brands", "inventories")
+	outbox_events = True
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.model = models.Product
 
+	async def commit(self):
+		await super().commit()
+		# images new to storage go up once the rows referencing them committed
+		await blobs.store_uploads(self.db)
+
 	@staticmethod
 	def query_parameters(brands: list[int] = Query(default=None, title="brands", description="filter by brands"),
 	                     inventories: list[int] = Query(default=None, title="inventory",
@@ -27,24 +42,30 @@ class ProductRepository(BaseRepository):
 		        "search": search, "start_price": start_price,
 		        "end_price": end_price}
 
+	@exception_quieter
 	async def get_all(self, skip: int = 0, limit: int = 100,
 	                  brands: List[int] = None,
 	                  inventories: List[int] = None,
 	                  search: str = None,
 	                  start_price: float = None,
-	                  end_price: float = None):
+	                  end_price: float = None,
+	                  after: dict = None,
+	                  include_count: bool = True,
+	                  count_strategy: CountStrategy = None):
 		querystring = "select * from products_view"
 		params = dict()
 
 		if brands:
-			querystring = f"{querystring} where brand_id in :brand_ids"
-			params["brand_ids"] = tuple(brands)
+			querystring = f"{querystring} where brand_id = any(:brand_ids)"
+			params["brand_ids"] = list(brands)
 		if inventories:
-			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} inventory_id in :inventory_ids"
-			params["inventory_ids"] = tuple(inventories)
-		if search:
-			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} description ilike :search or name ilike :search"
-			params["search"] = f"%{search}%"
+			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} inventory_id = any(:inventory_ids)"
+			params["inventory_ids"] = list(inventories)
+		tsquery = prefix_tsquery(search) if search else None
+		if tsquery:
+			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} search_vector @@ to_tsquery(:config, :search)"
+			params["config"] = settings.SEARCH_CONFIG
+			params["search"] = tsquery
 		if start_price and not end_price:
 			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} price >= :start_price"
 			params["start_price"] = start_price
@@ -55,17 +76,41 @@ class ProductRepository(BaseRepository):
 			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} price >= :start_price and price <= :end_price"
 			params["start_price"] = start_price
 			params["end_price"] = end_price
-		count = self.db.execute(text(querystring.replace("select *", "select count(*)", 1)),
-		                        params).mappings().first()["count"]
-		querystring = f"{querystring} order by name limit :limit offset :offset;"
+		count = await self.total(querystring, dict(params), include_count=include_count,
+		                         count_strategy=count_strategy)
+		ordering, keyset, order_by = self.ordering, "(name, id) >", "name, id"
+		if tsquery:
+			# search results are sorted by relevance. the matches come from the search_vector index and
+			# only the SEARCH_CANDIDATES most relevant of them are paged, so a page ranks them once and
+			# sorts no more than the candidates. count is that of every match
+			querystring = querystring.replace("select *", f"select *, {self.rank} as rank", 1)
+			if settings.SEARCH_CANDIDATES:
+				querystring = f"{querystring} order by rank desc, id desc limit :candidates"
+				params["candidates"] = settings.SEARCH_CANDIDATES
+			querystring = f"select *, rank from ({querystring}) as matches"
+			ordering, keyset, order_by = ("rank", "id"), "(rank, id) <", "rank desc, id desc"
+		if after:
+			querystring = f"{querystring} {'where' if tsquery or 'where' not in querystring else 'and'} {keyset} (:after_0, :after_1)"
+			params["after_0"], params["after_1"] = self.cursor_values(after, ordering)
+			skip = 0
+		querystring = querystring.replace("select *", f"select {self.columns}", 1)
+		querystring = f"{querystring} order by {order_by} limit :limit offset :offset;"
 		params["limit"] = limit
 		params["offset"] = skip
 		querystring = text(querystring)
-		return dict(results=self.db.execute(querystring, params).mappings().all(), count=count)
+		results = (await self.db.execute(querystring, params)).mappings().all()
+		return dict(results=results, count=count, next_cursor=next_cursor(results, limit, ordering))
 
 	@exception_quieter
 	async def get_by_id(self, id: int, exists=False):
-		product = await self.get(id=id, exists=exists)
+		if exists:
+			product = await self.get(id=id, exists=exists)
+		else:
+			querystring = select(self.model).filter(self.model.id == id) \
+				.options(selectinload(self.model.brand), selectinload(self.model.inventory),
+				         selectinload(self.model.images)) \
+				.execution_options(populate_existing=True)
+			product = (await self.db.execute(querystring)).scalars().first()
 		if not product:
 			raise NotFoundError("This product does not exist")
 		return product
@@ -86,7 +131,7 @@ class ProductRepository(BaseRepository):
 			querystring = f"{querystring} and id != :exclude_id"
 			params["exclude_id"] = exclude_id
 		querystring = text(f"{querystring};")
-		result = self.db.execute(querystring, params).mappings().all()
+		result = (await self.db.execute(querystring, params)).mappings().all()
 		if exists:
 			return len(result) > 0
 		return result[0] if result else None
@@ -103,10 +148,11 @@ class ProductRepository(BaseRepository):
 
 		images: List[UploadFile] = kwargs.pop("images", list())
 		product: models.Product = await super(ProductRepository, self).create(item, **kwargs)
-		for image in images:
-			models.ProductFile.save(name=image.file.name,
-			                        content=image.file.read(),
-			                        product_id=product.id)
+		if images:
+			product_files = await self.save_images(product.id, images)
+			self.db.add_all(product_files)
+			await self.commit()
+			await post_bulk_save.send(models.ProductFile, instances=product_files, created=True)
 
 		return product
 
@@ -117,27 +163,31 @@ class ProductRepository(BaseRepository):
 		if not product_exist:
 			raise NotFoundError(detail="This product does not exist")
 
-		product_files = [models.ProductFile.save(name=image.filename,
-			                                       content=await image.read(),
-			                                       product_id=id)
-		for image in images]
-		self.db.bulk_save_objects(product_files)
-		self.db.commit()
+		product_files = await self.save_images(id, images)
+		self.db.add_all(product_files)
+		await self.commit()
+		await post_bulk_save.send(models.ProductFile, instances=product_files, created=True)
 		return await self.get_by_id(id=id)
 
 
+	async def save_images(self, product_id: int, images: List[UploadFile]) -> List[models.ProductFile]:
+		"""streams the images to storage concurrently on commit, images stored already are only referenced"""
+		return await blobs.save_uploads(self.db, images, product_id=product_id)
+
 	@exception_quieter
 	async def delete_images(self, id, image_ids: List[int]):
 		product_exist = await self.get_by_id(id=id, exists=True)
 		if not product_exist:
 			raise ValidationError(detail="This product does not exist")
 
-		query = self.db.query(models.ProductFile).filter(models.ProductFile.id.in_(image_ids),
-                        models.ProductFile.product_id.in_([id]))
-		for img in query:
-			await pre_delete.send(img)
-		query.delete(synchronize_session=False)
-		self.db.commit()
+		query = select(models.ProductFile).filter(models.ProductFile.id.in_(image_ids),
+		                                          models.ProductFile.product_id.in_([id]))
+		images = list((await self.db.execute(query)).scalars())
+		if images:
+			await pre_bulk_delete.send(models.ProductFile, instances=images)
+		await self.db.execute(delete(models.ProductFile).filter(models.ProductFile.id.in_(image_ids),
+		                                                        models.ProductFile.product_id.in_([id])))
+		await self.commit()
 		return await self.get_by_id(id=id)
 
 	@exception_quieter
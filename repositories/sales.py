@@ -4,18 +4,19 @@ from typing import List
 
 from fastapi import Query
 from pydantic import BaseModel
-from sqlalchemy import text
+from sqlalchemy import text, select
 
 import models
 from helpers.exceptions import ValidationError, NotFoundError, AuthorizationError
 from helpers.permissions import permission_access
-from helpers.response import FailureResponse, exception_quieter, SuccessResponse
+from helpers.response import FailureResponse, exception_quieter, SuccessResponse, CountStrategy
 from repositories.helpers import BaseRepository
 from schemas import sales as schemas
 from signals import pre_save, post_save, pre_delete
 
 
 class SaleRepository(BaseRepository):
+	outbox_events = True
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
@@ -53,19 +54,19 @@ class SaleRepository(BaseRepository):
 		data = item.model_dump()
 		orders = data.pop("orders")
 		product_ids = [order['product_id'] for order in orders]
-		product_count = self.db.query(models.Product).filter(models.Product.id.in_(product_ids)).count()
+		product_count = await self.count(select(models.Product).filter(models.Product.id.in_(product_ids)))
 		if len(product_ids) != product_count:
 			raise ValidationError(detail="You have non existent products in this orders")
 		data["date_ordered"] = datetime.now()
 		sale = self.model(**data)
 		await pre_save.send(sale)
 		self.db.add(sale)
-		self.db.commit()
-		self.db.refresh(sale)
-		orders = [models.Order(**order, sale_id=sale.id) for order in orders]
-		self.db.bulk_save_objects(orders)
-		self.db.commit()
-		self.db.refresh(sale)
+		# the sale, its orders and the event commit together
+		await self.db.flush()
+		self.db.add_all([models.Order(**order, sale_id=sale.id) for order in orders])
+		self.record_event("sales.created", {**self.values(sale), "orders": orders})
+		await self.commit()
+		await self.db.refresh(sale)
 		await post_save.send(sale, created=True)
 		return SuccessResponse(message="Sale created successfully")
 
@@ -82,12 +83,12 @@ class SaleRepository(BaseRepository):
 			raise ValidationError(detail="This sale is already paid for. Please create another sale.")
 		orders = [models.Order(**order.model_dump(), sale_id=id) for order in orders]
 		product_ids = [order.product_id for order in orders]
-		product_count = self.db.query(models.Product).filter(models.Product.id.in_(product_ids)).count()
+		product_count = await self.count(select(models.Product).filter(models.Product.id.in_(product_ids)))
 		if len(product_ids) != product_count:
 			raise ValidationError(detail="You have non existent products in this orders")
-		self.db.bulk_save_objects(orders)
-		self.db.commit()
-		self.db.refresh(sale)
+		self.db.add_all(orders)
+		await self.commit()
+		await self.db.refresh(sale)
 		return SuccessResponse(message="Orders added successfully")
 
 
@@ -98,10 +99,10 @@ class SaleRepository(BaseRepository):
 			raise NotFoundError(detail="This Sale does not exist")
 		if sale.paid:
 			raise ValidationError(detail="This sale is already paid for and cannot be edited")
-		querystring = text("delete from orders where sale_id = :id and id in :order_ids")
-		self.db.execute(querystring, {"id": id, "order_ids": order_ids})
-		self.db.commit()
-		self.db.refresh(sale)
+		querystring = text("delete from orders where sale_id = :id and id = any(:order_ids)")
+		await self.db.execute(querystring, {"id": id, "order_ids": order_ids})
+		await self.commit()
+		await self.db.refresh(sale)
 		return SuccessResponse(message="Selected Orders have been removed successfully")
 
 	@exception_quieter
@@ -113,9 +114,11 @@ class SaleRepository(BaseRepository):
 			return sale
 		await pre_save.send(sale)
 		querystring = text("update sales set paid = true, date_paid = :now where id = :id")
-		self.db.execute(querystring, {"id": id, "now": datetime.now()})
-		self.db.commit()
-		self.db.refresh(sale)
+		now = datetime.now()
+		await self.db.execute(querystring, {"id": id, "now": now})
+		self.record_event("sales.paid", {"id": id, "customer_id": sale.customer_id, "date_paid": now})
+		await self.commit()
+		await self.db.refresh(sale)
 		await post_save.send(sale, created=False)
 		return SuccessResponse(message="Sale has been successfully marked as paid")
 
@@ -131,27 +134,29 @@ class SaleRepository(BaseRepository):
 			raise AuthorizationError(detail="You are not the owner of this sale")
 		await pre_delete.send(sale)
 		querystring = text("delete from sales where id = :id")
-		self.db.execute(querystring, {"id": id})
-		self.db.commit()
+		await self.db.execute(querystring, {"id": id})
+		await self.commit()
 		return SuccessResponse(status=204)
 
 
 	async def get_by_id(self, id: int):
 		querystring = text("select * from sales_view where id = :id ;")
-		sale_detail = dict(self.db.execute(querystring, {"id": id}).mappings().first())
-		querystring = text("select * from orders_view where sale_id = :id ;")
-		orders = self.db.execute(querystring, {"id": id}).mappings().all()
+		sale_detail = dict((await self.db.execute(querystring, {"id": id})).mappings().first())
+		querystring = text("select * from orders_view where sale_id = :id order by id ;")
+		orders = (await self.db.execute(querystring, {"id": id})).mappings().all()
 		sale_detail["orders"] = orders
 		return sale_detail
 
 
+	@exception_quieter
 	async def get_all(self, skip: int = 0, limit: int = 100, search:str=None, paid:bool=None,
 	                  date_ordered_start:datetime=None, date_ordered_stop:datetime=None,
-	                  date_paid_start:datetime=None, date_paid_stop:datetime=None):
+	                  date_paid_start:datetime=None, date_paid_stop:datetime=None, after: dict = None,
+	                  include_count: bool = True, count_strategy: CountStrategy = None):
 		querystring = "select * from sales_view"
 		params = dict()
 		if search:
-			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} location ilike :search or customer ilike :search"
+			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} (location ilike :search or customer ilike :search)"
 			params["search"] = f"%{search}%"
 		if paid is not None:
 			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} paid = :paid"
@@ -165,17 +170,23 @@ class SaleRepository(BaseRepository):
 			params["date_paid_start"] = date_paid_start
 			params["date_paid_end"] = date_paid_stop
 
-		count = self.db.execute(text(f"{querystring.replace('select *', 'select count(*)', 1)};"), params).mappings().first()["count"]
-		querystring = f"{querystring} offset :skip limit :limit ;"
+		count = await self.total(querystring, dict(params), include_count=include_count,
+		                         count_strategy=count_strategy)
+		if after:
+			querystring = f"{querystring} {'where' if 'where' not in querystring else 'and'} id > :after_id"
+			params["after_id"], = self.cursor_values(after)
+			skip = 0
+		querystring = f"{querystring} order by id offset :skip limit :limit ;"
 		params["skip"] = skip
 		params["limit"] = limit
-		return {"count": count, "results": self.db.execute(text(querystring), params).mappings().all()}
+		results = (await self.db.execute(text(querystring), params)).mappings().all()
+		return {"count": count, "results": results, "next_cursor": self.next_cursor(results, limit)}
 
 
 	@exception_quieter
 	@permission_access(customer=False, admin=False)
 	async def mark_order_as_delivered(self, order_id:int):
-		order = self.db.query(models.Order).filter(models.Order.id == order_id).first()
+		order = (await self.db.execute(select(models.Order).filter(models.Order.id == order_id))).scalars().first()
 		if not order:
 			raise NotFoundError(detail="This order does not exist")
 		if order.staff_id is None:
@@ -183,37 +194,39 @@ class SaleRepository(BaseRepository):
 		if order.staff_id  != self.user.staff_id:
 			raise AuthorizationError(detail="You are not assigned to this order")
 		querystring = "update orders set delivered = true, date_delivered = :now where id = :order_id ;"
-		self.db.execute(text(querystring), {"order_id": order_id, "now": datetime.now()})
-		self.db.commit()
+		await self.db.execute(text(querystring), {"order_id": order_id, "now": datetime.now()})
+		await self.commit()
 		return SuccessResponse(message="This order has been successfully marked as delivered")
 
 	@exception_quieter
 	@permission_access(customer=False, staff=False)
 	async def assign_staff_to_orders(self, staff_id:int, order_ids:List[int]):
-		orders_with_staffs = self.db.query(models.Order).filter(models.Order.id.in_(order_ids), models.Order.staff_id != None).count() > 0
+		orders_with_staffs = await self.count(select(models.Order).filter(models.Order.id.in_(order_ids),
+		                                                                  models.Order.staff_id != None)) > 0
 		if orders_with_staffs:
 			raise ValidationError(detail="Some selected orders already have staffs assigned to them")
 
-		delivered_orders = self.db.query(models.Order).filter(models.Order.id.in_(order_ids), models.Order.delivered == True).count() > 0
+		delivered_orders = await self.count(select(models.Order).filter(models.Order.id.in_(order_ids),
+		                                                                models.Order.delivered == True)) > 0
 		if delivered_orders:
 			raise ValidationError(detail="Some selected orders are already delivered and cannot be updated")
 
-		querystring = "update orders set staff_id = :staff_id where id in :ids ;"
-		self.db.execute(text(querystring), {"staff_id": staff_id, "ids": order_ids})
-		self.db.commit()
+		querystring = "update orders set staff_id = :staff_id where id = any(:ids) ;"
+		await self.db.execute(text(querystring), {"staff_id": staff_id, "ids": order_ids})
+		await self.commit()
 		return SuccessResponse(message="Staffs have been successfully assigned to selected orders")
 
 	@exception_quieter
 	@permission_access(customer=False, staff=False)
 	async def remove_staff_from_orders(self, staff_id: int, order_ids: List[int]):
-		delivered_orders = self.db.query(models.Order).filter(models.Order.id.in_(order_ids),
-		                                                      models.Order.delivered == True).count() > 0
+		delivered_orders = await self.count(select(models.Order).filter(models.Order.id.in_(order_ids),
+		                                                                models.Order.delivered == True)) > 0
 		if delivered_orders:
 			raise ValidationError(detail="Some selected orders are already delivered and cannot be updated")
 
-		querystring = "update orders set staff_id = NULL where id in :ids ;"
-		self.db.execute(text(querystring), {"staff_id": staff_id, "ids": order_ids})
-		self.db.commit()
+		querystring = "update orders set staff_id = NULL where id = any(:ids) ;"
+		await self.db.execute(text(querystring), {"staff_id": staff_id, "ids": order_ids})
+		await self.commit()
 		return SuccessResponse(message="Staffs have been successfully removed from the selected orders")
 
 
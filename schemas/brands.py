@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel
 from pydantic.v1 import Field
@@ -22,7 +22,8 @@ class Brand(BrandBase):
 
 
 class BrandListResponse(BaseModel):
-	count: int
+	count: Optional[int]
 	results: List[Brand]
+	next_cursor: Optional[str] = None
 
 
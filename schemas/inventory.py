@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Any, List
+from typing import Any, List, Optional
 
 from pydantic import BaseModel
 
@@ -28,7 +28,8 @@ class Inventory(InventoryBase):
 		orm_mode = True
 
 class InventoryListResponse(BaseModel):
-	count: int
+	count: Optional[int]
 	result: List[Inventory]
+	next_cursor: Optional[str] = None
 
 
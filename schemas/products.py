@@ -1,6 +1,6 @@
-from typing import List
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 
 from schemas.brands import Brand
 from schemas.inventory import Inventory
@@ -13,6 +13,13 @@ class ProductImageBase(BaseModel):
 
 class ProductImage(ProductImageBase):
 	id: int
+	# variant name (thumbnail, medium) -> url of its WebP copy, empty until they are rendered
+	variants: Dict[str, str] = {}
+
+	@field_validator("variants", mode="before")
+	@classmethod
+	def no_variants(cls, value):
+		return value or {}
 
 	class Config:
 		from_attributes = True
@@ -50,9 +57,20 @@ class ProductResponse(ProductBase):
 	brand: str
 	inventory: str
 	images: List[str]
+	# thumbnail of each image, None where it is not rendered yet
+	thumbnails: List[Optional[str]] = []
 
 class ProductListResponse(BaseModel):
-	count: int
+	count: Optional[int]
 	results: List[ProductResponse]
+	next_cursor: Optional[str] = None
+
+
+class Suggestion(BaseModel):
+	id: int
+	name: str
+	type: str  # product | brand
 
 
+class SuggestionResponse(BaseModel):
+	results: List[Suggestion]
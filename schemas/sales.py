@@ -31,8 +31,9 @@ class SaleListItem(BaseModel):
 	total_amount: float
 
 class SaleListResponse(BaseModel):
-	count: int
+	count: Optional[int]
 	results: List[SaleListItem]
+	next_cursor: Optional[str] = None
 
 
 class OrderListItem(OrderItem):
@@ -0,0 +1,131 @@
+"""
+Content addressed storage of product images.
+
+An uploaded image is stored under the sha256 of its content, so the same packshot uploaded for
+many products is stored once and uploaded once. The blobs table counts the product_files rows
+sharing each stored file. The count is raised in the transaction that adds the rows, and the
+file is only uploaded by the transaction whose insert created the blob, once it committed. A
+rolled back transaction uploads nothing. The count is lowered in the transaction that deletes
+rows (pre_delete, see signals.py). After the commit, collect deletes the files and their
+variants that nothing references anymore. collect holds the blob rows locked while it does, so
+an upload of the same content either waits and stores the file again or, having come first,
+keeps it alive.
+A delete spooled while S3 is down leaves its blob rows at a count of 0. An upload of the same
+content raises the count again and stores the file anew. The replay locks the rows again and
+only deletes the files of blobs still at 0, then drops those rows.
+Files saved before addressing by content have no blob and are deleted with their only row.
+"""
+import asyncio
+import hashlib
+import os
+from typing import Callable, List
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.datastructures import UploadFile
+
+import settings
+from models import ProductFile, file_saver
+from services.storage import upload_pool
+from settings.database import AsyncSessionLocal, SessionLocal
+
+# a blob back from a count of 0 may have lost its file to a spooled delete, it is stored again
+ACQUIRE = text("""
+	insert into blobs (url, refcount) values (:url, 1)
+	on conflict (url) do update set refcount = blobs.refcount + 1
+	returning (xmax = 0 or refcount = 1) as created
+""")
+
+RELEASE = text("""
+	update blobs b set refcount = b.refcount - d.released
+	from (select url, count(*) as released from unnest(cast(:urls as text[])) as url group by url) d
+	where b.url = d.url
+""")
+
+LOCK = text("select url, refcount from blobs where url = any(:urls) for update")
+
+DELETE = text("delete from blobs where url = any(:urls)")
+
+UPLOADS = "blob_uploads"
+
+
+def content_name(file, filename: str) -> str:
+	"""<sha256 of the content>.<extension of the upload>"""
+	digest = hashlib.sha256()
+	file.seek(0)
+	while chunk := file.read(settings.UPLOAD_CHUNK_SIZE):
+		digest.update(chunk)
+	extension = os.path.splitext(filename or "")[1].lower() or ".bin"
+	return f"{digest.hexdigest()}{extension}"
+
+
+async def save_uploads(db: AsyncSession, uploads: List[UploadFile], **kwargs) -> List[ProductFile]:
+	"""
+	product_files for the uploads, in the transaction of db. contents that are stored already
+	are not uploaded again, the others are held for store_uploads
+	"""
+	loop = asyncio.get_running_loop()
+	names = await asyncio.gather(*[loop.run_in_executor(upload_pool, content_name, upload.file, upload.filename)
+	                               for upload in uploads])
+	product_files, new = [], dict()
+	for upload, name in zip(uploads, names):
+		url = file_saver.url(ProductFile.upload_to, name)
+		# one statement at a time, the session is not safe for concurrent use
+		if (await db.execute(ACQUIRE, {"url": url})).scalar():
+			new[name] = upload
+		product_files.append(ProductFile.create(name, url, **kwargs))
+	db.info.setdefault(UPLOADS, {}).update(new)
+	return product_files
+
+
+async def store_uploads(db: AsyncSession):
+	"""streams the uploads held for db to storage concurrently, once its transaction committed"""
+	new = db.info.pop(UPLOADS, {})
+	await asyncio.gather(*[file_saver.save_upload(ProductFile.upload_to, name, upload.file)
+	                       for name, upload in new.items()])
+
+
+def drop_uploads(session: Session):
+	session.info.pop(UPLOADS, None)
+
+
+# the blobs of a rolled back transaction were never created, their uploads go with it
+event.listen(Session, "after_rollback", drop_uploads)
+
+
+async def release(db: AsyncSession, product_files: List[ProductFile]):
+	"""drops the references of rows deleted in the transaction of db"""
+	await db.execute(RELEASE, {"urls": [product_file.url for product_file in product_files]})
+
+
+async def collect(product_files: List[ProductFile]):
+	"""deletes the files of deleted rows that no other row references, after their commit"""
+	urls = list({product_file.url for product_file in product_files})
+	async with AsyncSessionLocal() as db:
+		references = dict((await db.execute(LOCK, {"urls": urls})).all())
+		unreferenced = {url for url in urls if references.get(url, 0) <= 0}
+		# file url -> the url of its blob
+		files = {url: product_file.url for product_file in product_files if product_file.url in unreferenced
+		         for url in product_file.urls()}
+		if files and not await file_saver.delete_async(list(files), owners=list(files.values())):
+			# spooled, the rows stay until the replay, see replay_delete
+			await db.commit()
+			return
+		await db.execute(DELETE, {"urls": list(unreferenced)})
+		await db.commit()
+
+
+def replay_delete(owners: List[str], keys: List[str], delete: Callable[[List[str]], None]):
+	"""replays a spooled delete of blob files, leaving out those of blobs referenced again since"""
+	with SessionLocal() as db:
+		references = dict(db.execute(LOCK, {"urls": list(set(owners))}).all())
+		unreferenced = {url for url in owners if references.get(url, 0) <= 0}
+		keys = [key for key, owner in zip(keys, owners) if owner in unreferenced]
+		if keys:
+			delete(keys)
+		db.execute(DELETE, {"urls": list(unreferenced)})
+		db.commit()
+
+
+file_saver.replay_owned_delete = replay_delete
@@ -0,0 +1,204 @@
+"""
+Read-through cache of detail responses (GET /products/{id}, /brands/{id}, /inventories/{id}).
+
+Responses are stored serialized, a hit is returned as is without touching the database or
+pydantic. Their ETag is the hash of the stored content, a request whose If-None-Match holds it
+gets 304, also without a database query. Entries are keyed by "<namespace>:<id>" and can be tagged with other keys, a product
+is tagged with its brand and inventory so renaming a brand drops the products embedding it.
+signals.py invalidates entries when a model is saved or deleted, the rabbitmq consumers when
+they change rows.
+
+An invalidation also leaves a tombstone on the key for `tombstone_ttl` seconds. A miss that read
+the row before the write committed would otherwise store the old row after the invalidation, so
+entries whose key or tags carry a tombstone are not stored. The check and the store are one step
+of the backend, reads keep missing until the tombstone expires.
+"""
+import asyncio
+import hashlib
+import logging
+from collections import Counter
+from typing import Awaitable, Callable, Iterable, Optional, Type
+
+from pydantic import BaseModel
+from starlette.responses import Response
+
+import settings
+from helpers.cache import TTLCache
+from helpers.response import etag_matches
+
+
+class MemoryBackend:
+	"""in-process backend for tests and single worker setups, invalidations stay in the process"""
+
+	def __init__(self, maxsize: int = 10000, tombstone_ttl: float = 10):
+		self.entries = TTLCache(maxsize=maxsize)
+		self.tags = TTLCache(maxsize=maxsize)
+		self.tombstones = TTLCache(maxsize=maxsize, ttl=tombstone_ttl)
+
+	async def get(self, key: str) -> Optional[bytes]:
+		return self.entries.get(key)
+
+	async def set(self, key: str, value: bytes, ttl: int, tags: Iterable[str] = ()) -> bool:
+		tags = list(tags)
+		if any(self.tombstones.get(item) for item in [key, *tags]):
+			return False
+		self.entries.set(key, value, ttl=ttl)
+		for tag in tags:
+			tagged = self.tags.get(tag) or set()
+			tagged.add(key)
+			self.tags.set(tag, tagged, ttl=ttl)
+		return True
+
+	async def delete(self, key: str):
+		self.tombstones.set(key, True)
+		self.entries.delete(key)
+		for tagged in self.tags.get(key) or ():
+			self.entries.delete(tagged)
+		self.tags.delete(key)
+
+
+# KEYS: the entry, the tombstones of the entry and its tags, the tag sets. ARGV: value, ttl,
+# number of tombstones, key
+SET_SCRIPT = """
+local tombstones = tonumber(ARGV[3])
+for i = 2, tombstones + 1 do
+	if redis.call('exists', KEYS[i]) == 1 then return 0 end
+end
+redis.call('set', KEYS[1], ARGV[1], 'ex', ARGV[2])
+for i = tombstones + 2, #KEYS do
+	redis.call('sadd', KEYS[i], ARGV[4])
+	redis.call('expire', KEYS[i], ARGV[2])
+end
+return 1
+"""
+
+# KEYS: the entry, its tag set, its tombstone. ARGV: tombstone ttl, key prefix
+DELETE_SCRIPT = """
+redis.call('set', KEYS[3], 1, 'ex', ARGV[1])
+for _, key in ipairs(redis.call('smembers', KEYS[2])) do
+	redis.call('del', ARGV[2] .. key)
+end
+redis.call('del', KEYS[1], KEYS[2])
+"""
+
+
+class RedisBackend:
+	"""entries and tag sets live in redis, so an invalidation reaches every worker"""
+
+	def __init__(self, client=None, prefix: str = "cache", tombstone_ttl: int = 10):
+		if client is None:
+			from services.redis_client import redis_client as client
+		self.client = client
+		self.prefix = prefix
+		self.tombstone_ttl = tombstone_ttl
+		self.set_script = client.register_script(SET_SCRIPT)
+		self.delete_script = client.register_script(DELETE_SCRIPT)
+
+	def key(self, key: str) -> str:
+		return f"{self.prefix}:{key}"
+
+	def tag(self, key: str) -> str:
+		return f"{self.prefix}:tagged:{key}"
+
+	def tombstone(self, key: str) -> str:
+		return f"{self.prefix}:invalidated:{key}"
+
+	async def get(self, key: str) -> Optional[bytes]:
+		return await self.client.get(self.key(key))
+
+	async def set(self, key: str, value: bytes, ttl: int, tags: Iterable[str] = ()) -> bool:
+		tags = list(tags)
+		tombstones = [self.tombstone(item) for item in [key, *tags]]
+		keys = [self.key(key), *tombstones, *(self.tag(tag) for tag in tags)]
+		return bool(await self.set_script(keys=keys, args=[value, ttl, len(tombstones), key]))
+
+	async def delete(self, key: str):
+		await self.delete_script(keys=[self.key(key), self.tag(key), self.tombstone(key)],
+		                         args=[self.tombstone_ttl, f"{self.prefix}:"])
+
+
+class DetailCache:
+
+	def __init__(self, backend, ttl: int = 300):
+		self.backend = backend
+		self.ttl = ttl
+		self.loop: Optional[asyncio.AbstractEventLoop] = None
+		self.hits = Counter()
+		self.misses = Counter()
+		self.errors = Counter()
+
+	async def fetch(self, namespace: str, id: int, load: Callable[[], Awaitable], schema: Type[BaseModel],
+	                tags: Callable[[object], Iterable[str]] = None, headers: dict = None,
+	                if_none_match: str = None) -> Optional[Response]:
+		"""
+		the cached response of namespace:id, or the response of load() which is then cached.
+		returns None when load() finds nothing, responses returned by load() (failures) are not cached
+		"""
+		headers = dict(headers or {})
+		key = f"{namespace}:{id}"
+		content = None
+		try:
+			content = await self.backend.get(key)
+		except Exception as e:
+			# a cache outage costs a database query, not the request
+			self.errors[namespace] += 1
+			logging.error(f"cache get {key} failed: {e}")
+		if content is not None:
+			self.hits[namespace] += 1
+			return self.respond(content, if_none_match, {**headers, "X-Cache": "HIT"})
+
+		self.misses[namespace] += 1
+		item = await load()
+		if item is None or isinstance(item, Response):
+			return item
+		content = schema.model_validate(item, from_attributes=True).model_dump_json().encode()
+		try:
+			await self.backend.set(key, content, self.ttl, tags(item) if tags else ())
+		except Exception as e:
+			self.errors[namespace] += 1
+			logging.error(f"cache set {key} failed: {e}")
+		return self.respond(content, if_none_match, {**headers, "X-Cache": "MISS"})
+
+	@staticmethod
+	def respond(content: bytes, if_none_match: Optional[str], headers: dict) -> Response:
+		etag = f'"{hashlib.sha1(content).hexdigest()}"'
+		headers = {**headers, "ETag": etag, "Cache-Control": "private, no-cache"}
+		if etag_matches(if_none_match, etag):
+			return Response(status_code=304, headers=headers)
+		return Response(content, media_type="application/json", headers=headers)
+
+	async def invalidate(self, namespace: str, id: int):
+		try:
+			await self.backend.delete(f"{namespace}:{id}")
+		except Exception as e:
+			self.errors[namespace] += 1
+			logging.error(f"cache invalidation of {namespace}:{id} failed: {e}")
+
+	def attach(self, loop: asyncio.AbstractEventLoop):
+		self.loop = loop
+
+	def invalidate_threadsafe(self, namespace: str, ids: Iterable[int]):
+		"""
+		invalidates from threads outside the event loop (rabbitmq consumers) on the loop the app
+		attached, without it the entries expire with their ttl
+		"""
+		if self.loop is None or self.loop.is_closed():
+			return
+		for id in ids:
+			asyncio.run_coroutine_threadsafe(self.invalidate(namespace, id), self.loop)
+
+	def stats(self) -> dict:
+		namespaces = set(self.hits) | set(self.misses) | set(self.errors)
+		return {namespace: {"hits": self.hits[namespace], "misses": self.misses[namespace],
+		                    "errors": self.errors[namespace],
+		                    "hit_ratio": round(self.hits[namespace] / ((self.hits[namespace] + self.misses[namespace]) or 1), 4)}
+		        for namespace in sorted(namespaces)}
+
+
+def create_backend():
+	if settings.DETAIL_CACHE_BACKEND == "memory":
+		return MemoryBackend(maxsize=settings.DETAIL_CACHE_SIZE, tombstone_ttl=settings.DETAIL_CACHE_TOMBSTONE_TTL)
+	return RedisBackend(tombstone_ttl=settings.DETAIL_CACHE_TOMBSTONE_TTL)
+
+
+detail_cache = DetailCache(create_backend(), ttl=settings.DETAIL_CACHE_TTL)
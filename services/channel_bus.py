@@ -0,0 +1,146 @@
+"""
+Backplane carrying websocket messages between workers.
+
+ConnectionManager delivers a message to its own connections and hands it to the bus. The bus
+of each node collects them and publishes one batch every WS_BUS_FLUSH_INTERVAL seconds (sooner
+once WS_BUS_BATCH_SIZE messages are waiting). Every node receives every batch and delivers it
+to the subscribers it has; a node skips the batches it published itself.
+"""
+import asyncio
+import json
+import logging
+import uuid
+from typing import Callable, List, Optional
+
+import settings
+
+
+def encode_batch(node: str, messages: List[tuple]) -> str:
+	return json.dumps({"node": node, "messages": messages})
+
+
+class MemoryBackend:
+	"""stand-in for tests, buses sharing a hub behave like workers sharing a redis"""
+
+	def __init__(self, hub: list = None):
+		self.hub = hub if hub is not None else []
+		self.handler = None
+
+	async def subscribe(self, handler: Callable):
+		self.handler = handler
+		self.hub.append(handler)
+
+	async def publish(self, payload: str):
+		for handler in list(self.hub):
+			await handler(payload)
+
+	async def close(self):
+		if self.handler in self.hub:
+			self.hub.remove(self.handler)
+
+
+class RedisBackend:
+	"""redis pub/sub on a single channel, subscribed over its own connection"""
+
+	def __init__(self, client=None, channel: str = None):
+		if client is None:
+			from services.redis_client import redis_client as client
+		self.client = client
+		self.channel = channel or settings.WS_BUS_CHANNEL
+		self.pubsub = None
+		self.listener: Optional[asyncio.Task] = None
+
+	async def subscribe(self, handler: Callable):
+		self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+		self.listener = asyncio.create_task(self.listen(handler))
+
+	async def listen(self, handler: Callable):
+		while True:
+			try:
+				if not self.pubsub.subscribed:
+					await self.pubsub.subscribe(self.channel)
+				async for message in self.pubsub.listen():
+					if message["type"] == "message":
+						await handler(message["data"])
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				# the pubsub reconnects and subscribes again on its next read
+				logging.error(f"websocket bus subscription failed: {e}")
+				await asyncio.sleep(1)
+
+	async def publish(self, payload: str):
+		await self.client.publish(self.channel, payload)
+
+	async def close(self):
+		if self.listener:
+			self.listener.cancel()
+		if self.pubsub:
+			await self.pubsub.aclose()
+
+
+class ChannelBus:
+
+	def __init__(self, backend, deliver: Callable[[str, dict], int],
+	             flush_interval: float = None, batch_size: int = None):
+		self.backend = backend
+		self.deliver = deliver
+		self.flush_interval = settings.WS_BUS_FLUSH_INTERVAL if flush_interval is None else flush_interval
+		self.batch_size = batch_size or settings.WS_BUS_BATCH_SIZE
+		self.node = uuid.uuid4().hex
+		self.pending: List[tuple] = []
+		self.queued = asyncio.Event()
+		self.full = asyncio.Event()
+		self.flusher: Optional[asyncio.Task] = None
+
+	async def start(self):
+		await self.backend.subscribe(self.receive)
+		self.flusher = asyncio.create_task(self.flush_periodically())
+
+	async def stop(self):
+		if self.flusher:
+			self.flusher.cancel()
+			self.flusher = None
+		await self.flush()
+		await self.backend.close()
+
+	def publish(self, channel: str, data: dict):
+		"""queues a message for the other nodes, does nothing until the bus is started"""
+		if self.flusher is None:
+			return
+		self.pending.append((channel, data))
+		self.queued.set()
+		if len(self.pending) >= self.batch_size:
+			self.full.set()
+
+	async def flush_periodically(self):
+		while True:
+			await self.queued.wait()
+			try:
+				await asyncio.wait_for(self.full.wait(), timeout=self.flush_interval)
+			except asyncio.TimeoutError:
+				pass
+			self.queued.clear()
+			self.full.clear()
+			await self.flush()
+
+	async def flush(self):
+		while self.pending:
+			batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+			try:
+				await self.backend.publish(encode_batch(self.node, batch))
+			except Exception as e:
+				logging.error(f"websocket bus dropped {len(batch)} messages: {e}")
+
+	async def receive(self, payload):
+		batch = json.loads(payload)
+		if batch["node"] == self.node:
+			return
+		for channel, data in batch["messages"]:
+			self.deliver(channel, data)
+
+
+def create_backend():
+	if settings.WS_BUS_BACKEND == "memory":
+		return MemoryBackend()
+	return RedisBackend()
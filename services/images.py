@@ -0,0 +1,92 @@
+"""
+Derivatives of product images.
+
+Once new product images committed, a deferred post_bulk_save receiver (see signals.py) renders
+each of them as WebP in the sizes of IMAGE_VARIANTS, on a pool of IMAGE_WORKERS processes. The
+variants are stored next to the original and their urls are recorded in ProductFile.variants.
+Listings then show the thumbnail and details the other sizes, while the original stays
+available. An image that cannot be read or rendered keeps no variants, and clients fall back to
+its url. Variants of an image deleted while they were rendered are removed again, unless another
+row shares its content.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from sqlalchemy import String, bindparam, text
+from sqlalchemy.dialects.postgresql import JSONB
+
+import settings
+from helpers.images import render_variants
+from models import ProductFile, Product, file_saver
+from services import blobs
+from services.cache import detail_cache
+from settings.database import AsyncSessionLocal
+
+SET_VARIANTS = text("update product_files set variants = :variants where id = :id returning id") \
+	.bindparams(bindparam("variants", type_=JSONB))
+
+# images are addressed by content, a duplicate upload shares the variants of its original
+RENDERED = text("select distinct on (url) url, variants from product_files where url = any(:urls) and variants is not null") \
+	.columns(url=String, variants=JSONB)
+
+process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def pool() -> ProcessPoolExecutor:
+	global process_pool
+	if process_pool is None:
+		# forking a process running the broker and relay threads is not safe
+		process_pool = ProcessPoolExecutor(settings.IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+	return process_pool
+
+
+async def render(product_file: ProductFile) -> Dict[str, str]:
+	"""renders and stores the variants of one image, returns their urls by name"""
+	content = await file_saver.read_async(product_file.url)
+	rendered = await asyncio.get_running_loop().run_in_executor(
+		pool(), render_variants, content, settings.IMAGE_VARIANTS, settings.IMAGE_WEBP_QUALITY)
+	stem = os.path.splitext(product_file.name)[0]
+	urls = await asyncio.gather(*[file_saver.save_async(ProductFile.upload_to, f"{stem}_{name}.webp", data)
+	                              for name, data in rendered.items()])
+	return dict(zip(rendered, urls))
+
+
+async def generate_variants(product_files: List[ProductFile]):
+	async with AsyncSessionLocal() as db:
+		rendered = dict((await db.execute(RENDERED, {"urls": [product_file.url for product_file in product_files]})).all())
+	# images are read whole, at most IMAGE_WORKERS of them at once
+	slots = asyncio.Semaphore(settings.IMAGE_WORKERS)
+
+	async def generate(product_file: ProductFile) -> Optional[Dict[str, str]]:
+		if product_file.url in rendered:
+			return rendered[product_file.url]
+		async with slots:
+			try:
+				return await render(product_file)
+			except Exception as e:
+				logging.error(f"rendering variants of {product_file.url} failed: {e!r}")
+				return None
+
+	# one rendering per content
+	originals = {product_file.url: product_file for product_file in product_files}
+	variants_of = dict(zip(originals, await asyncio.gather(*[generate(product_file) for product_file in originals.values()])))
+	results = [(product_file, variants_of[product_file.url]) for product_file in product_files
+	           if variants_of[product_file.url]]
+	if not results:
+		return
+	async with AsyncSessionLocal() as db:
+		updated = set()
+		for product_file, variants in results:
+			updated.update((await db.execute(SET_VARIANTS, {"id": product_file.id, "variants": variants})).scalars())
+		await db.commit()
+	# rows deleted while their variants were rendered, the variants go unless other rows share them
+	deleted = [ProductFile(url=product_file.url, variants=variants) for product_file, variants in results
+	           if product_file.id not in updated]
+	if deleted:
+		await blobs.collect(deleted)
+	for product_id in {product_file.product_id for product_file, _ in results}:
+		await detail_cache.invalidate(Product.__tablename__, product_id)
@@ -0,0 +1,82 @@
+"""
+Transactional outbox for events other services listen to.
+
+Repositories record an event as an outbox row in the transaction that makes the change, so the
+event exists exactly when the change does and the request never waits on the broker. The
+relay thread publishes the rows to the exchange in batches and deletes the ones the broker
+confirmed. It runs right after a commit that recorded events, and every OUTBOX_POLL_INTERVAL
+seconds for rows left by failures or by other workers. Rows are claimed with skip locked, so
+any number of workers can relay at once. Delivery is at least once, consumers deduplicate by
+the message id.
+"""
+import logging
+import threading
+from concurrent.futures import wait
+from typing import Optional
+
+from sqlalchemy import text
+
+import settings
+from settings.database import SessionLocal
+
+CLAIM = text("""
+	select id, message_id, event, payload from outbox order by id limit :limit for update skip locked
+""")
+
+DELETE = text("delete from outbox where id = any(:ids)")
+
+
+class OutboxRelay:
+
+	def __init__(self, batch_size: int = None, poll_interval: float = None):
+		self.batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+		self.poll_interval = poll_interval or settings.OUTBOX_POLL_INTERVAL
+		self.publisher = None
+		self.woken = threading.Event()
+		self.thread: Optional[threading.Thread] = None
+
+	def start(self, publisher):
+		self.publisher = publisher
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.run, name="outbox-relay", daemon=True)
+			self.thread.start()
+
+	def wake(self):
+		self.woken.set()
+
+	def run(self):
+		while True:
+			try:
+				relayed = self.relay()
+			except Exception as e:
+				logging.error(f"outbox relay failed: {e}")
+				relayed = 0
+			# a full batch means there is probably more waiting
+			if relayed < self.batch_size:
+				self.woken.wait(self.poll_interval)
+				self.woken.clear()
+
+	def relay(self) -> int:
+		"""publishes one batch and returns how many of its events the broker confirmed"""
+		with SessionLocal() as db:
+			rows = db.execute(CLAIM, {"limit": self.batch_size}).all()
+			if not rows:
+				return 0
+			futures = [(row.id, self.publisher.submit((), {"id": row.message_id, "event": row.event, "data": row.payload}))
+			           for row in rows]
+			wait([future for _, future in futures], timeout=settings.RABBIT_MQ_CONFIRM_TIMEOUT)
+			published = []
+			for id, future in futures:
+				if future.done() and not future.cancelled() and future.exception() is None:
+					published.append(id)
+				else:
+					# the row stays and goes out with a later batch
+					future.cancel()
+			if len(published) < len(rows):
+				logging.error(f"{len(rows) - len(published)} outbox events were not published, retrying later")
+			db.execute(DELETE, {"ids": published})
+			db.commit()
+			return len(published)
+
+
+outbox_relay = OutboxRelay()
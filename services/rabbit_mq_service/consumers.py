@@ -1,7 +1,10 @@
 from collections import namedtuple
-from typing import Protocol
+from typing import List, Protocol
 
-from pika.channel import Channel
+import settings
+from services.cache import detail_cache
+from services.rabbit_mq_service.inventory_events import apply_inventory_events
+from settings.database import SessionLocal
 
 
 class Queues:
@@ -18,17 +21,23 @@ Exchange = ExchangeType("sales_app", "fanout")
 
 class Consumer(Protocol):
 	queue_name = ""
-
-	@classmethod
-	def consume(cls, ch: Channel, method, properties, body):
-		cls.handle_message(body)
-		ch.basic_ack(method.delivery_tag, False)
+	# unacknowledged deliveries and worker threads, RABBIT_MQ_PREFETCH and RABBIT_MQ_WORKERS when unset
+	prefetch = None
+	workers = None
+	# deliveries handed to handle_batch together, or as many as arrived within batch_window seconds
+	batch_size = 1
+	batch_window = 0
 
 	@staticmethod
 	def handle_message(message):
 		print(f" [x] Received {message}")
 		return
 
+	@classmethod
+	def handle_batch(cls, messages: List[bytes]):
+		for message in messages:
+			cls.handle_message(message)
+
 
 class AccountConsumer(Consumer):
 	queue_name = Queues.AccountQueue
@@ -42,6 +51,19 @@ class ReportConsumer(Consumer):
 
 class InventoryConsumer(Consumer):
 	queue_name = Queues.InventoryQueue
+	batch_size = settings.INVENTORY_BATCH_SIZE
+	batch_window = settings.INVENTORY_BATCH_WINDOW
+	prefetch = 2 * settings.INVENTORY_BATCH_SIZE
+
+	@classmethod
+	def handle_message(cls, message):
+		cls.handle_batch([message])
+
+	@classmethod
+	def handle_batch(cls, messages: List[bytes]):
+		with SessionLocal() as db:
+			products = apply_inventory_events(db, messages)
+		detail_cache.invalidate_threadsafe("products", products)
 
 
 
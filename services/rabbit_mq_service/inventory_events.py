@@ -0,0 +1,144 @@
+"""
+Applying the events of the inventory_queue to the products table.
+
+Messages are json objects with an id unique to the message:
+	{"id": "...", "event": "stock_adjusted", "data": {"product_id": 1, "delta": -2}}
+	{"id": "...", "event": "product_upserted", "data": {"id": 1, "name": "...", "description": "...",
+	 "brand_id": 1, "inventory_id": 1, "price": 9.99, "quantity": 10}}
+A batch of them is applied in one transaction, one statement per kind of event. The message ids
+go into processed_messages in the same transaction, so a message that is redelivered, or
+that another worker already applied, changes nothing. Ids are kept for
+PROCESSED_MESSAGES_RETENTION_HOURS, longer than a message can take to come round again, and
+pruned by a periodic celery task (tasks.py).
+"""
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Set, Tuple
+
+from pydantic import BaseModel
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import settings
+from schemas.products import ProductBase
+
+
+class StockAdjusted(BaseModel):
+	product_id: int
+	delta: int
+
+
+class ProductUpserted(ProductBase):
+	id: int
+
+
+EVENTS = {"stock_adjusted": StockAdjusted, "product_upserted": ProductUpserted}
+
+RECORD_MESSAGES = text("""
+	insert into processed_messages (id) select unnest(cast(:ids as text[]))
+	on conflict do nothing returning id
+""")
+
+UPSERT_PRODUCTS = text("""
+	insert into products (id, name, description, brand_id, inventory_id, price, quantity)
+	select * from unnest(cast(:ids as integer[]), cast(:names as text[]), cast(:descriptions as text[]),
+	                     cast(:brand_ids as integer[]), cast(:inventory_ids as integer[]),
+	                     cast(:prices as double precision[]), cast(:quantities as integer[]))
+	on conflict (id) do update set name = excluded.name, description = excluded.description,
+		brand_id = excluded.brand_id, inventory_id = excluded.inventory_id,
+		price = excluded.price, quantity = excluded.quantity
+""")
+
+# products created here take their id from upstream, keep the sequence ahead of them
+SYNC_PRODUCT_IDS = text("""
+	select setval(s.name, p.max_id)
+	from (select pg_get_serial_sequence('products', 'id') as name) s, (select max(id) as max_id from products) p
+	where p.max_id > (select coalesce(last_value, 0) from pg_sequences where schemaname || '.' || sequencename = s.name)
+""")
+
+# in batches, so the delete never holds many row locks at once
+PRUNE_MESSAGES = text("""
+	delete from processed_messages where id in (
+		select id from processed_messages where processed_at < :before limit :batch_size
+	)
+""")
+
+ADJUST_STOCK = text("""
+	update products p set quantity = p.quantity + d.delta
+	from unnest(cast(:product_ids as integer[]), cast(:deltas as integer[])) as d(id, delta)
+	where p.id = d.id
+""")
+
+
+def parse(messages: List[bytes]) -> Dict[str, Tuple[str, BaseModel]]:
+	"""message id -> (event, data) in delivery order, the first copy of a message wins"""
+	events = dict()
+	for body in messages:
+		try:
+			message = json.loads(body)
+			event = message["event"]
+			if event not in EVENTS:
+				# the exchange is a fanout, events of every service come through here
+				continue
+			events.setdefault(str(message["id"]), (event, EVENTS[event].model_validate(message["data"])))
+		except (ValueError, KeyError, TypeError) as e:
+			# redelivering it would not make it any better
+			logging.error(f"dropping malformed inventory event {body[:200]!r}: {e}")
+	return events
+
+
+def plan(events: Dict[str, Tuple[str, BaseModel]], fresh: Set[str]) -> Tuple[Dict[int, ProductUpserted], Dict[int, int]]:
+	"""
+	folds the fresh events into the last upsert and the net stock change of each product. upserts
+	are applied first, so adjustments that came before a product's upsert are dropped
+	"""
+	upserts, deltas = dict(), dict()
+	for id, (event, data) in events.items():
+		if id not in fresh:
+			continue
+		if event == "product_upserted":
+			upserts[data.id] = data
+			deltas.pop(data.id, None)
+		else:
+			deltas[data.product_id] = deltas.get(data.product_id, 0) + data.delta
+	return upserts, deltas
+
+
+def apply_inventory_events(db: Session, messages: List[bytes]) -> Set[int]:
+	"""applies a batch of messages in one transaction and returns the ids of the products it changed"""
+	events = parse(messages)
+	if not events:
+		return set()
+	fresh = set(db.execute(RECORD_MESSAGES, {"ids": list(events)}).scalars())
+	upserts, deltas = plan(events, fresh)
+	if upserts:
+		products = list(upserts.values())
+		db.execute(UPSERT_PRODUCTS, {
+			"ids": [product.id for product in products],
+			"names": [product.name for product in products],
+			"descriptions": [product.description for product in products],
+			"brand_ids": [product.brand_id for product in products],
+			"inventory_ids": [product.inventory_id for product in products],
+			"prices": [product.price for product in products],
+			"quantities": [product.quantity for product in products],
+		})
+		db.execute(SYNC_PRODUCT_IDS)
+	if deltas:
+		db.execute(ADJUST_STOCK, {"product_ids": list(deltas), "deltas": list(deltas.values())})
+	db.commit()
+	return set(upserts) | set(deltas)
+
+
+def prune_processed_messages(db: Session, retention: timedelta = None, batch_size: int = None) -> int:
+	"""deletes the ids of messages processed longer than retention ago, returns how many went"""
+	retention = retention or timedelta(hours=settings.PROCESSED_MESSAGES_RETENTION_HOURS)
+	batch_size = batch_size or settings.PROCESSED_MESSAGES_PRUNE_BATCH
+	before = datetime.now(timezone.utc) - retention
+	pruned = 0
+	while True:
+		deleted = db.execute(PRUNE_MESSAGES, {"before": before, "batch_size": batch_size}).rowcount
+		db.commit()
+		pruned += deleted
+		if deleted < batch_size:
+			return pruned
@@ -0,0 +1,190 @@
+"""
+Publishing to the exchange from any thread or coroutine.
+
+pika connections are not thread-safe, so the publisher owns a SelectConnection of its own,
+driven by its own thread, and other threads only queue messages for it. Its channel is in
+confirm mode: everything waiting is published in one go and the broker confirms it in batches
+(multiple=True), each publish getting a future resolved by its confirm. Queues are bound the
+first time a message is published to them on a channel, not on every publish. Failing
+connection attempts open the publisher's circuit breaker, and while it is open publishing fails
+at once rather than waiting for a confirm that is not coming.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, Iterable, Optional, Set
+
+import pika
+from pika.spec import Basic
+
+import settings
+from helpers.circuit_breaker import CircuitBreaker, CircuitOpenError
+from services.rabbit_mq_service.consumers import ExchangeType
+
+
+class PublishError(Exception):
+	pass
+
+
+class Publisher:
+
+	def __init__(self, exchange: ExchangeType, parameters: pika.ConnectionParameters = None,
+	             max_unconfirmed: int = None):
+		self.exchange = exchange
+		self.parameters = parameters
+		self.max_unconfirmed = max_unconfirmed or settings.RABBIT_MQ_MAX_UNCONFIRMED
+		# (queues, body, future) waiting for the publisher thread, appended from any thread
+		self.outbox = deque()
+		# delivery tag -> future, in publishing order
+		self.unconfirmed: Dict[int, Future] = dict()
+		self.delivery_tag = 0
+		self.bound: Set[str] = set()
+		self.connection = None
+		self.channel = None
+		self.thread: Optional[threading.Thread] = None
+		self.lock = threading.Lock()
+		self.stopping = False
+		self.breaker = CircuitBreaker("rabbitmq")
+
+	def start(self):
+		with self.lock:
+			if self.thread is None:
+				self.stopping = False
+				self.thread = threading.Thread(target=self.run, name="rabbitmq-publisher", daemon=True)
+				self.thread.start()
+
+	def stop(self, timeout: float = None):
+		self.stopping = True
+		connection = self.connection
+		if connection is not None:
+			connection.ioloop.add_callback_threadsafe(self.close)
+		if self.thread is not None:
+			self.thread.join(timeout)
+			self.thread = None
+
+	def run(self):
+		while not self.stopping:
+			self.connection = self.connect()
+			self.connection.ioloop.start()
+			# the loop stops when the connection closes
+			if not self.stopping:
+				time.sleep(settings.RABBIT_MQ_RECONNECT_DELAY)
+		self.connection = None
+
+	def connect(self):
+		return pika.SelectConnection(self.parameters, on_open_callback=self.on_connection_open,
+		                             on_open_error_callback=self.on_connection_closed,
+		                             on_close_callback=self.on_connection_closed)
+
+	def close(self):
+		if self.connection.is_open:
+			self.connection.close()
+		else:
+			self.connection.ioloop.stop()
+
+	def on_connection_open(self, connection):
+		connection.channel(on_open_callback=self.on_channel_open)
+
+	def on_channel_open(self, channel):
+		channel.add_on_close_callback(self.on_channel_closed)
+		channel.confirm_delivery(self.on_confirm, callback=lambda _: self.ready(channel))
+
+	def ready(self, channel):
+		self.breaker.success()
+		self.channel = channel
+		self.delivery_tag = 0
+		self.bound = set()
+		self.flush()
+
+	def on_channel_closed(self, channel, reason):
+		logging.error(f"rabbitmq publisher channel closed: {reason}")
+		self.breaker.failure()
+		self.channel = None
+		self.fail_unconfirmed(reason)
+		if self.connection is not None and self.connection.is_open:
+			self.connection.close()
+
+	def on_connection_closed(self, connection, error):
+		if not self.stopping:
+			logging.error(f"rabbitmq publisher connection lost: {error}")
+			self.breaker.failure()
+		self.channel = None
+		self.fail_unconfirmed(error)
+		connection.ioloop.stop()
+
+	def fail_unconfirmed(self, reason):
+		# whether the broker got these is unknown, queued messages are kept for the next channel
+		unconfirmed, self.unconfirmed = self.unconfirmed, dict()
+		for future in unconfirmed.values():
+			if not future.done():
+				future.set_exception(PublishError(f"connection lost before the broker confirmed: {reason}"))
+
+	def submit(self, queues: Iterable[str], data: dict) -> Future:
+		"""queues a message from any thread, the future resolves once the broker confirms it"""
+		future = Future()
+		self.start()
+		if not self.breaker.allow():
+			future.set_exception(CircuitOpenError("rabbitmq is unavailable"))
+			return future
+		self.outbox.append((set(queues), json.dumps(data), future))
+		connection = self.connection
+		if connection is not None:
+			try:
+				connection.ioloop.add_callback_threadsafe(self.flush)
+			except Exception:
+				# closing, the next channel flushes the outbox
+				pass
+		return future
+
+	def publish(self, queues: Iterable[str], data: dict, timeout: float = None):
+		"""publishes and waits for the broker's confirm"""
+		future = self.submit(queues, data)
+		try:
+			return future.result(timeout or settings.RABBIT_MQ_CONFIRM_TIMEOUT)
+		except TimeoutError:
+			# a message still queued is dropped so the caller can spool it, one that went out may arrive twice
+			future.cancel()
+			raise
+
+	async def publish_async(self, queues: Iterable[str], data: dict):
+		"""publishes without blocking the event loop"""
+		return await asyncio.wrap_future(self.submit(queues, data))
+
+	def flush(self):
+		while self.channel is not None and self.outbox and len(self.unconfirmed) < self.max_unconfirmed:
+			queues, body, future = self.outbox.popleft()
+			# skips messages whose publisher gave up waiting, the others can no longer be cancelled
+			if not future.set_running_or_notify_cancel():
+				continue
+			for queue in queues - self.bound:
+				# the channel applies the binding before the publish that follows it
+				self.channel.queue_bind(queue=queue, exchange=self.exchange.name)
+				self.bound.add(queue)
+			self.channel.basic_publish(exchange=self.exchange.name, routing_key='', body=body)
+			self.delivery_tag += 1
+			self.unconfirmed[self.delivery_tag] = future
+
+	def on_confirm(self, frame):
+		method = frame.method
+		if method.multiple:
+			tags = []
+			for tag in self.unconfirmed:
+				if tag > method.delivery_tag:
+					break
+				tags.append(tag)
+		else:
+			tags = [method.delivery_tag]
+		acked = isinstance(method, Basic.Ack)
+		for tag in tags:
+			future = self.unconfirmed.pop(tag, None)
+			if future is None or future.done():
+				continue
+			if acked:
+				future.set_result(None)
+			else:
+				future.set_exception(PublishError("the broker rejected the message"))
+		self.flush()
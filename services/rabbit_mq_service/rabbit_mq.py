@@ -1,12 +1,18 @@
+import asyncio
 import json
+import logging
 import threading
 from typing import List
 
 import pika
-from pika.adapters.blocking_connection import BlockingConnection
 
+import settings
+from helpers.circuit_breaker import CircuitOpenError
 from helpers.decorators import singleton
 from services.rabbit_mq_service.consumers import ExchangeType, Consumer
+from services.rabbit_mq_service.publisher import Publisher, PublishError
+from services.rabbit_mq_service.workers import QueueWorker
+from services.spool import Spool
 from decouple import config
 
 # Define the connection parameters to connect to RabbitMQ server
@@ -22,33 +28,44 @@ class RabbitMQService:
 		self.consumers = consumers
 		self.queues = set([c.queue_name for c in consumers])
 		self.exchange = exchange
-		self.connection = BlockingConnection(connection_params)
-		self.channel = self.connection.channel()
-		self.channel.exchange_declare(exchange_type=exchange.type, exchange=exchange.name, passive=True,
-		                              durable=True)
-		for consumer in consumers:
-			self.channel.queue_declare(queue=consumer.queue_name, passive=True)
-		print("connected to rabbitmq")
+		# nothing connects here, so the app starts while the broker is down. consumers connect in
+		# their own threads and keep retrying, the publisher connects on its first message
+		self.publisher = Publisher(exchange, connection_params)
+		# messages published while the broker is unavailable, replayed once it is back
+		self.spool = Spool("rabbitmq")
+		self.spool.start_replay(self.replay)
 
 	def publish(self, queues: set[str], data: dict):
-		data = json.dumps(data)
+		"""publishes from any thread and waits for the confirm, spools the message while the broker is unavailable"""
 		queues = self.queues.intersection(queues)
-		for queue in queues:
-			self.channel.queue_bind(queue=queue, exchange=self.exchange.name)
+		try:
+			self.publisher.publish(queues, data)
+		except (CircuitOpenError, PublishError, TimeoutError) as e:
+			self.spool_message(queues, data, e)
 
-		self.channel.basic_publish(exchange=self.exchange.name,
-		                           routing_key='',
-		                           body=data)
+	async def publish_async(self, queues: set[str], data: dict):
+		queues = self.queues.intersection(queues)
+		try:
+			await asyncio.wait_for(self.publisher.publish_async(queues, data), settings.RABBIT_MQ_CONFIRM_TIMEOUT)
+		except (CircuitOpenError, PublishError, TimeoutError) as e:
+			self.spool_message(queues, data, e)
+
+	def spool_message(self, queues: set[str], data: dict, error: Exception):
+		logging.warning(f"spooling a message for rabbitmq: {error!r}")
+		self.spool.put({"queues": sorted(queues)}, json.dumps(data).encode())
+
+	def replay(self, meta: dict, body: bytes):
+		self.publisher.publish(meta["queues"], json.loads(body))
 
 	def consume(self):
-		for consumer in self.consumers:
-			self.channel.queue_bind(queue=consumer.queue_name, exchange=self.exchange.name)
-
-			self.channel.basic_consume(queue=consumer.queue_name,
-			                           on_message_callback=consumer.consume,
-			                           exclusive=False,
-			                           auto_ack=False)
-		self.channel.start_consuming()
+		# every consumer reads its queue on a connection of its own and handles it with a pool of workers
+		threads = [threading.Thread(target=QueueWorker(consumer, self.exchange, connection_params).run,
+		                            name=f"{consumer.queue_name}-consumer", daemon=True)
+		           for consumer in self.consumers]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
 
 	def consume_in_background(self):
 		thread = threading.Thread(target=self.consume)
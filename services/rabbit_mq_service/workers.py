@@ -0,0 +1,185 @@
+"""
+Consuming a queue with a pool of worker threads.
+
+Each consumer class gets a connection and channel of its own, read by one thread, with at most
+its prefetch of unacknowledged deliveries (basic_qos). Deliveries are grouped into batches of the
+class's batch_size (or whatever arrived within its batch_window) and handled by the class's
+pool of worker threads. As they finish the connection thread acks the longest run of
+finished ones with a single multiple=True ack. A delivery is only acked once it was handled, so
+whatever is in flight when the process or connection dies is redelivered. A failed batch is
+retried delivery by delivery first, so one bad message does not send its whole batch back.
+A delivery whose handler raised goes back to the end of its queue with its attempts counted in
+the x-attempts header, and is acked. After RABBIT_MQ_MAX_ATTEMPTS attempts it goes to the
+<queue>.dead queue of RABBIT_MQ_DEAD_LETTER_EXCHANGE instead, so a poison message stops going
+round. Both publishes are confirmed before the ack, and a retry that cannot be published is
+nacked back onto the queue.
+"""
+import copy
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+import pika
+from pika.adapters.blocking_connection import BlockingConnection
+
+import settings
+from services.rabbit_mq_service.consumers import Consumer, ExchangeType
+
+Delivery = Tuple[int, bytes, Optional[pika.BasicProperties]]
+
+
+class QueueWorker:
+
+	def __init__(self, consumer: Consumer, exchange: ExchangeType, parameters: pika.ConnectionParameters,
+	             prefetch: int = None, workers: int = None):
+		self.consumer = consumer
+		self.exchange = exchange
+		self.parameters = parameters
+		self.prefetch = prefetch or consumer.prefetch or settings.RABBIT_MQ_PREFETCH
+		self.workers = workers or consumer.workers or settings.RABBIT_MQ_WORKERS
+		# ack as soon as this many deliveries in a row are finished, the rest on a timer
+		self.ack_batch = max(1, self.prefetch // 2)
+		self.connection = None
+		self.channel = None
+		self.pool = None
+		# delivery tag -> None while it is handled, True once it was, in delivery order
+		self.pending: Dict[int, Optional[bool]] = dict()
+		self.ack_scheduled = False
+		# (delivery tag, body, properties) waiting for the batch to fill up or its window to close
+		self.batch: List[Delivery] = []
+		self.batch_window = None
+
+	def run(self):
+		while True:
+			try:
+				self.consume()
+			except pika.exceptions.AMQPError as e:
+				logging.error(f"{self.consumer.queue_name} consumer lost its connection: {e!r}")
+				time.sleep(settings.RABBIT_MQ_RECONNECT_DELAY)
+
+	def consume(self):
+		self.connection = BlockingConnection(self.parameters)
+		self.channel = self.connection.channel()
+		self.channel.exchange_declare(exchange=self.exchange.name, exchange_type=self.exchange.type,
+		                              passive=True, durable=True)
+		self.channel.queue_declare(queue=self.consumer.queue_name, passive=True)
+		self.channel.basic_qos(prefetch_count=self.prefetch)
+		self.channel.queue_bind(queue=self.consumer.queue_name, exchange=self.exchange.name)
+		# failed deliveries are published again before they are acked, confirmed so none get lost
+		self.channel.confirm_delivery()
+		self.channel.exchange_declare(exchange=settings.RABBIT_MQ_DEAD_LETTER_EXCHANGE, exchange_type="direct",
+		                              durable=True)
+		self.channel.queue_declare(queue=f"{self.consumer.queue_name}.dead", durable=True)
+		self.channel.queue_bind(queue=f"{self.consumer.queue_name}.dead", exchange=settings.RABBIT_MQ_DEAD_LETTER_EXCHANGE,
+		                        routing_key=self.consumer.queue_name)
+		self.channel.basic_consume(queue=self.consumer.queue_name, on_message_callback=self.on_message,
+		                           exclusive=False, auto_ack=False)
+		# deliveries of an earlier connection are redelivered, their tags mean nothing here
+		self.pending = dict()
+		self.ack_scheduled = False
+		self.batch = []
+		self.batch_window = None
+		with ThreadPoolExecutor(self.workers, thread_name_prefix=self.consumer.queue_name) as self.pool:
+			self.channel.start_consuming()
+
+	def on_message(self, channel, method, properties, body):
+		self.pending[method.delivery_tag] = None
+		self.batch.append((method.delivery_tag, body, properties))
+		if len(self.batch) >= self.consumer.batch_size:
+			self.dispatch()
+		elif self.batch_window is None:
+			self.batch_window = self.connection.call_later(self.consumer.batch_window, self.close_batch_window)
+
+	def close_batch_window(self):
+		self.batch_window = None
+		self.dispatch()
+
+	def dispatch(self):
+		if self.batch_window is not None:
+			self.connection.remove_timeout(self.batch_window)
+			self.batch_window = None
+		batch, self.batch = self.batch, []
+		if batch:
+			self.pool.submit(self.handle, self.connection, batch)
+
+	def handle(self, connection, batch: List[Delivery]):
+		results = self.run_batch(batch)
+		try:
+			# channels belong to the connection thread, acks are left to it
+			connection.add_callback_threadsafe(partial(self.settle, results))
+		except Exception:
+			# the connection is gone and the broker redelivers the messages
+			pass
+
+	def run_batch(self, batch: List[Delivery]) -> List[Tuple[Delivery, bool]]:
+		try:
+			self.consumer.handle_batch([body for _, body, _ in batch])
+			return [(delivery, True) for delivery in batch]
+		except Exception:
+			if len(batch) == 1:
+				logging.exception(f"{self.consumer.queue_name} consumer failed a message")
+				return [(batch[0], False)]
+			logging.exception(f"{self.consumer.queue_name} consumer failed a batch, retrying its messages one by one")
+			return [result for delivery in batch for result in self.run_batch([delivery])]
+
+	def settle(self, results: List[Tuple[Delivery, bool]]):
+		for (delivery_tag, body, properties), handled in results:
+			if delivery_tag not in self.pending:
+				continue
+			if handled or self.retry(body, properties):
+				self.pending[delivery_tag] = True
+			else:
+				del self.pending[delivery_tag]
+				self.channel.basic_nack(delivery_tag, multiple=False, requeue=True)
+		finished = self.finished()
+		if finished and (finished >= self.ack_batch or finished == len(self.pending)):
+			self.ack()
+		elif finished and not self.ack_scheduled:
+			self.ack_scheduled = True
+			self.connection.call_later(settings.RABBIT_MQ_ACK_INTERVAL, self.ack)
+
+	def retry(self, body: bytes, properties: Optional[pika.BasicProperties]) -> bool:
+		"""
+		publishes a failed delivery to the end of its queue, or to the dead letter exchange once it
+		used up its attempts. returns whether the broker took it, the delivery can be acked then
+		"""
+		properties = copy.copy(properties) if properties is not None else pika.BasicProperties(delivery_mode=2)
+		headers = dict(properties.headers or {})
+		attempts = int(headers.get("x-attempts", 1))
+		if attempts >= settings.RABBIT_MQ_MAX_ATTEMPTS:
+			logging.error(f"{self.consumer.queue_name} consumer gave up on a message after {attempts} attempts, "
+			              f"it goes to {self.consumer.queue_name}.dead")
+			exchange = settings.RABBIT_MQ_DEAD_LETTER_EXCHANGE
+		else:
+			exchange = ""
+		headers["x-attempts"] = attempts + 1
+		properties.headers = headers
+		try:
+			# the default exchange routes by queue name, the other queues of the fanout don't see it again
+			self.channel.basic_publish(exchange=exchange, routing_key=self.consumer.queue_name, body=body,
+			                           properties=properties, mandatory=True)
+			return True
+		except (pika.exceptions.NackError, pika.exceptions.UnroutableError) as e:
+			logging.error(f"{self.consumer.queue_name} consumer could not publish a retry: {e!r}")
+			return False
+
+	def finished(self) -> int:
+		count = 0
+		for handled in self.pending.values():
+			if not handled:
+				break
+			count += 1
+		return count
+
+	def ack(self):
+		self.ack_scheduled = False
+		last = None
+		for delivery_tag, handled in list(self.pending.items()):
+			if not handled:
+				break
+			last = delivery_tag
+			del self.pending[delivery_tag]
+		if last is not None:
+			self.channel.basic_ack(last, multiple=True)
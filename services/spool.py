@@ -0,0 +1,158 @@
+"""
+Bounded local disk spool for work a dependency could not take.
+
+While the broker or object storage is unavailable, the messages and uploads meant for it are
+written here, one file each, and replayed in the order they were spooled once its circuit
+breaker lets calls through again. A spool holds at most SPOOL_MAX_BYTES, beyond that put
+raises SpoolFull instead of filling the disk.
+
+Every process of the app shares the spools. The bytes a spool holds are counted in its .size
+file, which is only read and written under an flock, so the bound holds across processes. A
+record is sent by whichever process locks it first. The others skip it, so it is not sent twice,
+and the lock dies with a process that crashes while sending it.
+"""
+import fcntl
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, List, Optional, Union
+
+import settings
+from helpers.circuit_breaker import CircuitOpenError
+
+
+class SpoolFull(Exception):
+	pass
+
+
+class SizeCounter:
+
+	def __init__(self, file):
+		self.file = file
+		self.value = int(file.read() or 0)
+
+	def write(self, value: int):
+		self.file.seek(0)
+		self.file.truncate()
+		self.file.write(str(value))
+		self.file.flush()
+		self.value = value
+
+
+class Spool:
+
+	def __init__(self, name: str, path: str = None, max_bytes: int = None):
+		self.name = name
+		self.path = os.path.join(path or settings.SPOOL_PATH, name)
+		self.max_bytes = max_bytes or settings.SPOOL_MAX_BYTES
+		os.makedirs(self.path, exist_ok=True)
+		self.lock = threading.Lock()
+		self.sequence = itertools.count()
+		self.size_path = os.path.join(self.path, ".size")
+		with self.counter() as counter:
+			# what an earlier process left behind is replayed too. recounted in case one died between
+			# counting a record and writing it
+			counter.write(sum(os.path.getsize(os.path.join(self.path, name)) for name in self.files()))
+		self.replayer: Optional[threading.Thread] = None
+
+	@contextmanager
+	def counter(self):
+		"""the bytes held by the spool, locked against the threads and processes sharing it"""
+		with self.lock, open(self.size_path, "a+") as file:
+			fcntl.flock(file, fcntl.LOCK_EX)
+			file.seek(0)
+			counter = SizeCounter(file)
+			yield counter
+
+	@property
+	def size(self) -> int:
+		with self.counter() as counter:
+			return counter.value
+
+	def files(self) -> List[str]:
+		return sorted(name for name in os.listdir(self.path) if name.endswith(".spool"))
+
+	def __len__(self) -> int:
+		return len(self.files())
+
+	def put(self, meta: dict, body: Union[bytes, BinaryIO] = b""):
+		"""body is bytes or a file, which is copied from its start in chunks"""
+		header = json.dumps(meta).encode() + b"\n"
+		if isinstance(body, bytes):
+			length = len(body)
+		else:
+			length = body.seek(0, os.SEEK_END)
+			body.seek(0)
+		with self.counter() as counter:
+			if counter.value + len(header) + length > self.max_bytes:
+				raise SpoolFull(f"{self.name} spool is full")
+			counter.write(counter.value + len(header) + length)
+		name = f"{time.time_ns():020d}-{os.getpid()}-{next(self.sequence):06d}.spool"
+		temporary = os.path.join(self.path, f".{name}.tmp")
+		with open(temporary, "wb") as file:
+			file.write(header)
+			if isinstance(body, bytes):
+				file.write(body)
+			else:
+				shutil.copyfileobj(body, file, settings.UPLOAD_CHUNK_SIZE)
+		# the rename makes the record visible whole or not at all
+		os.replace(temporary, os.path.join(self.path, name))
+
+	def replay(self, send: Callable[[dict, bytes], None]) -> int:
+		"""
+		sends the records oldest first, stopping at the first failure, and returns how many went.
+		stops too at a record another process is sending, that one replays the rest
+		"""
+		sent = 0
+		for name in self.files():
+			path = os.path.join(self.path, name)
+			try:
+				file = open(path, "rb")
+			except FileNotFoundError:
+				# sent by another process since the listing
+				continue
+			with file:
+				try:
+					fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except BlockingIOError:
+					break
+				if os.fstat(file.fileno()).st_nlink == 0:
+					continue
+				meta, body = file.read().split(b"\n", 1)
+				send(json.loads(meta), body)
+				size = os.fstat(file.fileno()).st_size
+				# removed while still locked, so no other process opens it in between and sends it again
+				os.remove(path)
+			with self.counter() as counter:
+				counter.write(max(counter.value - size, 0))
+			sent += 1
+		return sent
+
+	def start_replay(self, send: Callable[[dict, bytes], None], interval: float = None):
+		"""
+		replays in the background whenever something is spooled. send goes through the
+		dependency's circuit breaker, so while it is open replaying stops at the first record
+		"""
+		interval = interval or settings.SPOOL_REPLAY_INTERVAL
+
+		def replay_periodically():
+			while True:
+				time.sleep(interval)
+				if not len(self):
+					continue
+				try:
+					sent = self.replay(send)
+					logging.warning(f"replayed {sent} spooled {self.name} records")
+				except CircuitOpenError:
+					pass
+				except Exception as e:
+					logging.error(f"replaying the {self.name} spool stopped: {e}")
+
+		if self.replayer is None:
+			self.replayer = threading.Thread(target=replay_periodically, name=f"{self.name}-spool", daemon=True)
+			self.replayer.start()
@@ -0,0 +1,156 @@
+"""
+Storage backends of uploaded files.
+
+A backend stores content under keys and knows the url a key is served from. LocalStorage keeps
+files in MEDIA_URL on this machine, S3Storage in a bucket. The S3 client is built once and shared
+by every thread of the process, with a connection pool sized for the upload pool and the parts
+of multipart uploads. Files from S3_MULTIPART_THRESHOLD bytes on are uploaded in parts, several
+at a time, and deletes go out in batches of up to 1000 keys per request. The blocking methods
+suit threads (replays, celery), the *_async ones run them on the upload pool.
+"""
+import abc
+import asyncio
+import io
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, List, Union
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+import settings
+
+# blocking storage i/o of uploads, kept off the default executor so uploads cannot starve it
+upload_pool = ThreadPoolExecutor(settings.UPLOAD_WORKERS, thread_name_prefix="upload")
+
+# delete_objects takes at most this many keys
+DELETE_BATCH = 1000
+# error codes s3 answers with when it is throttling or failing, not refusing the request
+UNAVAILABLE_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequests",
+                     "RequestTimeout", "InternalError", "ServiceUnavailable"}
+
+
+def s3_unavailable(error: Exception) -> bool:
+	"""whether s3 could not take a call now, so it may go through later"""
+	if isinstance(error, BotoCoreError):
+		return True
+	if isinstance(error, ClientError):
+		status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+		return status >= 500 or status == 429 or error.response.get("Error", {}).get("Code") in UNAVAILABLE_CODES
+	return False
+
+
+class Storage(abc.ABC):
+
+	def key(self, folder: str, name: str) -> str:
+		return os.path.join(settings.MEDIA_URL, folder, name)
+
+	@abc.abstractmethod
+	def url(self, key: str) -> str:
+		...
+
+	@abc.abstractmethod
+	def key_of(self, url: str) -> str:
+		...
+
+	@abc.abstractmethod
+	def put(self, key: str, content: Union[bytes, BinaryIO]):
+		"""content is bytes or a file, which is read from its start"""
+
+	@abc.abstractmethod
+	def delete(self, keys: List[str]):
+		...
+
+	@abc.abstractmethod
+	def get(self, key: str) -> bytes:
+		...
+
+	async def get_async(self, key: str) -> bytes:
+		return await asyncio.get_running_loop().run_in_executor(upload_pool, self.get, key)
+
+	async def put_async(self, key: str, content: Union[bytes, BinaryIO]):
+		await asyncio.get_running_loop().run_in_executor(upload_pool, self.put, key, content)
+
+	async def delete_async(self, keys: List[str]):
+		await asyncio.get_running_loop().run_in_executor(upload_pool, self.delete, keys)
+
+
+class LocalStorage(Storage):
+	"""keys are paths, and so are the urls"""
+
+	def url(self, key: str) -> str:
+		return key
+
+	def key_of(self, url: str) -> str:
+		return url
+
+	def put(self, key: str, content: Union[bytes, BinaryIO]):
+		os.makedirs(os.path.dirname(key), exist_ok=True)
+		with open(key, "wb") as file:
+			if isinstance(content, bytes):
+				file.write(content)
+			else:
+				content.seek(0)
+				shutil.copyfileobj(content, file, settings.UPLOAD_CHUNK_SIZE)
+
+	def delete(self, keys: List[str]):
+		for key in keys:
+			if os.path.exists(key):
+				os.remove(key)
+
+	def get(self, key: str) -> bytes:
+		with open(key, "rb") as file:
+			return file.read()
+
+
+class S3Storage(Storage):
+
+	def __init__(self, bucket: str, client=None):
+		self.bucket = bucket
+		self.s3 = client
+		self.lock = threading.Lock()
+		self.transfer = TransferConfig(multipart_threshold=settings.S3_MULTIPART_THRESHOLD,
+		                               multipart_chunksize=settings.S3_MULTIPART_CHUNKSIZE,
+		                               max_concurrency=settings.S3_MULTIPART_CONCURRENCY)
+
+	def client(self):
+		with self.lock:
+			if self.s3 is None:
+				# short timeouts and no retries, FileSaver's breaker and spool deal with outages
+				self.s3 = boto3.client('s3', aws_access_key_id=settings.AWS_ACCESS_KEY,
+				                       aws_secret_access_key=settings.AWS_SECRET_KEY,
+				                       endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+				                       config=Config(connect_timeout=settings.S3_TIMEOUT, read_timeout=settings.S3_TIMEOUT,
+				                                     retries={"max_attempts": 1},
+				                                     max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS))
+			return self.s3
+
+	def url(self, key: str) -> str:
+		return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+
+	def key_of(self, url: str) -> str:
+		return url.split(".s3.amazonaws.com/", 1)[-1]
+
+	def put(self, key: str, content: Union[bytes, BinaryIO]):
+		if isinstance(content, bytes):
+			content = io.BytesIO(content)
+		# a failed attempt starts over from the beginning of the file
+		content.seek(0)
+		self.client().upload_fileobj(content, self.bucket, key, Config=self.transfer)
+
+	def get(self, key: str) -> bytes:
+		return self.client().get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+	def delete(self, keys: List[str]):
+		for start in range(0, len(keys), DELETE_BATCH):
+			batch = keys[start:start + DELETE_BATCH]
+			response = self.client().delete_objects(Bucket=self.bucket, Delete={
+				"Objects": [{"Key": key} for key in batch], "Quiet": True})
+			for error in response.get("Errors", ()):
+				# retrying would not make a denied delete go through
+				logging.error(f"s3 could not delete {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
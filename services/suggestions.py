@@ -0,0 +1,157 @@
+import asyncio
+import bisect
+import logging
+import re
+import string
+from array import array
+from collections import defaultdict
+from sys import intern
+from typing import Iterable, List, Tuple
+
+from sqlalchemy import select
+
+import models
+import settings
+from settings.database import AsyncSessionLocal
+
+PRODUCT, BRAND = 0, 1
+KINDS = {PRODUCT: "product", BRAND: "brand"}
+PUNCTUATION = str.maketrans(string.punctuation, " " * len(string.punctuation))
+
+
+def words(name: str) -> List[str]:
+	return re.findall(r"\w+", name.lower())
+
+
+class PrefixIndex:
+	"""
+	in-memory typeahead index of product and brand names.
+
+	every word of a name is an entry of a sorted array (`keys`, with the packed kind and id of
+	the name in `refs` at the same position), so "mil" finds "Peak Milk" with two bisects and
+	a short scan. words are interned, which keeps an entry at about 16 bytes
+	"""
+
+	def __init__(self):
+		self.keys: List[str] = []
+		self.refs = array("q")
+		self.names = dict()
+
+	@staticmethod
+	def ref(kind: int, id: int) -> int:
+		return id * 2 + kind
+
+	def __len__(self):
+		return len(self.names)
+
+	def load(self, entries: Iterable[Tuple[int, int, str]]):
+		"""replaces the index with (kind, id, name) entries"""
+		names = dict()
+		postings = defaultdict(lambda: array("q"))
+		for kind, id, name in entries:
+			ref = self.ref(kind, id)
+			names[ref] = name
+			for word in set(words(name)):
+				postings[word].append(ref)
+		keys, refs = [], array("q")
+		for word in sorted(postings):
+			word_refs = sorted(postings.pop(word))
+			keys.extend([intern(word)] * len(word_refs))
+			refs.extend(word_refs)
+		self.keys, self.refs, self.names = keys, refs, names
+
+	def add(self, kind: int, id: int, name: str):
+		self.remove(kind, id)
+		ref = self.ref(kind, id)
+		self.names[ref] = name
+		for word in set(words(name)):
+			lo = bisect.bisect_left(self.keys, word)
+			hi = bisect.bisect_right(self.keys, word, lo)
+			position = bisect.bisect_left(self.refs, ref, lo, hi)
+			self.keys.insert(position, intern(word))
+			self.refs.insert(position, ref)
+
+	def remove(self, kind: int, id: int):
+		ref = self.ref(kind, id)
+		name = self.names.pop(ref, None)
+		if name is None:
+			return
+		for word in set(words(name)):
+			lo = bisect.bisect_left(self.keys, word)
+			hi = bisect.bisect_right(self.keys, word, lo)
+			position = bisect.bisect_left(self.refs, ref, lo, hi)
+			if position < hi and self.refs[position] == ref:
+				del self.keys[position]
+				del self.refs[position]
+
+	def prefix_range(self, prefix: str) -> Tuple[int, int]:
+		return bisect.bisect_left(self.keys, prefix), bisect.bisect_left(self.keys, prefix + "\uffff")
+
+	def search(self, query: str, limit: int = 10, max_scan: int = 5000) -> List[dict]:
+		"""
+		names having a word starting with each word of the query. candidates come from the
+		query word with the fewest entries, at most max_scan of them are checked. they are
+		matched against the other query words through those words' refs, or through the name
+		when a word is too common for its refs to be collected cheaply
+		"""
+		tokens = words(query)
+		if not tokens:
+			return []
+		ranges = sorted(((token, self.prefix_range(token)) for token in tokens[:8]),
+		                key=lambda item: item[1][1] - item[1][0])
+		(_, (lo, hi)), others = ranges[0], ranges[1:]
+		hi = min(hi, lo + max_scan)
+		candidates = None
+		for _, (other_lo, other_hi) in others:
+			if other_hi - other_lo <= max_scan * 10:
+				if candidates is None:
+					candidates = set(self.refs[lo:hi])
+				candidates.intersection_update(self.refs[other_lo:other_hi])
+		spelled = [f" {token}" for token, (other_lo, other_hi) in others if other_hi - other_lo > max_scan * 10]
+		results, seen = [], set()
+		for position in range(lo, hi):
+			ref = self.refs[position]
+			if ref in seen or (candidates is not None and ref not in candidates):
+				continue
+			seen.add(ref)
+			name = self.names[ref]
+			if spelled:
+				spaced = " " + name.lower().translate(PUNCTUATION)
+				if not all(token in spaced for token in spelled):
+					continue
+			results.append({"id": ref // 2, "name": name, "type": KINDS[ref % 2]})
+			if len(results) == limit:
+				break
+		return results
+
+
+suggestion_index = PrefixIndex()
+
+
+async def fetch_names():
+	entries = []
+	async with AsyncSessionLocal() as db:
+		for kind, model in ((PRODUCT, models.Product), (BRAND, models.Brand)):
+			result = await db.stream(select(model.id, model.name).execution_options(yield_per=10000))
+			async for partition in result.partitions():
+				entries.extend((kind, id, name) for id, name in partition)
+	return entries
+
+
+async def build_suggestion_index():
+	entries = await fetch_names()
+	# building is cpu bound, keep the event loop serving requests meanwhile
+	index = PrefixIndex()
+	await asyncio.to_thread(index.load, entries)
+	suggestion_index.keys, suggestion_index.refs, suggestion_index.names = index.keys, index.refs, index.names
+	logging.info(f"suggestion index built with {len(suggestion_index)} names")
+
+
+async def refresh_suggestion_index():
+	# signals only reach the worker that made the change, rebuilding catches up with the others
+	while True:
+		await asyncio.sleep(settings.SUGGEST_REFRESH_INTERVAL)
+		try:
+			await build_suggestion_index()
+		except Exception as e:
+			logging.critical(e)
@@ -0,0 +1,101 @@
+"""
+Publishing websocket events from application code.
+
+In the web process the app attaches its event loop and ConnectionManager at startup, and
+events go straight to the manager (which forwards them to the other workers over the channel
+bus), from the loop itself or from any thread. Elsewhere, e.g. in celery workers, events are
+published to the channel bus over one pooled redis connection. Either way there is no
+handshake or token per event.
+"""
+import asyncio
+import logging
+import threading
+import uuid
+from typing import List, Optional
+
+import settings
+from services.channel_bus import encode_batch
+
+
+class Publisher:
+
+	def __init__(self):
+		self.loop: Optional[asyncio.AbstractEventLoop] = None
+		self.manager = None
+		self.node = f"publisher-{uuid.uuid4().hex}"
+		self.lock = threading.Lock()
+		self.redis = None
+		self.async_redis = None
+
+	def attach(self, loop: asyncio.AbstractEventLoop, manager):
+		self.loop = loop
+		self.manager = manager
+
+	def detach(self):
+		self.loop = None
+		self.manager = None
+
+	@staticmethod
+	def message(channel: str, event: str, data: dict, sender: int = None) -> dict:
+		return dict(channel=channel, event=event, data=data, sender=sender)
+
+	def in_process(self) -> bool:
+		return self.loop is not None and not self.loop.is_closed()
+
+	def on_loop(self) -> bool:
+		try:
+			return asyncio.get_running_loop() is self.loop
+		except RuntimeError:
+			return False
+
+	def publish(self, channel: str, event: str, data: dict, sender: int = None):
+		"""sends an event from sync code, without blocking when called inside the web process"""
+		self.publish_many([self.message(channel, event, data, sender)])
+
+	def publish_many(self, messages: List[dict]):
+		if self.in_process():
+			if self.on_loop():
+				self.deliver(messages)
+			else:
+				self.loop.call_soon_threadsafe(self.deliver, messages)
+			return
+		try:
+			self.sync_client().publish(settings.WS_BUS_CHANNEL, self.batch(messages))
+		except Exception as e:
+			logging.error(f"websocket publisher dropped {len(messages)} events: {e}")
+
+	async def publish_async(self, channel: str, event: str, data: dict, sender: int = None):
+		"""sends an event from async code"""
+		await self.publish_many_async([self.message(channel, event, data, sender)])
+
+	async def publish_many_async(self, messages: List[dict]):
+		if self.in_process():
+			return self.publish_many(messages)
+		try:
+			await self.async_client().publish(settings.WS_BUS_CHANNEL, self.batch(messages))
+		except Exception as e:
+			logging.error(f"websocket publisher dropped {len(messages)} events: {e}")
+
+	def deliver(self, messages: List[dict]):
+		for message in messages:
+			self.manager.publish(message["channel"], message)
+
+	def batch(self, messages: List[dict]) -> str:
+		return encode_batch(self.node, [(message["channel"], message) for message in messages])
+
+	def sync_client(self):
+		with self.lock:
+			if self.redis is None:
+				import redis
+				self.redis = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=settings.REDIS_TIMEOUT,
+				                                  socket_connect_timeout=settings.REDIS_TIMEOUT)
+			return self.redis
+
+	def async_client(self):
+		if self.async_redis is None:
+			from services.redis_client import redis_client
+			self.async_redis = redis_client
+		return self.async_redis
+
+
+publisher = Publisher()
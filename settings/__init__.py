@@ -10,6 +10,41 @@ SECRET_KEY = config("SECRET_KEY")
 ALLOWED_HOSTS = ["localhost"]
 
 DATABASE_URL = config("DATABASE_URL")
+ASYNC_DATABASE_URL = config("ASYNC_DATABASE_URL", default="")
+DATABASE_POOL_SIZE = config("DATABASE_POOL_SIZE", default=10, cast=int)
+DATABASE_MAX_OVERFLOW = config("DATABASE_MAX_OVERFLOW", default=20, cast=int)
+
+# exact | estimated | cached, see helpers.response.CountStrategy
+DEFAULT_COUNT_STRATEGY = config("DEFAULT_COUNT_STRATEGY", default="exact")
+COUNT_CACHE_TTL = config("COUNT_CACHE_TTL", default=30, cast=int)
+COUNT_CACHE_SIZE = config("COUNT_CACHE_SIZE", default=1024, cast=int)
+# per worker cache of brand and inventory reads, cleared on writes through this worker.
+# writes through other workers show after at most REFERENCE_CACHE_TTL seconds
+REFERENCE_CACHE_TTL = config("REFERENCE_CACHE_TTL", default=60, cast=int)
+REFERENCE_CACHE_SIZE = config("REFERENCE_CACHE_SIZE", default=2048, cast=int)
+
+# view | table, see read_models.py
+READ_MODEL_MODE = config("READ_MODEL_MODE", default="view")
+
+# text search configuration of the generated search_vector columns
+SEARCH_CONFIG = config("SEARCH_CONFIG", default="simple")
+# how many of the most relevant product matches can be paged, 0 pages all of them
+SEARCH_CANDIDATES = config("SEARCH_CANDIDATES", default=1000, cast=int)
+SEARCH_MIN_PREFIX = config("SEARCH_MIN_PREFIX", default=3, cast=int)
+
+# seconds between rebuilds of the in-memory typeahead index, 0 disables them
+SUGGEST_REFRESH_INTERVAL = config("SUGGEST_REFRESH_INTERVAL", default=300, cast=int)
+
+REDIS_URL = config("REDIS_URL", default="redis://localhost:6379/0")
+REDIS_MAX_CONNECTIONS = config("REDIS_MAX_CONNECTIONS", default=50, cast=int)
+REDIS_TIMEOUT = config("REDIS_TIMEOUT", default=0.5, cast=float)
+
+# redis | memory, see services/cache.py. memory is per process and meant for tests
+DETAIL_CACHE_BACKEND = config("DETAIL_CACHE_BACKEND", default="redis")
+DETAIL_CACHE_TTL = config("DETAIL_CACHE_TTL", default=300, cast=int)
+DETAIL_CACHE_SIZE = config("DETAIL_CACHE_SIZE", default=10000, cast=int)
+# seconds an invalidated key is not cached again, longer than a detail read takes
+DETAIL_CACHE_TOMBSTONE_TTL = config("DETAIL_CACHE_TOMBSTONE_TTL", default=10, cast=int)
 
 CORS_ORIGINS = [
 	"http://localhost.tiangolo.com",
@@ -26,6 +61,78 @@ JWT_ALGORITHM = "HS256"
 JWT_ACCESS_TOKEN_EXPIRY = 60 * 24 * 1
 JWT_REFRESH_TOKEN_EXPIRY = 60 * 24 * 3
 JWT_ISSUER = "sales-app"
+# verified access tokens kept per worker
+JWT_CACHE_SIZE = config("JWT_CACHE_SIZE", default=10000, cast=int)
+
+# messages queued per websocket connection before the slow consumer policy applies:
+# coalesce (keep the newest message per channel and event) | disconnect
+WS_QUEUE_SIZE = config("WS_QUEUE_SIZE", default=100, cast=int)
+WS_SLOW_CONSUMER_POLICY = config("WS_SLOW_CONSUMER_POLICY", default="coalesce")
+WS_CLOSE_TIMEOUT = config("WS_CLOSE_TIMEOUT", default=1, cast=float)
+# clients connected with ?heartbeat=1 are sent {"event": "ping"} every WS_HEARTBEAT_INTERVAL seconds
+# and dropped when they sent nothing (a {"event": "pong"} will do) for WS_IDLE_TIMEOUT seconds, 0
+# disables either. dead sockets of the others are found by uvicorn's protocol level pings, see
+# --ws-ping-interval and --ws-ping-timeout
+WS_HEARTBEAT_INTERVAL = config("WS_HEARTBEAT_INTERVAL", default=25, cast=float)
+WS_IDLE_TIMEOUT = config("WS_IDLE_TIMEOUT", default=90, cast=float)
+# bounds of the batching interval clients can ask for with ?batch_ms=
+WS_BATCH_MIN_MS = config("WS_BATCH_MIN_MS", default=10, cast=int)
+WS_BATCH_MAX_MS = config("WS_BATCH_MAX_MS", default=1000, cast=int)
+# redis | memory | none, see services/channel_bus.py. none keeps messages on the worker
+WS_BUS_BACKEND = config("WS_BUS_BACKEND", default="redis")
+WS_BUS_CHANNEL = config("WS_BUS_CHANNEL", default="ws:bus")
+WS_BUS_FLUSH_INTERVAL = config("WS_BUS_FLUSH_INTERVAL", default=0.01, cast=float)
+WS_BUS_BATCH_SIZE = config("WS_BUS_BATCH_SIZE", default=500, cast=int)
+
+# the rabbitmq publisher keeps at most RABBIT_MQ_MAX_UNCONFIRMED messages awaiting the broker's
+# confirm, publish waits RABBIT_MQ_CONFIRM_TIMEOUT seconds for one
+RABBIT_MQ_MAX_UNCONFIRMED = config("RABBIT_MQ_MAX_UNCONFIRMED", default=1000, cast=int)
+RABBIT_MQ_CONFIRM_TIMEOUT = config("RABBIT_MQ_CONFIRM_TIMEOUT", default=5, cast=float)
+RABBIT_MQ_RECONNECT_DELAY = config("RABBIT_MQ_RECONNECT_DELAY", default=1, cast=float)
+# each consumer has up to RABBIT_MQ_PREFETCH unacknowledged deliveries, handled by RABBIT_MQ_WORKERS
+# threads. finished deliveries are acked together, at the latest after RABBIT_MQ_ACK_INTERVAL seconds
+RABBIT_MQ_PREFETCH = config("RABBIT_MQ_PREFETCH", default=50, cast=int)
+RABBIT_MQ_WORKERS = config("RABBIT_MQ_WORKERS", default=4, cast=int)
+RABBIT_MQ_ACK_INTERVAL = config("RABBIT_MQ_ACK_INTERVAL", default=0.05, cast=float)
+# a message whose handler failed RABBIT_MQ_MAX_ATTEMPTS times goes to <queue>.dead, bound to this exchange
+RABBIT_MQ_MAX_ATTEMPTS = config("RABBIT_MQ_MAX_ATTEMPTS", default=5, cast=int)
+RABBIT_MQ_DEAD_LETTER_EXCHANGE = config("RABBIT_MQ_DEAD_LETTER_EXCHANGE", default="sales_app.dead")
+# inventory_queue events are applied INVENTORY_BATCH_SIZE at a time, or as many as arrived within
+# INVENTORY_BATCH_WINDOW seconds
+INVENTORY_BATCH_SIZE = config("INVENTORY_BATCH_SIZE", default=100, cast=int)
+INVENTORY_BATCH_WINDOW = config("INVENTORY_BATCH_WINDOW", default=0.05, cast=float)
+# ids of applied inventory events are kept this long to spot redeliveries, keep it above the longest a
+# message can be held back (publisher spools, retries) before it comes round again. pruned hourly
+PROCESSED_MESSAGES_RETENTION_HOURS = config("PROCESSED_MESSAGES_RETENTION_HOURS", default=7 * 24, cast=int)
+PROCESSED_MESSAGES_PRUNE_BATCH = config("PROCESSED_MESSAGES_PRUNE_BATCH", default=10000, cast=int)
+
+# the outbox relay publishes up to OUTBOX_BATCH_SIZE events at a time, right after a commit that
+# recorded some and every OUTBOX_POLL_INTERVAL seconds
+OUTBOX_BATCH_SIZE = config("OUTBOX_BATCH_SIZE", default=500, cast=int)
+OUTBOX_POLL_INTERVAL = config("OUTBOX_POLL_INTERVAL", default=5, cast=float)
+
+# a dependency's circuit opens after BREAKER_FAILURE_THRESHOLD failures in a row and lets a trial
+# call through after BREAKER_RESET_TIMEOUT seconds
+BREAKER_FAILURE_THRESHOLD = config("BREAKER_FAILURE_THRESHOLD", default=3, cast=int)
+BREAKER_RESET_TIMEOUT = config("BREAKER_RESET_TIMEOUT", default=30, cast=float)
+# messages and uploads for an unavailable broker or s3 wait in SPOOL_PATH/<name>, at most
+# SPOOL_MAX_BYTES per spool, and are replayed every SPOOL_REPLAY_INTERVAL seconds
+SPOOL_PATH = config("SPOOL_PATH", default=os.path.join(os.path.abspath(""), "spool"))
+SPOOL_MAX_BYTES = config("SPOOL_MAX_BYTES", default=512 * 1024 * 1024, cast=int)
+SPOOL_REPLAY_INTERVAL = config("SPOOL_REPLAY_INTERVAL", default=5, cast=float)
+S3_TIMEOUT = config("S3_TIMEOUT", default=2, cast=float)
+# the s3 client is shared by the process and keeps up to S3_MAX_POOL_CONNECTIONS connections.
+# files from S3_MULTIPART_THRESHOLD bytes on are uploaded in S3_MULTIPART_CHUNKSIZE parts,
+# S3_MULTIPART_CONCURRENCY at a time
+S3_MAX_POOL_CONNECTIONS = config("S3_MAX_POOL_CONNECTIONS", default=50, cast=int)
+S3_MULTIPART_THRESHOLD = config("S3_MULTIPART_THRESHOLD", default=8 * 1024 * 1024, cast=int)
+S3_MULTIPART_CHUNKSIZE = config("S3_MULTIPART_CHUNKSIZE", default=8 * 1024 * 1024, cast=int)
+S3_MULTIPART_CONCURRENCY = config("S3_MULTIPART_CONCURRENCY", default=4, cast=int)
+
+# deferred signal receivers (file deletes, logging) run after the commit on SIGNAL_WORKERS
+# background tasks, commits wait once SIGNAL_QUEUE_SIZE calls are queued
+SIGNAL_WORKERS = config("SIGNAL_WORKERS", default=4, cast=int)
+SIGNAL_QUEUE_SIZE = config("SIGNAL_QUEUE_SIZE", default=1000, cast=int)
 
 CELERY_BROKER = "redis://localhost:6379/0"
 CELERY_BACKEND = "redis://localhost:6379/0"
@@ -40,5 +147,17 @@ MEDIA_URL = os.path.join(BASE_URL, MEDIA_PATH)
 AWS_S3_BUCKET_NAME = ""
 AWS_SECRET_KEY = ""
 AWS_ACCESS_KEY = ""
+# an s3 compatible stand-in (minio, moto server), None is aws
+AWS_S3_ENDPOINT_URL = config("AWS_S3_ENDPOINT_URL", default=None)
 
 UPLOAD_TYPE = "file"
+# uploaded images are copied to storage UPLOAD_CHUNK_SIZE bytes at a time, on at most
+# UPLOAD_WORKERS threads per process
+UPLOAD_CHUNK_SIZE = config("UPLOAD_CHUNK_SIZE", default=1024 * 1024, cast=int)
+UPLOAD_WORKERS = config("UPLOAD_WORKERS", default=8, cast=int)
+# product images get WebP variants (name:pixels on the longer side) of IMAGE_WEBP_QUALITY,
+# rendered on IMAGE_WORKERS processes
+IMAGE_VARIANTS = config("IMAGE_VARIANTS", default="thumbnail:320,medium:1024",
+                        cast=lambda value: {name: int(size) for name, size in (item.split(":") for item in value.split(","))})
+IMAGE_WEBP_QUALITY = config("IMAGE_WEBP_QUALITY", default=80, cast=int)
+IMAGE_WORKERS = config("IMAGE_WORKERS", default=2, cast=int)
@@ -17,9 +17,20 @@ celery = Celery(
 
 @celery.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
-	from tasks import my_periodic_task
+	from tasks import my_periodic_task, prune_processed_message_ids, prune_table_change_rows
 	sender.add_periodic_task(
 		crontab(minute="*"),
 		my_periodic_task.s(),
 		name="my_periodic_task",
 	)
+	sender.add_periodic_task(
+		crontab(minute=0),
+		prune_processed_message_ids.s(),
+		name="prune_processed_message_ids",
+	)
+	# the versions of the list endpoints count these rows, keep them few
+	sender.add_periodic_task(
+		crontab(minute="*/5"),
+		prune_table_change_rows.s(),
+		name="prune_table_change_rows",
+	)
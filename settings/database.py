@@ -1,31 +1,99 @@
+import logging
+
 from decouple import config
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateColumn
 
 import settings
 
 SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL
+ASYNC_SQLALCHEMY_DATABASE_URL = settings.ASYNC_DATABASE_URL or \
+                                make_url(SQLALCHEMY_DATABASE_URL).set(drivername="postgresql+asyncpg")
 
+# the sync engine is kept for DDL and for code running outside the event loop (celery, rabbitmq threads)
 engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, echo=True,
+                                   pool_size=settings.DATABASE_POOL_SIZE,
+                                   max_overflow=settings.DATABASE_MAX_OVERFLOW,
+                                   pool_pre_ping=True)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession,
+                                       autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 
 def create_db():
 	with engine.begin() as conn:
-		from models import Product, ProductFile, Brand, Inventory, Staff, Customer, Order
+		from models import Product, ProductFile, Brand, Inventory, Staff, Customer, Order, ProcessedMessage, OutboxEvent, Blob
+		from read_models import create_read_models
+		from versions import create_table_versions
 		Base.metadata.create_all(bind=conn)
+		create_added_columns(conn)
+		create_added_indexes(conn)
+		create_unique_constraints(conn)
+		create_search_columns(conn)
+		create_read_models(conn)
+		create_table_versions(conn)
 	engine.dispose()
 
 
-def get_db():
-	db = SessionLocal()
-	try:
+def create_added_columns(conn):
+	# create_all skips existing tables, so add nullable columns introduced after a table was created
+	for table in Base.metadata.sorted_tables:
+		existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+		for column in table.c:
+			if column.name in existing or not column.nullable or column.name == "search_vector":
+				continue
+			definition = CreateColumn(column).compile(dialect=conn.dialect)
+			conn.exec_driver_sql(f"alter table {table.name} add column if not exists {definition}")
+
+
+def create_added_indexes(conn):
+	# create_all skips existing tables, so add indexes declared after a table was created
+	for table in Base.metadata.sorted_tables:
+		for index in table.indexes:
+			if all(column.name != "search_vector" for column in index.columns):
+				index.create(bind=conn, checkfirst=True)
+
+
+def create_unique_constraints(conn):
+	# create_all skips existing tables, so add unique constraints of columns made unique later
+	for table in Base.metadata.sorted_tables:
+		constraints = inspect(conn).get_unique_constraints(table.name)
+		unique = {tuple(constraint["column_names"]) for constraint in constraints}
+		unique |= {tuple(index["column_names"]) for index in inspect(conn).get_indexes(table.name) if index["unique"]}
+		for column in table.c:
+			if not column.unique or (column.name,) in unique:
+				continue
+			try:
+				with conn.begin_nested():
+					conn.exec_driver_sql(f"alter table {table.name} add constraint {table.name}_{column.name}_key "
+					                     f"unique ({column.name})")
+			except IntegrityError as e:
+				logging.error(f"{table.name}.{column.name} holds duplicates and stays without its unique constraint: {e.orig}")
+
+
+def create_search_columns(conn):
+	# create_all skips existing tables, so add search columns introduced after a table was created
+	for table in Base.metadata.sorted_tables:
+		if "search_vector" not in table.c:
+			continue
+		column = CreateColumn(table.c.search_vector).compile(dialect=conn.dialect)
+		conn.exec_driver_sql(f"alter table {table.name} add column if not exists {column}")
+		for index in table.indexes:
+			index.create(bind=conn, checkfirst=True)
+
+
+async def get_db():
+	async with AsyncSessionLocal() as db:
 		yield db
-	finally:
-		db.close()
 
 
 Base.metadata.create_all(bind=engine)
@@ -1,4 +1,6 @@
 # main.py
+import hashlib
+import time
 from datetime import datetime, timedelta
 
 from fastapi import Depends, HTTPException, status
@@ -7,6 +9,7 @@ from jose import JWTError, jwt
 from starlette.requests import Request
 
 import settings
+from helpers.cache import TTLCache
 from schemas.inventory import Inventory
 from schemas.users import UserBase, UserType
 
@@ -17,6 +20,9 @@ REFRESH_TOKEN_EXPIRE_MINUTES = settings.JWT_REFRESH_TOKEN_EXPIRY
 JWT_SECRET = settings.JWT_SECRET_KEY
 JWT_ISSUER = settings.JWT_ISSUER
 
+# users of verified access tokens by sha256 of the token, each kept until its token expires
+verified_tokens = TTLCache(maxsize=settings.JWT_CACHE_SIZE)
+
 
 # Function to create JWT token
 
@@ -51,7 +57,7 @@ def convert_payload_to_base_model(payload:dict):
 	elif user_type == UserType.STAFF:
 		payload["staff_id"] = payload["id"]
 		payload["id"] = payload.pop("user_id")
-	elif payload["user_type"] == UserType.CUSTOMER:
+	elif user_type == UserType.CUSTOMER:
 		payload["customer_id"] = payload["id"]
 		payload["id"] = payload.pop("user_id")
 	else:
@@ -81,7 +87,12 @@ def create_refresh_token(user: Inventory, expires_delta: int = None) -> str:
 
 
 # Function to decode JWT token
-def decode_access_token(token: str):
+def decode_access_token(token: str) -> UserBase:
+	"""the user of a valid access token. the returned UserBase is shared by every request with that token"""
+	key = hashlib.sha256(token.encode()).digest()
+	user = verified_tokens.get(key)
+	if user is not None:
+		return user
 	error = dict(
 		status_code=status.HTTP_401_UNAUTHORIZED,
 		detail="Could not validate credentials",
@@ -91,7 +102,9 @@ def decode_access_token(token: str):
 		if datetime.utcnow().__ge__(datetime.fromtimestamp(payload['exp'])):
 			error['detail'] = "Expired access token"
 			raise HTTPException(**error)
-		return convert_payload_to_base_model(payload['user'])
+		user = convert_payload_to_base_model(payload['user'])
+		verified_tokens.set(key, user, ttl=payload['exp'] - time.time())
+		return user
 	except JWTError as e:
 		print(e)
 		raise HTTPException(**error)
@@ -144,6 +157,13 @@ class JWTBearer(HTTPBearer):
 oauth2_scheme = JWTBearer()
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+	# JWTBearer verified the token a moment ago, this is a cache hit and needs no thread
 	payload = decode_access_token(token)
-	return payload
\ No newline at end of file
+	return payload
+
+async def get_staff_user(user: UserBase = Depends(get_current_user)):
+	# operational endpoints, customers have no business there
+	if user.staff_id is None and user.admin_id is None:
+		raise HTTPException(status_code=403, detail="Only staff and admins can access this")
+	return user
@@ -1,14 +1,167 @@
+"""
+Model signals sent by the repositories.
+
+Receivers of a signal run concurrently and the send returns once they all did. Receivers the
+response does not depend on (file deletes, logging) are connected with deferred=True and run
+on background tasks after the commit instead, a failing one is logged. Receivers of signals sent
+inside the transaction (pre_save, pre_delete) wait for the repository's commit and are dropped
+when the transaction rolls back. The bulk signals are sent once for a batch of instances of a
+model, with the model as sender and the batch as `instances`.
+"""
+import asyncio
 import logging
+from functools import partial
+from typing import List, Optional
 
 from async_signals import Signal
+from async_signals.dispatcher import _make_id, NONE_ID
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_object_session
+from sqlalchemy.orm import Session, object_session
 
-from models import Product, ProductFile
+import settings
+from models import Product, ProductFile, Brand, Inventory
+from services import blobs
+from services.cache import detail_cache
+from services.images import generate_variants
+from services.suggestions import suggestion_index, PRODUCT, BRAND
 from settings.database import Base
 
+
+class SignalTasks:
+	"""
+	queue of deferred receiver calls worked off by background tasks on the event loop. until
+	start() (scripts, tests) calls run where they are queued
+	"""
+
+	def __init__(self, workers: int = None, maxsize: int = None):
+		self.workers = workers or settings.SIGNAL_WORKERS
+		self.maxsize = maxsize or settings.SIGNAL_QUEUE_SIZE
+		self.queue: Optional[asyncio.Queue] = None
+		self.tasks: List[asyncio.Task] = []
+
+	@staticmethod
+	def hold(session: Session, call: partial):
+		session.info.setdefault("deferred_signals", []).append(call)
+
+	@staticmethod
+	def drop(session: Session):
+		session.info.pop("deferred_signals", None)
+
+	async def release(self, session):
+		"""queues the calls held for a session, once it committed"""
+		for call in session.info.pop("deferred_signals", ()):
+			await self.submit(call)
+
+	async def submit(self, call: partial):
+		if self.tasks:
+			await self.queue.put(call)
+		else:
+			await self.run(call)
+
+	@staticmethod
+	async def run(call: partial):
+		try:
+			await call()
+		except Exception:
+			receiver = call.keywords["receiver"]
+			logging.exception(f"deferred signal receiver {getattr(receiver, '__name__', receiver)} failed")
+
+	async def work(self):
+		while True:
+			call = await self.queue.get()
+			try:
+				await self.run(call)
+			finally:
+				self.queue.task_done()
+
+	def start(self):
+		self.queue = asyncio.Queue(maxsize=self.maxsize)
+		self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+	async def stop(self, timeout: float = 10):
+		"""lets the queued calls finish for up to timeout seconds"""
+		if not self.tasks:
+			return
+		try:
+			await asyncio.wait_for(self.queue.join(), timeout)
+		except asyncio.TimeoutError:
+			logging.error(f"{self.queue.qsize()} deferred signal receivers did not run")
+		for task in self.tasks:
+			task.cancel()
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+
+
+signal_tasks = SignalTasks()
+# a rolled back transaction takes the receivers it deferred with it
+event.listen(Session, "after_rollback", signal_tasks.drop)
+
+
+class ModelSignal(Signal):
+	"""
+	receivers are connected to a model class while repositories send the instance,
+	so match receivers on the class of the instance. in_transaction signals are sent
+	before the commit, their deferred receivers wait for it. deferral is kept per
+	receiver and sender, a receiver connected to a sender both ways runs before the
+	commit and once more after it
+	"""
+
+	def __init__(self, in_transaction: bool = False, **kwargs):
+		super().__init__(**kwargs)
+		self.in_transaction = in_transaction
+		self.immediate = set()
+		self.deferred = set()
+
+	def connect(self, receiver, sender=None, weak=True, dispatch_uid=None, deferred: bool = False):
+		super().connect(receiver, sender, weak=weak, dispatch_uid=dispatch_uid)
+		(self.deferred if deferred else self.immediate).add((_make_id(receiver), _make_id(sender)))
+
+	def disconnect(self, receiver=None, sender=None, dispatch_uid=None) -> bool:
+		key = (_make_id(receiver), _make_id(sender))
+		self.immediate.discard(key)
+		self.deferred.discard(key)
+		return super().disconnect(receiver, sender, dispatch_uid=dispatch_uid)
+
+	@staticmethod
+	def model_of(sender):
+		return type(sender) if isinstance(sender, Base) else sender
+
+	def _live_receivers(self, sender):
+		return super()._live_receivers(self.model_of(sender))
+
+	def connected(self, connections: set, receiver, sender) -> bool:
+		receiver = _make_id(receiver)
+		return (receiver, _make_id(self.model_of(sender))) in connections or (receiver, NONE_ID) in connections
+
+	async def send(self, sender, **named) -> list:
+		receivers = self._live_receivers(sender)
+		immediate = [receiver for receiver in receivers if self.connected(self.immediate, receiver, sender)]
+		for receiver in receivers:
+			if self.connected(self.deferred, receiver, sender):
+				await self.defer(partial(self._call_receiver, receiver=receiver, signal=self, sender=sender, **named))
+		responses = await asyncio.gather(*[self._call_receiver(receiver=receiver, signal=self, sender=sender, **named)
+		                                   for receiver in immediate])
+		return list(zip(immediate, responses))
+
+	async def defer(self, call: partial):
+		session = None
+		if self.in_transaction:
+			instances = call.keywords.get("instances") or [call.keywords["sender"]]
+			session = object_session(instances[0]) if isinstance(instances[0], Base) else None
+		if session is not None:
+			signal_tasks.hold(session, call)
+		else:
+			await signal_tasks.submit(call)
+
+
 # Create a signal
-post_save = Signal()
-pre_save = Signal()
-pre_delete = Signal()
+post_save = ModelSignal()
+pre_save = ModelSignal(in_transaction=True)
+pre_delete = ModelSignal(in_transaction=True)
+# sent once for a batch, receivers take the model as sender and the batch as `instances`
+post_bulk_save = ModelSignal()
+pre_bulk_delete = ModelSignal(in_transaction=True)
 
 
 async def create_profile(sender: Product, created: bool, *args, **kwargs):
@@ -17,12 +170,79 @@ async def create_profile(sender: Product, created: bool, *args, **kwargs):
 	logging.critical("Signal received!")
 
 
+async def release_product_files(sender, instances: List[ProductFile] = None, *args, **kwargs):
+	# the stored files are shared by rows with the same content, see services/blobs.py
+	instances = instances or [sender]
+	db = async_object_session(instances[0])
+	if db is not None:
+		await blobs.release(db, instances)
+
+
 async def delete_product_file(sender: ProductFile, *args, **kwargs):
-	sender.delete_file()
+	await blobs.collect([sender])
 	logging.critical("deleted product file")
 
 
-post_save.connect(create_profile, Product)
-pre_delete.connect(delete_product_file, ProductFile)
+async def delete_product_files(sender, instances: List[ProductFile], *args, **kwargs):
+	await blobs.collect(instances)
+	logging.critical(f"deleted {len(instances)} product files")
+
+
+async def index_product_name(sender: Product, *args, **kwargs):
+	suggestion_index.add(PRODUCT, sender.id, sender.name)
+
+
+async def unindex_product_name(sender: Product, *args, **kwargs):
+	suggestion_index.remove(PRODUCT, sender.id)
+
+
+async def index_brand_name(sender: Brand, *args, **kwargs):
+	suggestion_index.add(BRAND, sender.id, sender.name)
+
+
+async def unindex_brand_name(sender: Brand, *args, **kwargs):
+	suggestion_index.remove(BRAND, sender.id)
+
+
+async def invalidate_detail(sender: Base, *args, **kwargs):
+	# detail responses are cached under the table name, see services/cache.py
+	await detail_cache.invalidate(sender.__tablename__, sender.id)
+
+
+async def invalidate_product_detail(sender: ProductFile, *args, **kwargs):
+	await detail_cache.invalidate(Product.__tablename__, sender.product_id)
+
+
+async def generate_product_image_variants(sender, instances: List[ProductFile], created: bool = False, *args, **kwargs):
+	if created:
+		await generate_variants(instances)
+
+
+async def invalidate_product_details(sender, instances: List[ProductFile], *args, **kwargs):
+	for product_id in {instance.product_id for instance in instances}:
+		await detail_cache.invalidate(Product.__tablename__, product_id)
+
+
+post_save.connect(create_profile, Product, deferred=True)
+pre_delete.connect(release_product_files, ProductFile)
+pre_bulk_delete.connect(release_product_files, ProductFile)
+pre_delete.connect(delete_product_file, ProductFile, deferred=True)
+pre_bulk_delete.connect(delete_product_files, ProductFile, deferred=True)
+post_bulk_save.connect(generate_product_image_variants, ProductFile, deferred=True)
+post_save.connect(index_product_name, Product)
+pre_delete.connect(unindex_product_name, Product)
+post_save.connect(index_brand_name, Brand)
+pre_delete.connect(unindex_brand_name, Brand)
+# deleted rows are invalidated before the commit and once more after it
+for model in (Product, Brand, Inventory):
+	post_save.connect(invalidate_detail, model)
+	pre_delete.connect(invalidate_detail, model)
+	pre_delete.connect(invalidate_detail, model, deferred=True)
+post_save.connect(invalidate_product_detail, ProductFile)
+pre_delete.connect(invalidate_product_detail, ProductFile)
+pre_delete.connect(invalidate_product_detail, ProductFile, deferred=True)
+post_bulk_save.connect(invalidate_product_details, ProductFile)
+pre_bulk_delete.connect(invalidate_product_details, ProductFile)
+pre_bulk_delete.connect(invalidate_product_details, ProductFile, deferred=True)
 
 # Send the signal
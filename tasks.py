@@ -1,4 +1,9 @@
+import logging
+
+from services.rabbit_mq_service.inventory_events import prune_processed_messages
 from settings.celery_config import celery
+from settings.database import SessionLocal
+from versions import prune_table_changes
 
 
 @celery.task
@@ -7,4 +12,16 @@ def my_periodic_task():
 
 @celery.task
 def just_comment():
-	print("I have commented o")
\ No newline at end of file
+	print("I have commented o")
+
+
+@celery.task
+def prune_processed_message_ids():
+	with SessionLocal() as db:
+		logging.info(f"pruned {prune_processed_messages(db)} processed message ids")
+
+
+@celery.task
+def prune_table_change_rows():
+	with SessionLocal() as db:
+		logging.info(f"pruned {prune_table_changes(db)} table change rows")
@@ -0,0 +1,119 @@
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import asyncpg
+
+import models
+from repositories.helpers import BaseRepository
+from repositories.products import ProductRepository
+from repositories.sales import SaleRepository
+
+
+class FakeResult:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def scalar_one(self):
+        return self.rows[0]
+
+    def scalars(self):
+        return self
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+    def mappings(self):
+        return self
+
+    def all(self):
+        return self.rows
+
+
+class FakeSession:
+    """an AsyncSession answering each execute with the next of its results, statements are kept"""
+
+    def __init__(self, *results):
+        self.info = {}
+        self.results = list(results)
+        self.statements = []
+        self.commits = 0
+
+    async def execute(self, statement, params=None):
+        self.statements.append((statement, params))
+        return FakeResult(self.results.pop(0) if self.results else [])
+
+    async def commit(self):
+        self.commits += 1
+
+    async def refresh(self, item):
+        pass
+
+
+def compiled(statement):
+    """the sql asyncpg is sent"""
+    return " ".join(str(statement.compile(dialect=asyncpg.dialect())).split())
+
+
+def repository(cls, db, model=None):
+    repo = cls(db)
+    if model is not None:
+        repo.model = model
+    return repo
+
+
+class TestBaseQueries:
+
+    def test_count_drops_the_ordering(self):
+        db = FakeSession([7])
+        repo = repository(BaseRepository, db, models.Brand)
+        assert asyncio.run(repo.count(select(models.Brand).order_by(models.Brand.name))) == 7
+        sql = compiled(db.statements[0][0])
+        assert sql.startswith("SELECT count(*) AS count_1 FROM (SELECT brands.id")
+        assert "ORDER BY" not in sql
+
+    def test_all_returns_a_list(self):
+        brands = [models.Brand(id=1, name="Peak"), models.Brand(id=2, name="Milo")]
+        repo = repository(BaseRepository, FakeSession(brands), models.Brand)
+        assert asyncio.run(repo.all(select(models.Brand))) == brands
+
+    def test_get_and_exists(self):
+        brand = models.Brand(id=4, name="Peak")
+        db = FakeSession([brand], [1])
+        repo = repository(BaseRepository, db, models.Brand)
+        assert asyncio.run(repo.get(4)) is brand
+        assert asyncio.run(repo.get(4, exists=True)) is True
+        assert "WHERE brands.id = $1::INTEGER" in compiled(db.statements[0][0])
+        assert compiled(db.statements[1][0]).startswith("SELECT count(*)")
+
+    def test_get_all_pages(self):
+        db = FakeSession([])
+        repo = repository(BaseRepository, db, models.Brand)
+        asyncio.run(repo.get_all(skip=20, limit=10))
+        assert compiled(db.statements[0][0]).endswith("LIMIT $1::INTEGER OFFSET $2::INTEGER")
+
+
+class TestAnyOfIds:
+
+    def test_filters_bind_lists(self):
+        db = FakeSession([3], [])
+        asyncio.run(ProductRepository(db).get_all(brands=[1, 2], inventories=(5,)))
+        for statement, params in db.statements:
+            assert "brand_id = any(:brand_ids)" in str(statement)
+            assert "inventory_id = any(:inventory_ids)" in str(statement)
+            # asyncpg binds python lists as arrays, tuples would not bind
+            assert params["brand_ids"] == [1, 2] and params["inventory_ids"] == [5]
+
+    def test_removed_orders_are_bound_as_one_array(self):
+        sale = models.Sale(id=9, paid=False)
+        db = FakeSession([sale], [])
+        response = asyncio.run(SaleRepository(db).remove_orders(9, [3, 4]))
+        statement, params = db.statements[1]
+        assert compiled(statement) == "delete from orders where sale_id = $1 and id = any($2)"
+        assert params == {"id": 9, "order_ids": [3, 4]}
+        assert db.commits == 1 and response.status_code == 200
+
+    def test_paid_sales_are_not_touched(self):
+        db = FakeSession([models.Sale(id=9, paid=True)])
+        response = asyncio.run(SaleRepository(db).remove_orders(9, [3]))
+        assert response.status_code == 400 and len(db.statements) == 1 and db.commits == 0
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from types import SimpleNamespace
+
+from sqlalchemy.orm import Session
+from starlette.datastructures import UploadFile
+
+import models
+import services.blobs
+import settings
+from services import blobs
+
+
+class BlobSession:
+    """the blobs table in memory, answering the statements of services/blobs.py"""
+
+    def __init__(self, refcounts=None):
+        self.refcounts = refcounts or dict()
+        self.acquired = []
+        self.info = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, statement, params):
+        if statement is blobs.ACQUIRE:
+            created = self.refcounts.get(params["url"], 0) == 0
+            self.refcounts[params["url"]] = self.refcounts.get(params["url"], 0) + 1
+            self.acquired.append(params["url"])
+            return SimpleNamespace(scalar=lambda: created)
+        if statement is blobs.RELEASE:
+            for url in params["urls"]:
+                if url in self.refcounts:
+                    self.refcounts[url] -= 1
+            return None
+        if statement is blobs.LOCK:
+            rows = [(url, self.refcounts[url]) for url in params["urls"] if url in self.refcounts]
+            return SimpleNamespace(all=lambda: rows)
+        for url in params["urls"]:
+            self.refcounts.pop(url, None)
+
+    async def commit(self):
+        pass
+
+
+def upload(content, filename="packshot.PNG"):
+    file = tempfile.SpooledTemporaryFile()
+    file.write(content)
+    return UploadFile(file, filename=filename)
+
+
+def stored(tmp_path):
+    return sorted(os.listdir(tmp_path / "products"))
+
+
+class TestContentAddressedUploads:
+
+    def test_same_content_is_stored_once(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        packshot = hashlib.sha256(b"packshot").hexdigest()
+        session = BlobSession({models.file_saver.url("products", f"{packshot}.png"): 1})
+        models.file_saver.save("products", f"{packshot}.png", b"packshot")
+        uploads = [upload(b"packshot"), upload(b"label"), upload(b"label", "label.png")]
+        product_files = asyncio.run(blobs.save_uploads(session, uploads, product_id=7))
+        label = hashlib.sha256(b"label").hexdigest()
+        # nothing goes up before the commit
+        assert stored(tmp_path) == [f"{packshot}.png"]
+        asyncio.run(blobs.store_uploads(session))
+        assert [product_file.name for product_file in product_files] == [f"{packshot}.png", f"{label}.png", f"{label}.png"]
+        assert product_files[1].url == product_files[2].url and product_files[0].product_id == 7
+        assert stored(tmp_path) == sorted([f"{packshot}.png", f"{label}.png"])
+        assert session.refcounts[product_files[0].url] == 2 and session.refcounts[product_files[1].url] == 2
+
+
+    def test_a_rollback_uploads_nothing(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        os.makedirs(tmp_path / "products")
+        session = Session()
+        session.begin()
+        session.info[blobs.UPLOADS] = {"label.png": upload(b"label")}
+        session.rollback()
+        asyncio.run(blobs.store_uploads(session))
+        assert stored(tmp_path) == []
+
+
+class SyncBlobSession:
+
+    def __init__(self, session):
+        self.session = session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement, params):
+        return asyncio.run(self.session.execute(statement, params))
+
+    def commit(self):
+        pass
+
+
+class TestReferenceCounting:
+
+    def product_file(self, name, content=b"png", **kwargs):
+        return models.ProductFile(name=name, url=models.file_saver.save("products", name, content), **kwargs)
+
+    def test_files_go_with_their_last_reference(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        shared = self.product_file("shared.png")
+        shared.variants = {"thumbnail": models.file_saver.save("products", "shared_thumbnail.webp", b"webp")}
+        session = BlobSession({shared.url: 2})
+        monkeypatch.setattr(services.blobs, "AsyncSessionLocal", lambda: session)
+
+        asyncio.run(blobs.release(session, [shared]))
+        asyncio.run(blobs.collect([shared]))
+        assert stored(tmp_path) == ["shared.png", "shared_thumbnail.webp"]
+
+        asyncio.run(blobs.release(session, [shared]))
+        asyncio.run(blobs.collect([shared]))
+        assert stored(tmp_path) == [] and session.refcounts == {}
+
+    def test_files_saved_before_content_addressing_are_deleted(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        legacy = self.product_file("prod_image_1700000000.0.png")
+        monkeypatch.setattr(services.blobs, "AsyncSessionLocal", lambda: BlobSession())
+        asyncio.run(blobs.collect([legacy]))
+        assert stored(tmp_path) == []
+
+    def test_spooled_deletes_keep_blobs_referenced_again(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        shared = self.product_file("shared.png")
+        session = BlobSession({shared.url: 1})
+        monkeypatch.setattr(services.blobs, "AsyncSessionLocal", lambda: session)
+        monkeypatch.setattr(services.blobs, "SessionLocal", lambda: SyncBlobSession(session))
+        spooled = []
+
+        def spool(meta, content=b""):
+            spooled.append(meta)
+            return False
+
+        monkeypatch.setattr(models.file_saver, "store", spool)
+        asyncio.run(blobs.release(session, [shared]))
+        asyncio.run(blobs.collect([shared]))
+        # the row stays until the delete really happened
+        assert session.refcounts == {shared.url: 0} and spooled[0]["owners"] == [shared.url]
+
+        # the same content is uploaded again before the replay, it is stored anew and kept
+        assert asyncio.run(session.execute(blobs.ACQUIRE, {"url": shared.url})).scalar()
+        deleted = []
+        blobs.replay_delete(spooled[0]["owners"], spooled[0]["keys"], deleted.extend)
+        assert deleted == [] and session.refcounts == {shared.url: 1}
+
+        asyncio.run(blobs.release(session, [shared]))
+        blobs.replay_delete(spooled[0]["owners"], spooled[0]["keys"], deleted.extend)
+        assert deleted == spooled[0]["keys"] and session.refcounts == {}
+
@@ -0,0 +1,26 @@
+import time
+
+from helpers.cache import TTLCache
+
+
+class TestTTLCache:
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1 and cache.get("c") == 3
+
+    def test_expiry_and_invalidation(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set(("brands", 1), 1)
+        cache.set(("sales", 1), 2)
+        cache.set("short", 3, ttl=0.01)
+        time.sleep(0.02)
+        assert cache.get("short") is None
+        cache.invalidate(lambda key: key[0] == "brands")
+        assert cache.get(("brands", 1)) is None
+        assert cache.get(("sales", 1)) == 2
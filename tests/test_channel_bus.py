@@ -0,0 +1,46 @@
+import asyncio
+
+from services.channel_bus import ChannelBus, MemoryBackend
+
+
+class TestChannelBus:
+
+    def test_batches_reach_the_other_nodes_only(self):
+        async def run():
+            hub, delivered = [], {"a": [], "b": []}
+            a = ChannelBus(MemoryBackend(hub), lambda channel, data: delivered["a"].append((channel, data)),
+                           flush_interval=0.01, batch_size=100)
+            b = ChannelBus(MemoryBackend(hub), lambda channel, data: delivered["b"].append((channel, data)),
+                           flush_interval=0.01, batch_size=100)
+            await a.start()
+            await b.start()
+            published, publish = [], b.backend.publish
+
+            async def counting(payload):
+                published.append(payload)
+                await publish(payload)
+            b.backend.publish = counting
+            for i in range(3):
+                b.publish("user_7", {"event": "order", "i": i})
+            await asyncio.sleep(0.05)
+            assert delivered["a"] == [("user_7", {"event": "order", "i": i}) for i in range(3)]
+            assert delivered["b"] == [] and len(published) == 1
+            await a.stop()
+            await b.stop()
+            assert hub == []
+        asyncio.run(run())
+
+    def test_full_batches_are_sent_early(self):
+        async def run():
+            hub, delivered = [], []
+            receiver = ChannelBus(MemoryBackend(hub), lambda channel, data: delivered.append(data))
+            sender = ChannelBus(MemoryBackend(hub), lambda channel, data: None, flush_interval=60, batch_size=2)
+            await receiver.start()
+            await sender.start()
+            sender.publish("general", {"i": 1})
+            sender.publish("general", {"i": 2})
+            await asyncio.sleep(0.01)
+            assert delivered == [{"i": 1}, {"i": 2}]
+            await sender.stop()
+            await receiver.stop()
+        asyncio.run(run())
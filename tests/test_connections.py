@@ -0,0 +1,201 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import msgpack
+
+import settings
+from consumer import Connection, ConnectionManager, Message, protocol
+from schemas.users import UserBase
+
+
+class LocalSocket:
+
+    def __init__(self, inbound=()):
+        self.sent = []
+        self.closed = None
+        self.inbound = list(inbound)
+
+    async def receive_json(self):
+        return self.inbound.pop(0)
+
+    async def send_text(self, message):
+        self.sent.append(message)
+
+    async def send_bytes(self, message):
+        self.sent.append(message)
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+def user(id):
+    return UserBase(id=id, first_name="", last_name="", email="", customer_id=id, staff_id=None, admin_id=None)
+
+
+class TestConnectionManager:
+
+    def connect(self, manager, socket, user_id, heartbeat=False):
+        connection = Connection(socket, user(user_id), ["general", f"user_{user_id}"], heartbeat=heartbeat,
+                                on_failure=manager.evict)
+        connection.writer = asyncio.create_task(connection.write())
+        manager.users.setdefault(user_id, set()).add(connection)
+        for channel in connection.channels:
+            manager.channels.setdefault(channel, set()).add(connection)
+        return connection
+
+    def test_every_socket_of_a_user_gets_its_messages(self):
+        async def run():
+            manager, phone, laptop, other = ConnectionManager(), LocalSocket(), LocalSocket(), LocalSocket()
+            first = self.connect(manager, phone, 1)
+            self.connect(manager, laptop, 1)
+            self.connect(manager, other, 2)
+            assert manager.broadcast("user_1", {"channel": "user_1", "event": "order"}) == 2
+            assert manager.broadcast("general", {"channel": "general", "event": "stock"}) == 3
+            await asyncio.sleep(0)
+            assert len(phone.sent) == len(laptop.sent) == 2 and len(other.sent) == 1
+            await manager.disconnect(first)
+            assert manager.broadcast("user_1", {"channel": "user_1", "event": "order"}) == 1
+        asyncio.run(run())
+
+    def test_slow_consumers_are_coalesced(self, monkeypatch):
+        monkeypatch.setattr(settings, "WS_QUEUE_SIZE", 2)
+        connection = Connection(LocalSocket(), user(1), ["general"])
+        connection.offer(Message("general", {"i": 1}), ("general", "stock"))
+        connection.offer(Message("general", {"i": 2}), ("general", "price"))
+        assert connection.offer(Message("general", {"i": 3}), ("general", "stock"))
+        assert [message.data["i"] for _, message in connection.pending] == [2, 3]
+        assert connection.dropped == 1
+
+    def test_slow_consumers_are_disconnected(self, monkeypatch):
+        monkeypatch.setattr(settings, "WS_QUEUE_SIZE", 1)
+        monkeypatch.setattr(settings, "WS_SLOW_CONSUMER_POLICY", "disconnect")
+
+        async def run():
+            manager, socket = ConnectionManager(), LocalSocket()
+            connection = self.connect(manager, socket, 1)
+            connection.writer.cancel()
+            assert manager.broadcast("general", {"event": "stock"}) == 1
+            assert manager.broadcast("general", {"event": "stock"}) == 0
+            await asyncio.sleep(0.01)
+            assert socket.closed == 1013 and 1 not in manager.users
+        asyncio.run(run())
+
+    def test_batched_msgpack_frames(self):
+        async def run():
+            manager, socket = ConnectionManager(), LocalSocket()
+            connection = Connection(socket, user(1), ["general", "user_1"], encoding="msgpack", batch_interval=0.01)
+            connection.writer = asyncio.create_task(connection.write())
+            for channel in connection.channels:
+                manager.channels.setdefault(channel, set()).add(connection)
+            for i in range(3):
+                manager.broadcast("general", {"event": "stock", "i": i})
+            manager.broadcast("user_1", {"event": "order"})
+            connection.offer(Message.reply("Invalid channel"))
+            await asyncio.sleep(0.05)
+            connection.writer.cancel()
+            return socket.sent
+        sent = asyncio.run(run())
+        assert [msgpack.unpackb(frame) for frame in sent] == [
+            "Invalid channel",
+            {"channels": {"general": [{"event": "stock", "i": i} for i in range(3)], "user_1": [{"event": "order"}]}},
+        ]
+
+    def test_messages_that_cannot_be_encoded_are_skipped(self):
+        async def run():
+            manager, plain, batched = ConnectionManager(), LocalSocket(), LocalSocket()
+            self.connect(manager, plain, 1)
+            connection = self.connect(manager, batched, 2)
+            connection.encoding, connection.batch_interval = "msgpack", 0.01
+            manager.broadcast("general", {"event": "stock", "at": object()})
+            manager.broadcast("general", {"event": "stock", "i": 1})
+            await asyncio.sleep(0.05)
+            assert not connection.writer.done()
+            dropped = [other.dropped for other in manager.connections()]
+            for other in manager.connections():
+                other.writer.cancel()
+            return plain.sent, batched.sent, dropped
+        plain, batched, dropped = asyncio.run(run())
+        assert [json.loads(frame) for frame in plain] == [{"event": "stock", "i": 1}]
+        assert [msgpack.unpackb(frame) for frame in batched] == [{"channels": {"general": [{"event": "stock", "i": 1}]}}]
+        assert dropped == [1, 1]
+
+    def test_connections_that_cannot_be_written_to_are_evicted(self):
+        class ClosedSocket(LocalSocket):
+            async def send_text(self, message):
+                raise RuntimeError("Cannot call \"send\" once a close message has been sent.")
+
+        async def run():
+            manager, socket = ConnectionManager(), ClosedSocket()
+            self.connect(manager, socket, 1)
+            manager.broadcast("general", {"event": "stock"})
+            await asyncio.sleep(0.01)
+            return manager, socket
+        manager, socket = asyncio.run(run())
+        assert socket.closed == 1013 and manager.connections() == [] and manager.channels == {}
+
+    def test_messages_are_encoded_once_per_encoding(self):
+        message = Message("general", {"event": "stock"})
+        assert message.frame("json") is message.frame("json")
+        assert json.loads(message.frame("json")) == msgpack.unpackb(message.frame("msgpack"))
+        assert Message.reply("Invalid channel").frame("json") == "Invalid channel"
+
+    def test_batch_frames_decode_like_encoded_batches(self):
+        from consumer import BATCHERS
+        channels = {"general": [Message("general", {"event": "stock", "i": i}) for i in range(2)],
+                    "user_1": [Message("user_1", {"event": "order"})]}
+        expected = {"channels": {channel: [message.data for message in messages] for channel, messages in channels.items()}}
+        assert json.loads(BATCHERS["json"](channels)) == expected
+        assert msgpack.unpackb(BATCHERS["msgpack"](channels)) == expected
+
+
+class TestHeartbeat:
+
+    def test_idle_connections_are_pinged_then_evicted(self, monkeypatch):
+        monkeypatch.setattr(settings, "WS_HEARTBEAT_INTERVAL", 0.01)
+        monkeypatch.setattr(settings, "WS_IDLE_TIMEOUT", 0.05)
+
+        async def run():
+            manager = ConnectionManager()
+            idle, live, listening = LocalSocket(), LocalSocket(inbound=[{"event": "pong"}] * 20), LocalSocket()
+            connect = TestConnectionManager().connect
+            connect(manager, idle, 1, heartbeat=True)
+            responsive = connect(manager, live, 2, heartbeat=True)
+            # clients that did not opt in are neither pinged nor evicted
+            connect(manager, listening, 3)
+            manager.heartbeat = asyncio.create_task(manager.beat())
+            for _ in range(10):
+                await asyncio.sleep(0.01)
+                await manager.notify(responsive)
+            heartbeat = manager.heartbeat
+            await manager.stop()
+            assert heartbeat.cancelled() and manager.heartbeat is None
+            return manager, idle, live, listening
+        manager, idle, live, listening = asyncio.run(run())
+        assert json.loads(idle.sent[0]) == {"event": "ping"}
+        assert idle.closed == 1001 and 1 not in manager.users
+        assert live.closed is None and 2 in manager.users
+        assert all(json.loads(frame) == {"event": "ping"} for frame in live.sent)
+        assert listening.sent == [] and listening.closed is None and 3 in manager.users
+
+    def test_heartbeats_are_opt_in(self):
+        def socket(**query_params):
+            return SimpleNamespace(query_params=query_params)
+
+        assert protocol(socket())["heartbeat"] is False
+        assert protocol(socket(heartbeat="1"))["heartbeat"] is True
+
+    def test_stats(self):
+        async def run():
+            manager = ConnectionManager()
+            connect = TestConnectionManager().connect
+            for user_id in (1, 1, 2):
+                connect(manager, LocalSocket(), user_id)
+            stats = manager.stats()
+            for connection in manager.connections():
+                connection.writer.cancel()
+            return stats
+        stats = asyncio.run(run())
+        assert stats["connections"] == 3 and stats["users"] == 2
+        assert stats["largest_channels"]["general"] == 3 and stats["largest_channels"]["user_1"] == 2
+        assert stats["estimated_bytes"] == 3 * stats["estimated_bytes_per_connection"] > 0
@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+from pydantic import BaseModel
+
+from services.cache import DetailCache, MemoryBackend
+
+
+class Item(BaseModel):
+    id: int
+    name: str
+    brand_id: int
+
+
+class BrokenBackend:
+
+    async def get(self, key):
+        raise ConnectionError("redis is down")
+
+    async def set(self, key, value, ttl, tags=()):
+        raise ConnectionError("redis is down")
+
+
+class TestDetailCache:
+
+    def fetch(self, cache, id, item, loads, if_none_match=None):
+        async def load():
+            loads.append(id)
+            return item
+        return asyncio.run(cache.fetch("products", id, load, Item, tags=lambda i: [f"brands:{i.brand_id}"],
+                                       if_none_match=if_none_match))
+
+    def test_read_through_and_invalidation(self):
+        cache, loads = DetailCache(MemoryBackend(), ttl=60), []
+        item = Item(id=1, name="Peak Milk", brand_id=3)
+        assert self.fetch(cache, 1, item, loads).headers["X-Cache"] == "MISS"
+        response = self.fetch(cache, 1, item, loads)
+        assert response.headers["X-Cache"] == "HIT"
+        assert response.body == item.model_dump_json().encode()
+        assert loads == [1]
+
+        asyncio.run(cache.invalidate("brands", 3))
+        assert self.fetch(cache, 1, item, loads).headers["X-Cache"] == "MISS"
+        asyncio.run(cache.invalidate("products", 1))
+        self.fetch(cache, 1, item, loads)
+        assert loads == [1, 1, 1]
+        assert cache.stats()["products"] == {"hits": 1, "misses": 3, "errors": 0, "hit_ratio": 0.25}
+
+    def test_missing_items_are_not_cached(self):
+        cache, loads = DetailCache(MemoryBackend(), ttl=60), []
+        assert self.fetch(cache, 2, None, loads) is None
+        assert self.fetch(cache, 2, None, loads) is None
+        assert loads == [2, 2]
+
+    def test_backend_errors_fall_back_to_the_loader(self):
+        cache, loads = DetailCache(BrokenBackend(), ttl=60), []
+        response = self.fetch(cache, 1, Item(id=1, name="Milo", brand_id=1), loads)
+        assert response.status_code == 200 and loads == [1]
+        assert cache.stats()["products"]["errors"] == 2
+
+    def test_etag_of_the_cached_entry(self):
+        cache, loads = DetailCache(MemoryBackend(), ttl=60), []
+        item = Item(id=1, name="Peak Milk", brand_id=3)
+        etag = self.fetch(cache, 1, item, loads).headers["ETag"]
+        response = self.fetch(cache, 1, item, loads, if_none_match=etag)
+        assert response.status_code == 304 and response.body == b""
+        assert response.headers["ETag"] == etag and loads == [1]
+        assert self.fetch(cache, 1, item, loads, if_none_match='"old"').status_code == 200
+
+        asyncio.run(cache.invalidate("products", 1))
+        renamed = self.fetch(cache, 1, Item(id=1, name="Peak Milk Powder", brand_id=3), loads, if_none_match=etag)
+        assert renamed.status_code == 200 and renamed.headers["ETag"] != etag
+
+    def test_a_miss_that_read_before_an_invalidation_is_not_cached(self):
+        cache, loads = DetailCache(MemoryBackend(), ttl=60), []
+        stale = Item(id=1, name="Peak Milk", brand_id=3)
+
+        async def load():
+            # the row is read, then a write commits and invalidates it before the miss stores it
+            loads.append(1)
+            await cache.invalidate("products", 1)
+            return stale
+
+        response = asyncio.run(cache.fetch("products", 1, load, Item))
+        assert response.body == stale.model_dump_json().encode()
+        fresh = Item(id=1, name="Peak Milk Powder", brand_id=3)
+        assert self.fetch(cache, 1, fresh, loads).body == fresh.model_dump_json().encode()
+        assert loads == [1, 1]
+
+    def test_tombstones_of_tags_and_expiry(self):
+        cache, loads = DetailCache(MemoryBackend(tombstone_ttl=0.05), ttl=60), []
+        item = Item(id=1, name="Peak Milk", brand_id=3)
+        asyncio.run(cache.invalidate("brands", 3))
+        self.fetch(cache, 1, item, loads)
+        assert self.fetch(cache, 1, item, loads).headers["X-Cache"] == "MISS"
+        time.sleep(0.06)
+        self.fetch(cache, 1, item, loads)
+        assert self.fetch(cache, 1, item, loads).headers["X-Cache"] == "HIT"
+        assert loads == [1, 1, 1]
@@ -0,0 +1,12 @@
+from helpers.response import etag_matches
+
+
+class TestEtagMatches:
+
+    def test_if_none_match(self):
+        etag = '"abc"'
+        assert etag_matches('"abc"', etag)
+        assert etag_matches('"old", W/"abc"', etag)
+        assert etag_matches("*", etag)
+        assert not etag_matches('"old"', etag)
+        assert not etag_matches(None, etag)
@@ -0,0 +1,117 @@
+import asyncio
+import io
+import os
+from types import SimpleNamespace
+
+from PIL import Image
+
+import models
+import services.blobs
+import services.images
+import settings
+from helpers.images import render_variants
+from schemas.products import ProductImage
+from services.images import generate_variants
+
+
+def picture(size, mode="RGB", format="JPEG", color="red"):
+    output = io.BytesIO()
+    Image.new(mode, size, color).save(output, format)
+    return output.getvalue()
+
+
+class RecordingSession:
+    """update ... returning id for the rows in existing, the stored files have no blobs"""
+
+    def __init__(self, existing, rendered=None):
+        self.existing = existing
+        self.rendered = rendered or dict()
+        self.variants = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, statement, params):
+        if statement is services.images.RENDERED:
+            return SimpleNamespace(all=lambda: [(url, self.rendered[url]) for url in params["urls"] if url in self.rendered])
+        if statement is services.blobs.LOCK:
+            return SimpleNamespace(all=lambda: [])
+        if statement is services.blobs.DELETE or params["id"] not in self.existing:
+            return SimpleNamespace(scalars=lambda: [])
+        self.variants[params["id"]] = params["variants"]
+        return SimpleNamespace(scalars=lambda: [params["id"]])
+
+    async def commit(self):
+        pass
+
+
+class TestRenderVariants:
+
+    def test_variants_are_webp_scaled_to_fit(self):
+        variants = render_variants(picture((2000, 1000)), {"thumbnail": 320, "medium": 1024}, 80)
+        sizes = {name: Image.open(io.BytesIO(data)).size for name, data in variants.items()}
+        assert sizes == {"thumbnail": (320, 160), "medium": (1024, 512)}
+        assert all(Image.open(io.BytesIO(data)).format == "WEBP" for data in variants.values())
+
+    def test_small_and_transparent_images_keep_their_size_and_alpha(self):
+        variants = render_variants(picture((200, 100), "RGBA", "PNG", (255, 0, 0, 128)), {"thumbnail": 320}, 80)
+        thumbnail = Image.open(io.BytesIO(variants["thumbnail"]))
+        assert thumbnail.size == (200, 100) and thumbnail.mode == "RGBA"
+
+
+class TestGenerateVariants:
+
+    def product_file(self, id, content):
+        product_file = models.ProductFile(id=id, name=f"prod_image_{id}.jpg", product_id=1)
+        product_file.url = models.file_saver.save(models.ProductFile.upload_to, product_file.name, content)
+        return product_file
+
+    def test_variants_are_stored_and_recorded(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        monkeypatch.setattr(settings, "IMAGE_VARIANTS", {"thumbnail": 64})
+        session = RecordingSession(existing={1, 2})
+        monkeypatch.setattr(services.images, "AsyncSessionLocal", lambda: session)
+        monkeypatch.setattr(services.blobs, "AsyncSessionLocal", lambda: session)
+        product_files = [self.product_file(1, picture((640, 480))), self.product_file(2, b"not an image"),
+                         self.product_file(3, picture((640, 480)))]
+        asyncio.run(generate_variants(product_files))
+        thumbnail = session.variants[1]["thumbnail"]
+        assert list(session.variants) == [1]
+        assert thumbnail.endswith("prod_image_1_thumbnail.webp")
+        assert Image.open(thumbnail).size == (64, 48)
+        # the third image was deleted while it was rendered
+        assert not os.path.exists(thumbnail.replace("_1_", "_3_"))
+
+    def test_duplicates_share_the_variants_of_their_content(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        monkeypatch.setattr(settings, "IMAGE_VARIANTS", {"thumbnail": 64})
+        original = self.product_file(1, picture((640, 480)))
+        session = RecordingSession(existing={1, 2, 3}, rendered={original.url: {"thumbnail": "stored.webp"}})
+        monkeypatch.setattr(services.images, "AsyncSessionLocal", lambda: session)
+        duplicate = models.ProductFile(id=2, name=original.name, url=original.url, product_id=2)
+        new = self.product_file(3, picture((640, 480), color="blue"))
+        copy = models.ProductFile(id=4, name=new.name, url=new.url, product_id=2)
+        session.existing.add(4)
+        asyncio.run(generate_variants([duplicate, new, copy]))
+        assert session.variants[2] == {"thumbnail": "stored.webp"}
+        assert session.variants[3] == session.variants[4] != {"thumbnail": "stored.webp"}
+        # the new content was rendered once
+        assert sorted(os.listdir(tmp_path / "products")) == ["prod_image_1.jpg", "prod_image_3.jpg",
+                                                             "prod_image_3_thumbnail.webp"]
+
+    def test_deleting_an_image_deletes_its_variants(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        product_file = self.product_file(1, b"original")
+        product_file.variants = {"thumbnail": models.file_saver.save("products", "thumbnail.webp", b"thumbnail")}
+        asyncio.run(models.ProductFile.delete_files([product_file]))
+        assert os.listdir(tmp_path / "products") == []
+
+
+class TestVariantsInResponses:
+
+    def test_images_without_variants_have_none(self):
+        image = ProductImage.model_validate(models.ProductFile(id=1, name="a.jpg", url="media/a.jpg"))
+        assert image.variants == {}
@@ -0,0 +1,73 @@
+import json
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from services.rabbit_mq_service.inventory_events import parse, plan, prune_processed_messages
+
+
+def message(message_id, event, **data):
+    return json.dumps({"id": message_id, "event": event, "data": data}).encode()
+
+
+def product(id, quantity):
+    return dict(id=id, name="Soap", description="", brand_id=1, inventory_id=1, price=2.5, quantity=quantity)
+
+
+class TestInventoryEvents:
+
+    def test_parse_drops_malformed_and_repeated_messages(self):
+        events = parse([
+            message("a", "stock_adjusted", product_id=1, delta=2),
+            message("a", "stock_adjusted", product_id=1, delta=5),
+            message("b", "stock_adjusted", product_id="x", delta=1),
+            message("c", "restocked", product_id=1),
+            b"not json",
+        ])
+        assert list(events) == ["a"] and events["a"][1].delta == 2
+
+    def test_plan_nets_adjustments_per_product(self):
+        events = parse([message(i, "stock_adjusted", product_id=i % 2, delta=1) for i in range(5)])
+        upserts, deltas = plan(events, set(events))
+        assert upserts == {} and deltas == {0: 3, 1: 2}
+
+    def test_plan_skips_messages_already_applied(self):
+        events = parse([message(i, "stock_adjusted", product_id=1, delta=1) for i in range(5)])
+        assert plan(events, {"3", "4"})[1] == {1: 2}
+
+    def test_an_upsert_supersedes_earlier_adjustments(self):
+        events = parse([
+            message("a", "stock_adjusted", product_id=7, delta=4),
+            message("b", "product_upserted", **product(7, 10)),
+            message("c", "stock_adjusted", product_id=7, delta=-3),
+            message("d", "product_upserted", **product(8, 1)),
+        ])
+        upserts, deltas = plan(events, set(events))
+        assert {id: product.quantity for id, product in upserts.items()} == {7: 10, 8: 1}
+        assert deltas == {7: -3}
+
+
+class PruningSession:
+
+    def __init__(self, stale):
+        self.stale = stale
+        self.batches = []
+        self.commits = 0
+
+    def execute(self, statement, params):
+        self.batches.append(params)
+        deleted = min(self.stale, params["batch_size"])
+        self.stale -= deleted
+        return SimpleNamespace(rowcount=deleted)
+
+    def commit(self):
+        self.commits += 1
+
+
+class TestPruning:
+
+    def test_old_ids_are_deleted_in_batches(self):
+        db = PruningSession(stale=25)
+        assert prune_processed_messages(db, retention=timedelta(days=7), batch_size=10) == 25
+        assert [params["batch_size"] for params in db.batches] == [10, 10, 10] and db.commits == 3
+        cutoff = datetime.now(timezone.utc) - timedelta(days=7)
+        assert abs((db.batches[0]["before"] - cutoff).total_seconds()) < 5
@@ -0,0 +1,47 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from jose import jwt
+
+from settings.jwt_config import ALGORITHM, JWT_ISSUER, JWT_SECRET, decode_access_token, get_staff_user, verified_tokens
+
+
+def access_token(expires_in: timedelta, user_type: str = "Customer") -> str:
+    user = {"id": 3, "user_id": 9, "user_type": user_type, "first_name": "Ada", "last_name": "Obi",
+            "email": "ada@shop.ng"}
+    return jwt.encode({"exp": datetime.utcnow() + expires_in, "user": user, "iss": JWT_ISSUER},
+                      JWT_SECRET, ALGORITHM)
+
+
+class TestVerifiedTokens:
+
+    def test_repeat_tokens_are_not_decoded_again(self):
+        verified_tokens.clear()
+        token = access_token(timedelta(hours=1))
+        user = decode_access_token(token)
+        assert (user.id, user.customer_id) == (9, 3)
+        assert decode_access_token(token) is user
+        assert len(verified_tokens) == 1
+
+    def test_cached_tokens_expire_with_the_token(self):
+        verified_tokens.clear()
+        token = access_token(timedelta(seconds=1), user_type="Staff")
+        assert decode_access_token(token).staff_id == 3
+        time.sleep(1.1)
+        with pytest.raises(HTTPException):
+            decode_access_token(token)
+
+
+class TestStaffUser:
+
+    def test_customers_are_turned_away(self):
+        customer = decode_access_token(access_token(timedelta(hours=1)))
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(get_staff_user(customer))
+        assert error.value.status_code == 403
+        for user_type in ("Staff", "Administrator"):
+            user = decode_access_token(access_token(timedelta(hours=1), user_type=user_type))
+            assert asyncio.run(get_staff_user(user)) is user
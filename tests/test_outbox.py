@@ -0,0 +1,107 @@
+import asyncio
+from datetime import datetime
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import services.outbox
+from services.outbox import OutboxRelay
+from repositories.helpers import BaseRepository
+import models
+
+
+class RecordingSession:
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.deleted = None
+        self.committed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement, params):
+        if "delete" in str(statement):
+            self.deleted = params["ids"]
+            return None
+        return SimpleNamespace(all=lambda: self.rows[:params["limit"]])
+
+    def commit(self):
+        self.committed = True
+
+
+class ConfirmingPublisher:
+    """confirms everything but the events named in refuse, which never get an answer"""
+
+    def __init__(self, refuse=()):
+        self.refuse = refuse
+        self.published = []
+        self.pending = []
+
+    def submit(self, queues, data):
+        future = Future()
+        self.published.append(data)
+        if data["event"] in self.refuse:
+            self.pending.append(future)
+        else:
+            future.set_result(None)
+        return future
+
+
+def row(id, event="products.created"):
+    return SimpleNamespace(id=id, message_id=f"m{id}", event=event, payload={"id": id})
+
+
+class TestOutboxRelay:
+
+    def test_confirmed_events_are_deleted(self, monkeypatch):
+        session = RecordingSession([row(1), row(2), row(3)])
+        monkeypatch.setattr(services.outbox, "SessionLocal", lambda: session)
+        relay, publisher = OutboxRelay(batch_size=2), ConfirmingPublisher()
+        relay.publisher = publisher
+        assert relay.relay() == 2
+        assert publisher.published == [{"id": "m1", "event": "products.created", "data": {"id": 1}},
+                                        {"id": "m2", "event": "products.created", "data": {"id": 2}}]
+        assert session.deleted == [1, 2] and session.committed
+
+    def test_unconfirmed_events_stay_for_a_later_batch(self, monkeypatch):
+        monkeypatch.setattr(services.outbox.settings, "RABBIT_MQ_CONFIRM_TIMEOUT", 0.01)
+        session = RecordingSession([row(1), row(2, "sales.paid"), row(3)])
+        monkeypatch.setattr(services.outbox, "SessionLocal", lambda: session)
+        relay, publisher = OutboxRelay(), ConfirmingPublisher(refuse=("sales.paid",))
+        relay.publisher = publisher
+        assert relay.relay() == 2
+        assert session.deleted == [1, 3]
+        assert publisher.pending[0].cancelled()
+
+
+class RecordingAsyncSession:
+
+    def __init__(self):
+        self.added = []
+        self.info = {}
+
+    def add(self, item):
+        self.added.append(item)
+
+    async def commit(self):
+        pass
+
+
+class TestRecordEvent:
+
+    def test_events_are_added_to_the_transaction_and_wake_the_relay(self, monkeypatch):
+        woken = []
+        monkeypatch.setattr(services.outbox.outbox_relay, "wake", lambda: woken.append(True))
+        repository = BaseRepository(RecordingAsyncSession())
+        repository.model = models.Sale
+        repository.record_event("sales.paid", {"id": 1, "date_paid": datetime(2024, 1, 2)})
+        event, = repository.db.added
+        assert event.event == "sales.paid" and event.payload == {"id": 1, "date_paid": "2024-01-02T00:00:00"}
+        assert woken == []
+        asyncio.run(repository.commit())
+        assert woken == [True]
+        asyncio.run(repository.commit())
+        assert woken == [True]
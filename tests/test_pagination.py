@@ -0,0 +1,22 @@
+import pytest
+from fastapi import HTTPException
+
+from helpers.response import encode_cursor, decode_cursor, next_cursor
+
+
+class TestCursor:
+
+    def test_round_trip(self):
+        cursor = encode_cursor({"name": "Milo 500g", "id": 42})
+        assert "=" not in cursor
+        assert decode_cursor(cursor) == {"name": "Milo 500g", "id": 42}
+
+    def test_invalid_cursor(self):
+        for cursor in ("not-a-cursor", encode_cursor([1, 2])[:-1], encode_cursor(["a"])):
+            with pytest.raises(HTTPException):
+                decode_cursor(cursor)
+
+    def test_next_cursor_only_on_full_page(self):
+        rows = [{"name": "a", "id": 1}, {"name": "b", "id": 2}]
+        assert next_cursor(rows, 3, ("name", "id")) is None
+        assert decode_cursor(next_cursor(rows, 2, ("name", "id"))) == {"name": "b", "id": 2}
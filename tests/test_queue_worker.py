@@ -0,0 +1,150 @@
+from types import SimpleNamespace
+
+import pika
+
+import settings
+from services.rabbit_mq_service.consumers import Consumer, Exchange
+from services.rabbit_mq_service.workers import QueueWorker
+
+
+class RecordingChannel:
+
+    def __init__(self):
+        self.acks = []
+        self.nacks = []
+        self.published = []
+        self.unroutable = False
+
+    def basic_ack(self, delivery_tag, multiple):
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple, requeue):
+        self.nacks.append((delivery_tag, requeue))
+
+    def basic_publish(self, exchange, routing_key, body, properties, mandatory):
+        if self.unroutable:
+            raise pika.exceptions.UnroutableError([])
+        self.published.append((exchange, routing_key, body, properties.headers["x-attempts"]))
+
+
+class InlineConnection:
+    """runs callbacks right away, timers when the test says so"""
+
+    def __init__(self):
+        self.timers = []
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+    def call_later(self, delay, callback):
+        self.timers.append(callback)
+        return callback
+
+    def remove_timeout(self, callback):
+        self.timers.remove(callback)
+
+
+class DeferredPool:
+
+    def __init__(self):
+        self.submitted = {}
+
+    def submit(self, handle, connection, batch):
+        self.submitted[batch[0][0]] = lambda: handle(connection, batch)
+
+    def finish(self, *delivery_tags):
+        for delivery_tag in delivery_tags:
+            self.submitted.pop(delivery_tag)()
+
+
+class FailingConsumer(Consumer):
+    queue_name = "inventory_queue"
+    batches = []
+
+    @classmethod
+    def handle_batch(cls, messages):
+        if b"bad" in messages:
+            raise ValueError(messages)
+        cls.batches.append(messages)
+
+
+class BatchingConsumer(FailingConsumer):
+    batch_size = 3
+    batch_window = 0.05
+
+
+class TestQueueWorker:
+
+    def worker(self, prefetch=8, deliveries=(b"ok",) * 4, consumer=FailingConsumer, properties=None):
+        worker = QueueWorker(consumer, Exchange, None, prefetch=prefetch, workers=2)
+        worker.channel, worker.connection, worker.pool = RecordingChannel(), InlineConnection(), DeferredPool()
+        for tag, body in enumerate(deliveries, start=1):
+            worker.on_message(worker.channel, SimpleNamespace(delivery_tag=tag), properties, body)
+        return worker
+
+    def test_finished_runs_are_acked_together(self):
+        worker = self.worker()
+        worker.pool.finish(2, 3)
+        assert worker.channel.acks == []
+        worker.pool.finish(1)
+        assert worker.channel.acks == []
+        worker.connection.timers.pop()()
+        assert worker.channel.acks == [(3, True)]
+        worker.pool.finish(4)
+        assert worker.channel.acks == [(3, True), (4, True)]
+
+    def test_a_full_batch_is_acked_right_away(self):
+        worker = self.worker(prefetch=4, deliveries=(b"ok",) * 3)
+        worker.pool.finish(1)
+        assert worker.channel.acks == []
+        worker.pool.finish(2)
+        assert worker.channel.acks == [(2, True)]
+
+    def test_failures_go_back_to_the_queue_with_their_attempts(self):
+        worker = self.worker(deliveries=(b"ok", b"bad", b"ok"))
+        worker.pool.finish(2, 1, 3)
+        assert worker.channel.published == [("", "inventory_queue", b"bad", 2)]
+        assert worker.channel.nacks == []
+        assert worker.channel.acks == [(3, True)]
+        assert worker.pending == {}
+
+    def test_poison_messages_are_dead_lettered(self):
+        properties = pika.BasicProperties(headers={"x-attempts": settings.RABBIT_MQ_MAX_ATTEMPTS})
+        worker = self.worker(deliveries=(b"bad",), properties=properties)
+        worker.pool.finish(1)
+        assert worker.channel.published == [(settings.RABBIT_MQ_DEAD_LETTER_EXCHANGE, "inventory_queue", b"bad",
+                                             settings.RABBIT_MQ_MAX_ATTEMPTS + 1)]
+        assert worker.channel.acks == [(1, True)]
+        # the delivery's own properties are left alone
+        assert properties.headers["x-attempts"] == settings.RABBIT_MQ_MAX_ATTEMPTS
+
+    def test_failures_that_cannot_be_retried_are_requeued(self):
+        worker = self.worker(deliveries=(b"ok", b"bad"))
+        worker.channel.unroutable = True
+        worker.pool.finish(1, 2)
+        assert worker.channel.nacks == [(2, True)]
+        assert worker.channel.acks == [(1, True)]
+
+    def test_deliveries_of_a_lost_connection_are_left_to_redelivery(self):
+        worker = self.worker(deliveries=(b"ok",))
+        worker.pending = {}
+        worker.pool.finish(1)
+        assert worker.channel.acks == [] and worker.channel.nacks == []
+
+    def test_deliveries_are_batched_by_count_or_window(self):
+        FailingConsumer.batches = []
+        worker = self.worker(deliveries=[b"%d" % i for i in range(5)], consumer=BatchingConsumer)
+        assert list(worker.pool.submitted) == [1]
+        worker.connection.timers.pop()()
+        assert list(worker.pool.submitted) == [1, 4]
+        worker.pool.finish(1, 4)
+        assert BatchingConsumer.batches == [[b"0", b"1", b"2"], [b"3", b"4"]]
+        assert worker.channel.acks[-1] == (5, True) and worker.pending == {}
+
+    def test_a_failed_batch_is_retried_message_by_message(self):
+        FailingConsumer.batches = []
+        worker = self.worker(deliveries=(b"ok", b"bad", b"fine"), consumer=BatchingConsumer)
+        worker.pool.finish(1)
+        assert BatchingConsumer.batches == [[b"ok"], [b"fine"]]
+        assert worker.channel.published == [("", "inventory_queue", b"bad", 2)]
+        assert worker.channel.acks == [(3, True)]
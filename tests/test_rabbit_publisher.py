@@ -0,0 +1,119 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+from pika.spec import Basic
+
+from services.rabbit_mq_service.consumers import Exchange
+from services.rabbit_mq_service.publisher import Publisher, PublishError
+
+
+class RecordingChannel:
+
+    def __init__(self):
+        self.bindings = []
+        self.published = []
+
+    def queue_bind(self, queue, exchange):
+        self.bindings.append(queue)
+
+    def basic_publish(self, exchange, routing_key, body):
+        self.published.append(json.loads(body))
+
+
+def confirm(method, tag, multiple):
+    return SimpleNamespace(method=method(delivery_tag=tag, multiple=multiple))
+
+
+class IdlePublisher(Publisher):
+    """never connects, the tests play the broker by calling its callbacks"""
+
+    def start(self):
+        pass
+
+
+class TestPublisher:
+
+    def publisher(self, **kwargs):
+        publisher, channel = IdlePublisher(Exchange, **kwargs), RecordingChannel()
+        publisher.ready(channel)
+        return publisher, channel
+
+    def test_queues_are_bound_once_per_channel(self):
+        publisher, channel = self.publisher()
+        for i in range(3):
+            publisher.submit({"inventory_queue"}, {"i": i})
+        publisher.submit({"inventory_queue", "report_queue"}, {"i": 3})
+        publisher.flush()
+        assert sorted(channel.bindings) == ["inventory_queue", "report_queue"]
+        assert [message["i"] for message in channel.published] == [0, 1, 2, 3]
+
+    def test_batched_confirms_resolve_every_covered_publish(self):
+        publisher, channel = self.publisher()
+        futures = [publisher.submit(set(), {"i": i}) for i in range(5)]
+        publisher.flush()
+        publisher.on_confirm(confirm(Basic.Ack, 3, True))
+        assert [future.done() for future in futures] == [True, True, True, False, False]
+        publisher.on_confirm(confirm(Basic.Nack, 4, False))
+        publisher.on_confirm(confirm(Basic.Ack, 5, False))
+        assert futures[4].result() is None
+        with pytest.raises(PublishError):
+            futures[3].result()
+
+    def test_unconfirmed_publishes_are_bounded(self):
+        publisher, channel = self.publisher(max_unconfirmed=2)
+        for i in range(5):
+            publisher.submit(set(), {"i": i})
+        publisher.flush()
+        assert len(channel.published) == 2
+        publisher.on_confirm(confirm(Basic.Ack, 2, True))
+        assert len(channel.published) == 4
+
+    def test_lost_channel_fails_unconfirmed_and_keeps_queued(self):
+        publisher, channel = self.publisher(max_unconfirmed=1)
+        sent, queued = publisher.submit(set(), {"i": 0}), publisher.submit(set(), {"i": 1})
+        publisher.flush()
+        publisher.on_channel_closed(channel, "gone")
+        with pytest.raises(PublishError):
+            sent.result()
+        replacement = RecordingChannel()
+        publisher.ready(replacement)
+        assert replacement.published == [{"i": 1}]
+        publisher.on_confirm(confirm(Basic.Ack, 1, False))
+        assert queued.result() is None
+
+    def test_publish_async_waits_without_blocking_the_loop(self):
+        publisher, channel = self.publisher()
+
+        async def run():
+            publishing = asyncio.create_task(publisher.publish_async(set(), {"i": 0}))
+            await asyncio.sleep(0)
+            publisher.flush()
+            threading.Thread(target=publisher.on_confirm, args=(confirm(Basic.Ack, 1, False),)).start()
+            await asyncio.wait_for(publishing, 1)
+        asyncio.run(run())
+        assert channel.published == [{"i": 0}]
+
+    def test_publishing_fails_at_once_while_the_broker_is_down(self):
+        from helpers.circuit_breaker import CircuitOpenError
+        publisher, channel = self.publisher()
+        for _ in range(publisher.breaker.failure_threshold):
+            publisher.on_channel_closed(channel, "connection refused")
+        future = publisher.submit(set(), {"i": 0})
+        with pytest.raises(CircuitOpenError):
+            future.result(0)
+        publisher.ready(RecordingChannel())
+        assert not publisher.submit(set(), {"i": 1}).done()
+
+    def test_timed_out_publishes_are_not_sent_later(self):
+        publisher = IdlePublisher(Exchange)
+        with pytest.raises(TimeoutError):
+            publisher.publish(set(), {"i": 0}, timeout=0.01)
+        sent = publisher.submit(set(), {"i": 1})
+        channel = RecordingChannel()
+        publisher.ready(channel)
+        assert channel.published == [{"i": 1}]
+        # once sent, giving up no longer takes it back
+        assert not sent.cancel()
@@ -0,0 +1,118 @@
+import re
+
+import settings
+from read_models import REFRESH_FUNCTION, SOURCES, changed_rows, create_read_models, trigger_function
+
+
+class Result:
+
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self.value
+
+
+class FakeConnection:
+    """answers the catalog lookups of read_models and records the rest"""
+
+    def __init__(self, kinds, columns):
+        self.kinds = kinds
+        self.columns = columns
+        self.statements = []
+
+    def exec_driver_sql(self, sql):
+        kind = re.match(r"select relkind .* to_regclass\('(\w+)'\)", sql)
+        if kind:
+            return Result(self.kinds.get(kind.group(1)))
+        self.statements.append(" ".join(sql.split()))
+        return Result(None)
+
+    def execute(self, statement, params=None):
+        if params and "name" in params:
+            return Result(self.columns.get(params["name"], []))
+        self.statements.append(" ".join(str(statement).split()))
+        return Result(None)
+
+
+PRODUCT_COLUMNS = ["id", "name", "description", "brand_id", "inventory_id", "price", "quantity", "brand",
+                   "inventory", "images", "thumbnails"]
+
+
+class TestTriggers:
+
+    def test_changed_rows(self):
+        assert changed_rows(None) == "new_rows"
+        assert changed_rows(("name", "price")) == (
+            "(select n.* from new_rows n join old_rows o on o.id = n.id "
+            "where (n.name, n.price) is distinct from (o.name, o.price))")
+
+    def test_trigger_function_refreshes_the_touched_rows(self):
+        function = trigger_function("brands")
+        assert "create or replace function brands_refresh_read_models()" in function
+        assert ("if TG_OP = 'INSERT' then\n\t\tperform refresh_read_model('products_view', "
+                "array(select p.id from products p join new_rows r on r.id = p.brand_id));") in function
+        assert ("perform refresh_read_model('products_view', array(select p.id from products p join "
+                "(select n.* from new_rows n join old_rows o on o.id = n.id where (n.name) is distinct from (o.name)) "
+                "r on r.id = p.brand_id));") in function
+        assert "join old_rows r on r.id = p.brand_id));" in function
+
+    def test_moved_rows_refresh_their_old_read_model_rows(self):
+        function = trigger_function("orders")
+        assert ("perform refresh_read_model('sales_view', array(select sale_id from old_rows "
+                "except select sale_id from new_rows));") in function
+        # rows of the order's own read model are matched by id, no old side to refresh
+        assert "array(select id from old_rows except" not in function
+
+    def test_refreshes_of_a_row_take_turns_and_upsert(self):
+        function = " ".join(REFRESH_FUNCTION.split())
+        assert "perform pg_advisory_xact_lock(hashtext(model), row_id);" in function
+        assert "on conflict (id) do update set %s" in function
+        # a refresh no longer deletes rows the source still holds
+        assert "and not exists (select from %I s where s.id = m.id)" in function
+
+
+class TestModes:
+
+    def test_view_mode_replaces_tables_with_views(self, monkeypatch):
+        monkeypatch.setattr(settings, "READ_MODEL_MODE", "view")
+        conn = FakeConnection(kinds={"products_view": "r", "sales_view": "v"}, columns={})
+        create_read_models(conn)
+        assert "drop table products_view" in conn.statements
+        assert "drop trigger if exists products_insert_read_models on products" in conn.statements
+        assert "drop table sales_view" not in conn.statements
+        for name in SOURCES:
+            assert any(statement.startswith(f"create view {name} as select") for statement in conn.statements)
+        assert not any(statement.startswith("create trigger") for statement in conn.statements)
+
+    def test_table_mode_rebuilds_tables_whose_columns_changed(self, monkeypatch):
+        monkeypatch.setattr(settings, "READ_MODEL_MODE", "table")
+        # products_view was built before search_vector, sales_view is current and orders_view a view
+        conn = FakeConnection(kinds={"products_view": "r", "sales_view": "r", "orders_view": "v"},
+                              columns={"products_view": PRODUCT_COLUMNS,
+                                       "products_view_source": PRODUCT_COLUMNS + ["search_vector"],
+                                       "sales_view": ["id", "paid"], "sales_view_source": ["id", "paid"]})
+        create_read_models(conn)
+        assert "drop table products_view" in conn.statements
+        assert "create table products_view as select * from products_view_source" in conn.statements
+        assert "drop table sales_view" not in conn.statements
+        assert "create table sales_view as select * from sales_view_source" not in conn.statements
+        assert "drop view orders_view" in conn.statements
+        assert "create table orders_view as select * from orders_view_source" in conn.statements
+        assert ("create trigger brands_update_read_models after update on brands referencing new table as new_rows "
+                "old table as old_rows for each statement execute function brands_refresh_read_models()") in conn.statements
+        assert "create index if not exists ix_products_view_search_vector on products_view using gin (search_vector)" \
+               in conn.statements
+
+    def test_table_mode_rebuild_on_request(self, monkeypatch):
+        monkeypatch.setattr(settings, "READ_MODEL_MODE", "table")
+        conn = FakeConnection(kinds={name: "r" for name in SOURCES}, columns={})
+        create_read_models(conn, rebuild=True)
+        for name in SOURCES:
+            assert f"drop table {name}" in conn.statements
@@ -0,0 +1,100 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+import models
+from helpers.exceptions import ValidationError
+from repositories.helpers import BaseRepository
+
+
+class FakeSession:
+
+    def __init__(self):
+        self.info = {}
+        self.queries = 0
+        self.rolled_back = False
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        self.rolled_back = True
+
+    async def execute(self, statement):
+        self.queries += 1
+        return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: [1]))
+
+
+class CachedRepository(BaseRepository):
+    model = models.Brand
+    cache_reads = True
+
+
+class TestReferenceCache:
+
+    def test_reads_are_cached_until_a_commit(self):
+        repo, loads = CachedRepository(FakeSession()), []
+
+        async def load():
+            loads.append(1)
+            return len(loads)
+
+        async def run():
+            assert await repo.cached(("key",), load) == 1
+            assert await repo.cached(("key",), load) == 1
+            await repo.commit()
+            assert await repo.cached(("key",), load) == 2
+        asyncio.run(run())
+        assert len(loads) == 2
+
+    def test_read_racing_a_commit_is_not_cached(self):
+        repo, loads = CachedRepository(FakeSession()), []
+
+        async def load():
+            loads.append(1)
+            await repo.commit()
+            return len(loads)
+
+        async def run():
+            assert await repo.cached(("race",), load) == 1
+            assert await repo.cached(("race",), load) == 2
+        asyncio.run(run())
+
+    def test_uncached_repositories_always_load(self):
+        repo, loads = BaseRepository(FakeSession()), []
+        repo.model = models.Brand
+
+        async def load():
+            loads.append(1)
+
+        asyncio.run(repo.cached(("key",), load))
+        asyncio.run(repo.cached(("key",), load))
+        assert len(loads) == 2
+
+    def test_name_checks_of_writes_always_query(self):
+        session = FakeSession()
+        repo = CachedRepository(session)
+        assert asyncio.run(repo.ids_named("Nestle")) == [1]
+        assert asyncio.run(repo.ids_named("Nestle")) == [1]
+        assert session.queries == 2
+
+
+class TestUniqueWrites:
+
+    def write(self, sqlstate):
+        async def write():
+            raise IntegrityError("insert", {}, SimpleNamespace(sqlstate=sqlstate))
+        return write()
+
+    def test_a_concurrent_duplicate_is_a_validation_error(self):
+        repo = CachedRepository(FakeSession())
+        with pytest.raises(ValidationError) as error:
+            asyncio.run(repo.unique(self.write("23505"), detail="A branch with this name already exists"))
+        assert error.value.detail == "A branch with this name already exists" and repo.db.rolled_back
+
+    def test_other_integrity_errors_are_left_alone(self):
+        repo = CachedRepository(FakeSession())
+        with pytest.raises(IntegrityError):
+            asyncio.run(repo.unique(self.write("23503"), detail="duplicate"))
@@ -0,0 +1,100 @@
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+import models
+import settings
+from repositories.brands import BrandRepository
+from repositories.helpers import prefix_tsquery
+from repositories.products import ProductRepository
+
+
+class FakeResult:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def scalar_one(self):
+        return self.rows
+
+    def mappings(self):
+        return self
+
+    def all(self):
+        return self.rows
+
+
+class FakeSession:
+
+    def __init__(self, count=0, rows=()):
+        self.info = {}
+        self.count, self.rows = count, list(rows)
+        self.statements = []
+
+    async def execute(self, statement, params=None):
+        self.statements.append((str(statement), params))
+        if str(statement).startswith("select count(*)"):
+            return FakeResult(self.count)
+        return FakeResult(self.rows)
+
+
+class TestPrefixTsquery:
+
+    def test_words_match_as_prefixes(self):
+        assert prefix_tsquery("Coca Col") == "coca:* & col:*"
+
+    def test_short_words_match_whole(self):
+        assert prefix_tsquery("a milk") == "a & milk:*"
+
+    def test_operators_are_dropped(self):
+        assert prefix_tsquery("milk & !(tea) | 'x") == "milk:* & tea:* & x"
+        assert prefix_tsquery("&|!") == ""
+
+
+class TestSearchQuery:
+
+    def test_search_ranks_and_filters(self):
+        repo = BrandRepository(FakeSession())
+        queryset, rank = repo.search(select(models.Brand), "peak mil")
+        compiled = queryset.compile(dialect=postgresql.dialect())
+        sql = str(compiled)
+        assert "brands.search_vector @@ to_tsquery(" in sql
+        assert "peak:* & mil:*" in compiled.params.values()
+        assert "ts_rank(brands.search_vector" in sql and rank.name == "rank"
+
+    def test_nothing_to_search(self):
+        queryset = select(models.Brand)
+        assert BrandRepository(FakeSession()).search(queryset, "!!") == (queryset, None)
+
+    def test_product_candidates_are_the_most_relevant_matches(self, monkeypatch):
+        monkeypatch.setattr(settings, "SEARCH_CANDIDATES", 50)
+        db = FakeSession(count=120)
+        result = asyncio.run(ProductRepository(db).get_all(limit=10, search="milk", include_count=True))
+        count_sql, count_params = db.statements[0]
+        sql, params = db.statements[1]
+        assert "limit" not in count_sql and count_params["search"] == "milk:*"
+        assert ("(select *, ts_rank(search_vector, to_tsquery(:config, :search)) as rank from products_view "
+                "where search_vector @@ to_tsquery(:config, :search) order by rank desc, id desc limit :candidates) "
+                "as matches") in sql
+        assert sql.startswith(f"select {ProductRepository.columns}, rank from")
+        assert sql.endswith("order by rank desc, id desc limit :limit offset :offset;")
+        assert params["candidates"] == 50
+        # every match is counted, not only the candidates
+        assert result["count"] == 120
+
+    def test_product_search_keyset(self, monkeypatch):
+        monkeypatch.setattr(settings, "SEARCH_CANDIDATES", 50)
+        db = FakeSession(count=3)
+        result = asyncio.run(ProductRepository(db).get_all(limit=10, search="milk", after={"rank": 0.5, "id": 9},
+                                                           skip=20))
+        sql, params = db.statements[1]
+        assert ") as matches where (rank, id) < (:after_0, :after_1)" in sql
+        assert (params["after_0"], params["after_1"], params["offset"]) == (0.5, 9, 0)
+        assert result["count"] == 3
+
+    def test_unlimited_candidates(self, monkeypatch):
+        monkeypatch.setattr(settings, "SEARCH_CANDIDATES", 0)
+        db = FakeSession(count=120)
+        result = asyncio.run(ProductRepository(db).get_all(limit=10, search="milk"))
+        assert ":candidates" not in db.statements[1][0] and result["count"] == 120
@@ -0,0 +1,161 @@
+import asyncio
+import time
+
+from sqlalchemy.orm import Session
+
+import models
+import signals
+from signals import ModelSignal, SignalTasks, signal_tasks
+
+
+def product_file(id, product_id=1):
+    return models.ProductFile(id=id, name=f"{id}.png", url=f"media/products/{id}.png", product_id=product_id)
+
+
+class TestConcurrentReceivers:
+
+    def test_receivers_run_concurrently(self):
+        signal = ModelSignal()
+
+        async def slow(sender, **kwargs):
+            await asyncio.sleep(0.1)
+            return sender.id
+
+        async def slower(sender, **kwargs):
+            await asyncio.sleep(0.1)
+            return -sender.id
+
+        signal.connect(slow, models.ProductFile)
+        signal.connect(slower, models.ProductFile)
+        start = time.monotonic()
+        responses = asyncio.run(signal.send(product_file(3)))
+        assert time.monotonic() - start < 0.18
+        assert [response for _, response in responses] == [3, -3]
+
+
+class TestDeferredReceivers:
+
+    def test_deferred_receivers_wait_for_the_commit(self):
+        signal, calls = ModelSignal(in_transaction=True), []
+
+        async def delete_file(sender, **kwargs):
+            calls.append(sender.id)
+
+        signal.connect(delete_file, models.ProductFile, deferred=True)
+        session = Session()
+        instance = product_file(1)
+        session.add(instance)
+
+        async def delete():
+            responses = await signal.send(instance)
+            assert responses == [] and calls == []
+            await signal_tasks.release(session)
+
+        asyncio.run(delete())
+        assert calls == [1]
+        assert "deferred_signals" not in session.info
+
+    def test_a_rollback_drops_deferred_receivers(self):
+        signal, calls = ModelSignal(in_transaction=True), []
+
+        async def delete_file(sender, **kwargs):
+            calls.append(sender.id)
+
+        signal.connect(delete_file, models.ProductFile, deferred=True)
+        session = Session()
+        instance = product_file(1)
+        session.add(instance)
+        asyncio.run(signal.send(instance))
+        session.rollback()
+        asyncio.run(signal_tasks.release(session))
+        assert calls == []
+
+    def test_started_tasks_run_calls_in_the_background_and_log_failures(self, monkeypatch, caplog):
+        signal, calls, tasks = ModelSignal(), [], SignalTasks(workers=2)
+        monkeypatch.setattr(signals, "signal_tasks", tasks)
+
+        async def log(sender, **kwargs):
+            await asyncio.sleep(0.05)
+            calls.append(sender.id)
+
+        async def broken(sender, **kwargs):
+            raise RuntimeError("disk is gone")
+
+        signal.connect(log, models.ProductFile, deferred=True)
+        signal.connect(broken, models.ProductFile, deferred=True)
+
+        async def save():
+            tasks.start()
+            await signal.send(product_file(1))
+            assert calls == []
+            await tasks.stop()
+
+        asyncio.run(save())
+        assert calls == [1]
+        assert "deferred signal receiver broken failed" in caplog.text
+
+    def test_deferral_is_kept_per_sender(self):
+        signal, calls = ModelSignal(), []
+
+        async def invalidate(sender, **kwargs):
+            calls.append(type(sender).__name__)
+
+        signal.connect(invalidate, models.Brand)
+        signal.connect(invalidate, models.ProductFile, deferred=True)
+        during_send = []
+
+        async def save():
+            # started tasks keep deferred calls off the send
+            signal_tasks.start()
+            await signal.send(models.Brand(id=1, name="Peak", description=""))
+            await signal.send(product_file(1))
+            during_send.append(list(calls))
+            await signal_tasks.stop()
+
+        asyncio.run(save())
+        assert during_send == [["Brand"]]
+        assert calls == ["Brand", "ProductFile"]
+
+
+class TestBulkSignal:
+
+    def test_one_send_for_a_batch(self):
+        signal, batches = ModelSignal(in_transaction=True), []
+
+        async def delete_files(sender, instances, **kwargs):
+            batches.append((sender, [instance.id for instance in instances]))
+
+        signal.connect(delete_files, models.ProductFile, deferred=True)
+        session = Session()
+        instances = [product_file(id) for id in (1, 2, 3)]
+        session.add_all(instances)
+
+        async def delete():
+            await signal.send(models.ProductFile, instances=instances)
+            await signal_tasks.release(session)
+
+        asyncio.run(delete())
+        assert batches == [(models.ProductFile, [1, 2, 3])]
+
+
+class TestDetailInvalidation:
+
+    def test_deleted_rows_are_invalidated_again_after_the_commit(self, monkeypatch):
+        invalidated = []
+
+        async def invalidate(namespace, id):
+            invalidated.append((namespace, id))
+
+        monkeypatch.setattr(signals.detail_cache, "invalidate", invalidate)
+        session = Session()
+        brand = models.Brand(id=5, name="Peak", description="")
+        session.add(brand)
+
+        async def delete():
+            await signals.pre_delete.send(brand)
+            assert invalidated == [("brands", 5)]
+            # a read between the two caches the row again, the commit drops it once more
+            await signal_tasks.release(session)
+
+        asyncio.run(delete())
+        assert invalidated == [("brands", 5), ("brands", 5)]
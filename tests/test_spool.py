@@ -0,0 +1,167 @@
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+import settings
+from helpers.circuit_breaker import CircuitBreaker, CircuitOpenError
+from helpers.utilities import FileSaver
+from services.spool import Spool, SpoolFull
+
+
+class TestCircuitBreaker:
+
+    def fail(self):
+        raise ConnectionError()
+
+    def test_opens_after_repeated_failures_and_recovers_through_a_trial(self):
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0)
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                breaker.call(self.fail)
+        assert breaker.state == "open"
+        assert breaker.allow() and breaker.state == "half open"
+        assert not breaker.allow()
+        breaker.success()
+        assert breaker.state == "closed" and breaker.call(lambda: 1) == 1
+
+    def test_open_breakers_fail_at_once(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+        with pytest.raises(ConnectionError):
+            breaker.call(self.fail)
+        with pytest.raises(CircuitOpenError):
+            breaker.call(lambda: 1)
+
+
+class TestSpool:
+
+    def test_replays_in_order_and_stops_at_the_first_failure(self, tmp_path):
+        spool, sent = Spool("test", path=str(tmp_path)), []
+        for i in range(3):
+            spool.put({"i": i}, b"body %d" % i)
+
+        def send(meta, body):
+            if meta["i"] == 1 and not sent[1:]:
+                sent.append(None)
+                raise ConnectionError()
+            sent.append((meta["i"], body))
+
+        with pytest.raises(ConnectionError):
+            spool.replay(send)
+        assert len(spool) == 2
+        assert spool.replay(send) == 2
+        assert [item for item in sent if item] == [(0, b"body 0"), (1, b"body 1"), (2, b"body 2")]
+        assert len(spool) == 0 and spool.size == 0
+
+    def test_is_bounded_and_survives_restarts(self, tmp_path):
+        spool = Spool("test", path=str(tmp_path), max_bytes=100)
+        spool.put({"i": 0}, b"x" * 50)
+        with pytest.raises(SpoolFull):
+            spool.put({"i": 1}, b"x" * 50)
+        restarted = Spool("test", path=str(tmp_path), max_bytes=100)
+        assert len(restarted) == 1 and restarted.size == spool.size
+
+    def test_processes_share_the_bound_and_the_records(self, tmp_path):
+        first = Spool("test", path=str(tmp_path), max_bytes=100)
+        second = Spool("test", path=str(tmp_path), max_bytes=100)
+        first.put({"i": 0}, b"x" * 50)
+        with pytest.raises(SpoolFull):
+            second.put({"i": 1}, b"x" * 50)
+        sent = []
+
+        def send(meta, body):
+            # the other process replays while this record is being sent
+            assert second.replay(lambda *args: sent.append("twice")) == 0
+            sent.append(meta["i"])
+
+        assert first.replay(send) == 1 and sent == [0]
+        assert second.size == 0 and second.replay(send) == 0
+
+
+class TestFileSaverOutage:
+
+    def test_uploads_are_spooled_while_s3_is_down(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "SPOOL_PATH", str(tmp_path))
+        saver, stored = FileSaver("AWS"), []
+
+        def unreachable(meta, content):
+            raise EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+
+        monkeypatch.setattr(saver, "apply", unreachable)
+        urls = [saver.save("products", f"{i}.png", b"png") for i in range(5)]
+        assert urls[0].endswith("/products/0.png")
+        # only the first reached s3, the others queued behind it in the spool
+        assert saver.breaker.failures == 1 and len(saver.spool) == 5
+
+        monkeypatch.setattr(saver, "apply", lambda meta, content: stored.append((meta["action"], meta["key"])))
+        saver.breaker.reset_timeout = 0
+        assert saver.spool.replay(saver.replay) == 5
+        assert [key.rsplit("/", 1)[-1] for _, key in stored] == [f"{i}.png" for i in range(5)]
+
+    @staticmethod
+    def client_error(status, code):
+        return ClientError({"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "PutObject")
+
+    def test_throttling_is_spooled_and_later_writes_queue_behind_it(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "SPOOL_PATH", str(tmp_path))
+        saver, stored = FileSaver("AWS"), []
+
+        def slow_down(meta, content):
+            raise self.client_error(503, "SlowDown")
+
+        monkeypatch.setattr(saver, "apply", slow_down)
+        saver.save("products", "0.png", b"png")
+        assert len(saver.spool) == 1
+
+        # s3 is back, but the spooled upload goes out before the newer ones
+        monkeypatch.setattr(saver, "apply", lambda meta, content: stored.append((meta["action"], meta.get("key") or meta["keys"][0])))
+        saver.save("products", "1.png", b"png")
+        saver.delete_many([saver.url("products", "0.png")])
+        assert stored == [] and len(saver.spool) == 3
+        assert saver.spool.replay(saver.replay) == 3
+        assert [(action, key.rsplit("/", 1)[-1]) for action, key in stored] == [
+            ("put", "0.png"), ("put", "1.png"), ("delete", "0.png")]
+        saver.save("products", "2.png", b"png")
+        assert len(saver.spool) == 0 and stored[-1][1].endswith("2.png")
+
+    def test_refused_calls_raise_and_are_not_failures(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "SPOOL_PATH", str(tmp_path))
+        saver = FileSaver("AWS")
+
+        def denied(meta, content):
+            raise self.client_error(403, "AccessDenied")
+
+        monkeypatch.setattr(saver, "apply", denied)
+        for _ in range(settings.BREAKER_FAILURE_THRESHOLD):
+            with pytest.raises(ClientError):
+                saver.save("products", "0.png", b"png")
+        assert saver.breaker.state == "closed" and len(saver.spool) == 0
+
+        # a spooled record s3 refuses is dropped, the ones behind it still go
+        saver.spool.put({"action": "put", "key": "media/products/1.png"}, b"png")
+        saver.spool.put({"action": "put", "key": "media/products/2.png"}, b"png")
+        stored = []
+
+        def refuse_first(meta, content):
+            if meta["key"].endswith("1.png"):
+                raise self.client_error(400, "InvalidRequest")
+            stored.append(meta["key"])
+
+        monkeypatch.setattr(saver, "apply", refuse_first)
+        assert saver.spool.replay(saver.replay) == 2 and stored == ["media/products/2.png"]
+
+
+    def test_spooled_deletes_of_owned_files_replay_through_their_owner(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "SPOOL_PATH", str(tmp_path))
+        saver, calls = FileSaver("AWS"), []
+        saver.spool.put({"action": "delete", "keys": ["media/products/a.png"], "owners": ["a"]})
+        assert not saver.delete_many([saver.url("products", "b.png")], owners=["b"])
+
+        def replay_owned_delete(owners, keys, delete):
+            calls.append((owners, keys))
+            delete(keys)
+
+        saver.replay_owned_delete = replay_owned_delete
+        deleted = []
+        monkeypatch.setattr(saver, "apply", lambda meta, content: deleted.extend(meta["keys"]))
+        assert saver.spool.replay(saver.replay) == 2
+        assert [owners for owners, _ in calls] == [["a"], ["b"]]
+        assert [key.rsplit("/", 1)[-1] for key in deleted] == ["a.png", "b.png"]
@@ -0,0 +1,95 @@
+import asyncio
+import io
+import os
+
+import boto3
+import pytest
+
+import settings
+from helpers.utilities import FileSaver
+from services.storage import S3Storage
+
+moto = pytest.importorskip("moto")
+
+BUCKET = "shop-media"
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="testing",
+                              aws_secret_access_key="testing")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+class CountingClient:
+    """the client, counting delete_objects requests"""
+
+    def __init__(self, client):
+        self.client = client
+        self.deletes = []
+
+    def delete_objects(self, **kwargs):
+        self.deletes.append(len(kwargs["Delete"]["Objects"]))
+        return self.client.delete_objects(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def keys(s3):
+    pages = s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET)
+    return sorted(item["Key"] for page in pages for item in page.get("Contents", ()))
+
+
+class TestS3Storage:
+
+    def test_large_files_are_uploaded_in_parts(self, s3, monkeypatch):
+        # s3 parts but the last are at least 5MB
+        monkeypatch.setattr(settings, "S3_MULTIPART_THRESHOLD", 5 * MB)
+        monkeypatch.setattr(settings, "S3_MULTIPART_CHUNKSIZE", 5 * MB)
+        storage = S3Storage(BUCKET, client=s3)
+        content = os.urandom(12 * MB)
+        storage.put("products/large.png", io.BytesIO(content))
+        storage.put("products/small.png", b"png")
+        assert s3.head_object(Bucket=BUCKET, Key="products/large.png")["ETag"].endswith('-3"')
+        assert s3.get_object(Bucket=BUCKET, Key="products/large.png")["Body"].read() == content
+        assert s3.get_object(Bucket=BUCKET, Key="products/small.png")["Body"].read() == b"png"
+
+    def test_deletes_are_batched(self, s3):
+        client = CountingClient(s3)
+        storage = S3Storage(BUCKET, client=client)
+        names = [f"products/{i}.png" for i in range(1001)]
+        for name in names + ["products/kept.png"]:
+            s3.put_object(Bucket=BUCKET, Key=name, Body=b"png")
+        storage.delete(names + ["products/missing.png"])
+        assert client.deletes == [1000, 2]
+        assert keys(s3) == ["products/kept.png"]
+
+    def test_async_interface(self, s3):
+        storage = S3Storage(BUCKET, client=s3)
+
+        async def roundtrip():
+            await asyncio.gather(*[storage.put_async(f"products/{i}.png", b"png") for i in range(5)])
+            assert len(keys(s3)) == 5
+            await storage.delete_async([f"products/{i}.png" for i in range(5)])
+
+        asyncio.run(roundtrip())
+        assert keys(s3) == []
+
+
+class TestFileSaverOnS3:
+
+    def test_saves_and_deletes_through_the_shared_client(self, s3, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "SPOOL_PATH", str(tmp_path))
+        monkeypatch.setattr(settings, "AWS_S3_BUCKET_NAME", BUCKET)
+        saver = FileSaver("AWS")
+        saver.storage.s3 = s3
+        urls = [saver.save("products", f"{i}.png", b"png") for i in range(3)]
+        assert urls[0] == f"https://{BUCKET}.s3.amazonaws.com/{os.path.join(settings.MEDIA_URL, 'products', '0.png')}"
+        assert len(keys(s3)) == 3
+        asyncio.run(saver.delete_async(urls[:2]))
+        assert keys(s3) == [saver.storage.key_of(urls[2])]
+        assert len(saver.spool) == 0
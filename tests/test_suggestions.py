@@ -0,0 +1,26 @@
+from services.suggestions import PrefixIndex, PRODUCT, BRAND
+
+
+class TestPrefixIndex:
+    index = PrefixIndex()
+    index.load([(PRODUCT, 1, "Peak Milk 400g"), (PRODUCT, 2, "Peak Evaporated Milk"),
+                (PRODUCT, 3, "Milo Refill"), (BRAND, 1, "Peak")])
+
+    def test_matches_any_word_prefix(self):
+        assert {(r["type"], r["id"]) for r in self.index.search("mil")} == \
+               {("product", 1), ("product", 2), ("product", 3)}
+        assert {(r["type"], r["id"]) for r in self.index.search("peak evap")} == {("product", 2)}
+        assert self.index.search("  ") == []
+
+    def test_limit(self):
+        assert len(self.index.search("peak", limit=2)) == 2
+
+    def test_add_and_remove(self):
+        index = PrefixIndex()
+        index.add(PRODUCT, 7, "Golden Penny Spaghetti")
+        assert index.search("spag") == [{"id": 7, "name": "Golden Penny Spaghetti", "type": "product"}]
+        index.add(PRODUCT, 7, "Golden Penny Macaroni")
+        assert index.search("spag") == []
+        assert index.search("maca")[0]["id"] == 7
+        index.remove(PRODUCT, 7)
+        assert index.search("golden") == [] and len(index.keys) == 0
@@ -0,0 +1,105 @@
+import asyncio
+
+from versions import TABLES, TableVersions
+
+
+class FakeConnection:
+
+    def __init__(self, changes):
+        self.listeners = {}
+        self.on_termination = None
+        self.closed = False
+        # rows of table_changes as (id, table)
+        self.changes = changes
+
+    async def fetch(self, query, tables):
+        rows = {}
+        for id, table in self.changes:
+            if table in tables:
+                latest, count = rows.get(table, (0, 0))
+                rows[table] = (max(latest, id), count + 1)
+        return [(table, latest, count) for table, (latest, count) in rows.items()]
+
+    def add_termination_listener(self, callback):
+        self.on_termination = callback
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    def notify(self, table):
+        self.listeners["table_versions"](self, 1, "table_versions", table)
+
+    def terminate(self):
+        self.closed = True
+        self.on_termination(self)
+
+    def is_closed(self):
+        return self.closed
+
+    async def close(self):
+        self.closed = True
+
+
+class TestTableVersions:
+
+    def test_versions_are_read_from_the_database_on_notification(self):
+        changed, changes, connections = [], [(1, "brands")], []
+        versions = TableVersions(on_change=changed.append, retry_interval=0)
+
+        async def connect():
+            connections.append(FakeConnection(changes))
+            return connections[-1]
+
+        async def run():
+            assert versions.get(("brands",)) is None
+            await versions.start(connect)
+            await asyncio.sleep(0.01)
+            before = versions.get(("brands", "products"))
+            assert before == {"brands": "1.1", "products": "0"}
+            # another worker reading the same rows computes the same versions
+            other = TableVersions()
+            await other.refresh(FakeConnection(changes))
+            other.connected = True
+            assert other.get(("brands", "products")) == before
+
+            changes.append((2, "brands"))
+            connections[0].notify("brands")
+            assert versions.get(("brands",)) is None and changed[-1] == "brands"
+            await asyncio.sleep(0.01)
+            assert versions.get(("brands", "products")) == {"brands": "2.2", "products": "0"}
+
+            # an id taken earlier that commits later still changes the version
+            changes.insert(0, (0, "brands"))
+            connections[0].notify("brands")
+            await asyncio.sleep(0.01)
+            assert versions.get(("brands",)) == {"brands": "2.3"}
+
+            # a lost connection is reopened, and everything is read again
+            connections[0].terminate()
+            await asyncio.sleep(0.01)
+            assert len(connections) == 2 and versions.connected
+            assert versions.get(("brands",)) == {"brands": "2.3"}
+            await versions.stop()
+            assert connections[1].closed
+
+        asyncio.run(run())
+        assert set(TABLES) <= set(changed)
+
+    def test_own_commits_are_unknown_until_read(self):
+        versions = TableVersions()
+        versions.connected, versions.stale = True, set()
+        assert versions.get(("inventories",)) == {"inventories": "0"}
+        versions.touch("inventories")
+        assert versions.get(("inventories",)) is None
+
+    def test_a_touch_during_the_read_keeps_the_table_unknown(self):
+        versions = TableVersions()
+        versions.connected, versions.stale = True, {"brands"}
+
+        class Racing(FakeConnection):
+            async def fetch(self, query, tables):
+                versions.touch("brands")
+                return []
+
+        asyncio.run(versions.refresh(Racing([])))
+        assert versions.get(("brands",)) is None
@@ -0,0 +1,88 @@
+import asyncio
+import io
+import os
+import tempfile
+
+import pytest
+from starlette.datastructures import UploadFile
+
+import models
+import settings
+from helpers.utilities import FileSaver
+from services.spool import Spool
+from services.storage import LocalStorage, Storage
+
+
+class CountingFile(io.BytesIO):
+    """records the size of every read"""
+
+    def __init__(self, content):
+        super().__init__(content)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return super().read(size)
+
+
+def upload(content, filename="packshot.png"):
+    # what starlette hands views, spooled to disk past 1MB
+    file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    file.write(content)
+    return UploadFile(file, filename=filename)
+
+
+class TestStreamingUploads:
+
+    def test_files_are_copied_in_chunks(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        monkeypatch.setattr(settings, "UPLOAD_CHUNK_SIZE", 1024)
+        content = os.urandom(10 * 1024 + 1)
+        file = CountingFile(content)
+        file.seek(len(content))
+        path = asyncio.run(FileSaver("file").save_upload("products", "a.png", file))
+        with open(path, "rb") as saved:
+            assert saved.read() == content
+        assert set(file.reads) == {1024}
+
+    def test_images_of_a_request_are_saved_concurrently_under_distinct_names(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(settings, "MEDIA_URL", str(tmp_path))
+        images = [upload(bytes([i]) * (2 * 1024 * 1024)) for i in range(8)]
+
+        async def save():
+            return await asyncio.gather(*[models.ProductFile.save_upload(image, product_id=1) for image in images])
+
+        product_files = asyncio.run(save())
+        assert len({product_file.url for product_file in product_files}) == 8
+        for i, product_file in enumerate(product_files):
+            assert product_file.name.endswith(".png") and product_file.product_id == 1
+            with open(product_file.url, "rb") as saved:
+                assert saved.read() == bytes([i]) * (2 * 1024 * 1024)
+
+    def test_uploads_spool_from_the_file(self, tmp_path):
+        spool = Spool("test", path=str(tmp_path))
+        spool.put({"key": "a.png"}, upload(b"png" * 1000).file)
+        sent = []
+        spool.replay(lambda meta, body: sent.append((meta["key"], body)))
+        assert sent == [("a.png", b"png" * 1000)]
+
+
+class TestStorageBackends:
+
+    def test_incomplete_backends_fail_at_construction(self):
+        class UrlsOnly(Storage):
+            def url(self, key):
+                return key
+
+            def key_of(self, url):
+                return url
+
+        with pytest.raises(TypeError, match="delete, get, put"):
+            UrlsOnly()
+
+    def test_local_storage_round_trip(self, tmp_path):
+        storage, key = LocalStorage(), str(tmp_path / "products" / "a.png")
+        storage.put(key, io.BytesIO(b"png"))
+        assert storage.get(storage.key_of(storage.url(key))) == b"png"
+        storage.delete([key, key])
+        assert not os.path.exists(key)
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+
+from services.channel_bus import ChannelBus, MemoryBackend
+from services.ws_publisher import Publisher
+
+
+class RecordingManager:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, data):
+        self.published.append((channel, data["event"], threading.current_thread() is threading.main_thread()))
+
+
+class RecordingRedis:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, payload):
+        self.published.append(payload)
+
+
+class TestPublisher:
+
+    def test_in_process_events_go_to_the_manager_on_its_loop(self):
+        async def run():
+            publisher, manager = Publisher(), RecordingManager()
+            publisher.attach(asyncio.get_running_loop(), manager)
+            publisher.publish("general", "stock", {"id": 1})
+            await publisher.publish_async("user_2", "order", {"id": 2})
+            thread = threading.Thread(target=publisher.publish, args=("user_3", "sale", {"id": 3}))
+            thread.start()
+            thread.join()
+            await asyncio.sleep(0)
+            return manager.published
+        assert asyncio.run(run()) == [("general", "stock", True), ("user_2", "order", True), ("user_3", "sale", True)]
+
+    def test_other_processes_publish_bus_batches(self):
+        publisher, redis = Publisher(), RecordingRedis()
+        publisher.redis = redis
+        publisher.publish_many([publisher.message("general", "stock", {"id": 1}, sender=4),
+                                publisher.message("user_4", "order", {"id": 2})])
+        assert len(redis.published) == 1
+
+        delivered = []
+        bus = ChannelBus(MemoryBackend(), lambda channel, data: delivered.append((channel, data["event"])))
+        asyncio.run(bus.receive(redis.published[0]))
+        assert delivered == [("general", "stock"), ("user_4", "order")]
@@ -0,0 +1,168 @@
+"""
+Change versions of the catalog tables, used as ETags by the list endpoints.
+
+Every insert, update, delete or truncate statement on a table in TABLES appends a row to
+table_changes from a statement level trigger and sends a notification on the table_versions
+channel. Appending takes no lock on a shared row, so writers of a table don't queue behind each
+other, and a rolled back write leaves neither the row nor the notification behind. They come
+from every worker, celery task and consumer.
+
+The version of a table is the highest id and the number of its rows in table_changes. Ids are
+taken before the commit, so a transaction may commit after one with a higher id, its row still
+changes the count. The version lives in the database, so every worker computes the same etags.
+Each worker listens on its own connection and reads the versions of the notified tables again,
+a request does not query them. Until that read is done, and while the listener is not connected,
+the versions of a table are unknown and its list endpoints answer without an etag.
+prune_table_changes keeps the latest row of every table, the new count costs the clients of a
+pruned table one full response.
+"""
+import asyncio
+import logging
+from collections import Counter
+from typing import Callable, Dict, Iterable, Optional
+
+from sqlalchemy import Connection, text
+from sqlalchemy.orm import Session
+
+TABLES = ("products", "product_files", "brands", "inventories")
+
+CHANNEL = "table_versions"
+
+BUMP_FUNCTION = f"""
+create or replace function bump_table_version() returns trigger language plpgsql as $$
+begin
+	insert into table_changes (table_name) values (TG_TABLE_NAME);
+	perform pg_notify('{CHANNEL}', TG_TABLE_NAME);
+	return null;
+end $$;
+"""
+
+VERSIONS = """
+select table_name, max(id), count(*) from table_changes where table_name = any($1::text[]) group by table_name
+"""
+
+# pruning changes the counts, the pruned tables are notified so every worker reads them again
+PRUNE_CHANGES = text(f"""
+with pruned as (
+	delete from table_changes c
+	where id < (select max(id) from table_changes latest where latest.table_name = c.table_name)
+	returning table_name
+)
+select count(*), pg_notify('{CHANNEL}', table_name) from pruned group by table_name
+""")
+
+
+def create_table_versions(conn: Connection):
+	conn.exec_driver_sql("create table if not exists table_changes "
+	                     "(id bigserial primary key, table_name text not null)")
+	conn.exec_driver_sql("create index if not exists table_changes_table_name_id on table_changes (table_name, id)")
+	conn.execute(text(BUMP_FUNCTION))
+	for table in TABLES:
+		conn.exec_driver_sql(f"drop trigger if exists {table}_bump_version on {table}")
+		conn.exec_driver_sql(f"create trigger {table}_bump_version "
+		                     f"after insert or update or delete or truncate on {table} "
+		                     f"for each statement execute function bump_table_version()")
+	# counters used to be rows bumped by the triggers
+	conn.exec_driver_sql("drop table if exists table_versions")
+
+
+def prune_table_changes(db: Session) -> int:
+	"""deletes the rows of table_changes below the latest of their table, returns how many went"""
+	pruned = sum(count for count, _ in db.execute(PRUNE_CHANGES))
+	db.commit()
+	return pruned
+
+
+def listen_dsn() -> str:
+	from sqlalchemy.engine import make_url
+	from settings.database import ASYNC_SQLALCHEMY_DATABASE_URL
+	return make_url(ASYNC_SQLALCHEMY_DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class TableVersions:
+
+	def __init__(self, on_change: Callable[[str], None] = None, retry_interval: float = 1):
+		self.versions: Dict[str, str] = {}
+		self.on_change = on_change
+		self.retry_interval = retry_interval
+		self.connected = False
+		# tables changed since their versions were last read, and how often they were touched
+		self.stale = set(TABLES)
+		self.touches = Counter()
+		self.changed = asyncio.Event()
+		self.listener: Optional[asyncio.Task] = None
+
+	def touch(self, table: str):
+		"""marks the versions of a table unknown until the listener read them again"""
+		self.stale.add(table)
+		self.touches[table] += 1
+		self.changed.set()
+		if self.on_change:
+			self.on_change(table)
+
+	def get(self, tables: Iterable[str]) -> Optional[dict]:
+		"""the versions of tables, None while one of them is unknown"""
+		tables = list(tables)
+		if not self.connected or self.stale.intersection(tables):
+			for table in tables:
+				if self.on_change:
+					self.on_change(table)
+			return None
+		return {table: self.versions.get(table, "0") for table in tables}
+
+	def receive(self, connection, pid: int, channel: str, table: str):
+		self.touch(table)
+
+	async def refresh(self, connection):
+		touches = {table: self.touches[table] for table in self.stale}
+		self.changed.clear()
+		rows = await connection.fetch(VERSIONS, list(touches))
+		versions = {table: "0" for table in touches}
+		versions.update({table: f"{latest}.{count}" for table, latest, count in rows})
+		self.versions.update(versions)
+		# a table touched again during the read stays unknown until the next one
+		self.stale -= {table for table, count in touches.items() if self.touches[table] == count}
+
+	async def start(self, connect: Callable = None):
+		self.listener = asyncio.create_task(self.listen(connect))
+
+	async def stop(self):
+		if self.listener:
+			self.listener.cancel()
+			# lets it close the connection
+			await asyncio.gather(self.listener, return_exceptions=True)
+			self.listener = None
+		self.connected = False
+
+	async def listen(self, connect: Callable = None):
+		if connect is None:
+			import asyncpg
+			connect = lambda: asyncpg.connect(listen_dsn())
+		while True:
+			connection = None
+			try:
+				connection = await connect()
+				closed = asyncio.Event()
+
+				def terminated(_):
+					closed.set()
+					self.changed.set()
+
+				connection.add_termination_listener(terminated)
+				await connection.add_listener(CHANNEL, self.receive)
+				# writes committed while no one listened went unnoticed
+				for table in TABLES:
+					self.touch(table)
+				self.connected = True
+				while not closed.is_set():
+					await self.refresh(connection)
+					await self.changed.wait()
+				logging.error("table_versions listener lost its connection")
+			except asyncio.CancelledError:
+				if connection is not None and not connection.is_closed():
+					await connection.close()
+				raise
+			except Exception as e:
+				logging.error(f"table_versions listener failed: {e}")
+			self.connected = False
+			await asyncio.sleep(self.retry_interval)
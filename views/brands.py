@@ -1,8 +1,8 @@
 from typing import List
 
 from fastapi import APIRouter, UploadFile
-from fastapi import HTTPException, Depends, Query
-from sqlalchemy.orm import Session
+from fastapi import HTTPException, Depends, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import models
 import schemas.brands as schemas
@@ -10,28 +10,33 @@ from helpers.response import pagination_params, SuccessResponse, FailureResponse
 from settings.database import get_db
 from settings.jwt_config import get_current_user
 from repositories import brands as repository
+from services.cache import detail_cache
 
 router = APIRouter(prefix="/brands", tags=['brand'])
 
 
 @router.get("/", response_model=schemas.BrandListResponse)
-async def fetch_brands(db: Session = Depends(get_db),
+async def fetch_brands(db: AsyncSession = Depends(get_db),
                        current_user: dict = Depends(get_current_user),
                        pagination: dict = Depends(pagination_params),
-                       query: dict = Depends(repository.BrandRepository.query_parameters)
+                       query: dict = Depends(repository.BrandRepository.query_parameters),
+                       etag: str = Depends(repository.BrandRepository.etag),
                        ):
 	page = pagination['page']
 	per_page = pagination['per_page']
 	repo = repository.BrandRepository(db, current_user)
-	return await repo.get_all(skip=((page - 1) * per_page), limit=per_page, **query)
+	return await repo.get_all(skip=((page - 1) * per_page), limit=per_page, after=pagination['after'],
+	                          include_count=pagination['include_count'],
+	                          count_strategy=pagination['count_strategy'], **query)
 
 
 @router.get("/{brand_id}", response_model=schemas.Brand)
-async def read_brand(brand_id: int, db: Session = Depends(get_db),
+async def read_brand(brand_id: int, request: Request, db: AsyncSession = Depends(get_db),
                      current_user: dict = Depends(get_current_user),
                      ):
 	repo = repository.BrandRepository(db, current_user)
-	brand = await repo.get(brand_id)
+	brand = await detail_cache.fetch("brands", brand_id, lambda: repo.get(brand_id), schemas.Brand,
+	                                 if_none_match=request.headers.get("if-none-match"))
 	if brand is None:
 		return FailureResponse(status=404, message="Brand not found")
 	return brand
@@ -39,7 +44,7 @@ async def read_brand(brand_id: int, db: Session = Depends(get_db),
 
 @router.post("/", response_model=schemas.Brand)
 async def create_brand(data: schemas.CreateBrand,
-                       db: Session = Depends(get_db),
+                       db: AsyncSession = Depends(get_db),
                        current_user: dict = Depends(get_current_user),
 
                        ):
@@ -48,7 +53,7 @@ async def create_brand(data: schemas.CreateBrand,
 
 
 @router.put("/{brand_id}", response_model=schemas.Brand)
-async def update_brand(data: schemas.CreateBrand, brand_id: int, db: Session = Depends(get_db),
+async def update_brand(data: schemas.CreateBrand, brand_id: int, db: AsyncSession = Depends(get_db),
                        # current_user: dict = Depends(get_current_user),
                        ):
 	repo = repository.BrandRepository(db)
@@ -56,7 +61,7 @@ async def update_brand(data: schemas.CreateBrand, brand_id: int, db: Session = D
 
 
 @router.delete("/{brand_id}", response_model=schemas.Brand)
-async def delete_brand(brand_id: int, db: Session = Depends(get_db),
+async def delete_brand(brand_id: int, db: AsyncSession = Depends(get_db),
                        current_user: dict = Depends(get_current_user),
                        query: dict = Depends(repository.BrandRepository.delete_parameters)
                        ):
@@ -1,8 +1,8 @@
 from typing import List
 
 from fastapi import APIRouter
-from fastapi import HTTPException, Depends, Query
-from sqlalchemy.orm import Session
+from fastapi import HTTPException, Depends, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import models
 import schemas.inventory as schemas
@@ -10,30 +10,35 @@ from helpers.response import pagination_params, SuccessResponse, FailureResponse
 from settings.database import get_db
 from settings.jwt_config import get_current_user
 from repositories import inventory as repository
+from services.cache import detail_cache
 
 router = APIRouter(prefix="/inventories", tags=['inventory'])
 
 
 @router.get("/", response_model=schemas.InventoryListResponse)
-async def fetch_inventories(db: Session = Depends(get_db),
+async def fetch_inventories(db: AsyncSession = Depends(get_db),
                             current_user: dict = Depends(get_current_user),
                             pagination: dict = Depends(pagination_params),
-                            query: dict = Depends(repository.InventoryRepository.query_parameters)
+                            query: dict = Depends(repository.InventoryRepository.query_parameters),
+                            etag: str = Depends(repository.InventoryRepository.etag),
                             ):
 	page = pagination['page']
 	per_page = pagination['per_page']
 	repo = repository.InventoryRepository(db, current_user)
 	inventories = await repo.get_all(skip=((page - 1) * per_page),
-	                                 limit=per_page, **query)
+	                                 limit=per_page, after=pagination['after'],
+	                                 include_count=pagination['include_count'],
+	                                 count_strategy=pagination['count_strategy'], **query)
 	return inventories
 
 
 @router.get("/{inventory_id}", response_model=schemas.Inventory)
-async def read_inventory(inventory_id: int, db: Session = Depends(get_db),
+async def read_inventory(inventory_id: int, request: Request, db: AsyncSession = Depends(get_db),
                          current_user: dict = Depends(get_current_user),
                          ):
 	repo = repository.InventoryRepository(db, current_user)
-	inventory = await repo.get(inventory_id)
+	inventory = await detail_cache.fetch("inventories", inventory_id, lambda: repo.get(inventory_id),
+	                                     schemas.Inventory, if_none_match=request.headers.get("if-none-match"))
 	if inventory is None:
 		return FailureResponse(status=404, message="Inventory not found")
 	return inventory
@@ -41,7 +46,7 @@ async def read_inventory(inventory_id: int, db: Session = Depends(get_db),
 
 @router.post("/", response_model=schemas.Inventory)
 async def create_inventory(data: schemas.CreateInventory,
-                           db: Session = Depends(get_db),
+                           db: AsyncSession = Depends(get_db),
                            current_user: dict = Depends(get_current_user),
 
                            ):
@@ -49,7 +54,7 @@ async def create_inventory(data: schemas.CreateInventory,
 	return await repo.create(data)
 
 @router.put("/{inventory_id}", response_model=schemas.Inventory)
-async def update_inventory(data: schemas.CreateInventory, inventory_id: int, db: Session = Depends(get_db),
+async def update_inventory(data: schemas.CreateInventory, inventory_id: int, db: AsyncSession = Depends(get_db),
                            current_user: dict = Depends(get_current_user),
                            ):
 	repo = repository.InventoryRepository(db, current_user)
@@ -58,7 +63,7 @@ async def update_inventory(data: schemas.CreateInventory, inventory_id: int, db:
 
 
 @router.delete("/{inventory_id}")
-async def delete_inventory(inventory_id: int, db: Session = Depends(get_db),
+async def delete_inventory(inventory_id: int, db: AsyncSession = Depends(get_db),
                            current_user: dict = Depends(get_current_user),
                            query: dict = Depends(repository.InventoryRepository.delete_parameters)
                            ):
@@ -1,13 +1,15 @@
 from typing import List
 
 from fastapi import APIRouter, UploadFile
-from fastapi import Depends
-from sqlalchemy.orm import Session
+from fastapi import Depends, Query, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import models
 import schemas.products as schemas
 from helpers.response import pagination_params
 from repositories import products as repository
+from services.cache import detail_cache
+from services.suggestions import suggestion_index
 from settings.database import get_db
 from settings.jwt_config import get_current_user
 
@@ -15,31 +17,46 @@ router = APIRouter(prefix="/products", tags=['product'])
 
 
 @router.get("/" , response_model=schemas.ProductListResponse)
-async def fetch_products(db: Session = Depends(get_db),
+async def fetch_products(db: AsyncSession = Depends(get_db),
                          current_user: dict = Depends(get_current_user),
                          pagination: dict = Depends(pagination_params),
-                         query: dict = Depends(repository.ProductRepository.query_parameters)
+                         query: dict = Depends(repository.ProductRepository.query_parameters),
+                         etag: str = Depends(repository.ProductRepository.etag),
                          ):
 	page = pagination['page']
 	per_page = pagination['per_page']
 	repo = repository.ProductRepository(db, current_user)
 	products = await repo.get_all(skip=((page - 1) * per_page),
-	                              limit=per_page, **query)
+	                              limit=per_page, after=pagination['after'],
+	                              include_count=pagination['include_count'],
+	                              count_strategy=pagination['count_strategy'], **query)
 	return products
 
 
 
+@router.get("/suggest", response_model=schemas.SuggestionResponse)
+async def suggest_products(q: str = Query(..., min_length=1),
+                           limit: int = Query(10, gt=0, le=50),
+                           current_user: dict = Depends(get_current_user),
+                           ):
+	return {"results": suggestion_index.search(q, limit=limit)}
+
+
 @router.get("/{product_id}", response_model=schemas.ProductDetailResponse)
-async def read_product(product_id: int, db: Session = Depends(get_db),
+async def read_product(product_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db),
                        current_user: dict = Depends(get_current_user),
                        ):
 	repo = repository.ProductRepository(db, current_user)
-	return await repo.get_by_id(product_id)
+	return await detail_cache.fetch("products", product_id, lambda: repo.get_by_id(product_id),
+	                                schemas.ProductDetailResponse,
+	                                tags=lambda product: (f"brands:{product.brand_id}",
+	                                                      f"inventories:{product.inventory_id}"),
+	                                headers=response.headers, if_none_match=request.headers.get("if-none-match"))
 
 
 @router.post("/", response_model=schemas.CreateProductResponse)
 async def create_product(data: schemas.CreateProduct,
-                         db: Session = Depends(get_db),
+                         db: AsyncSession = Depends(get_db),
                          current_user: dict = Depends(get_current_user),
 
                          ):
@@ -48,21 +65,21 @@ async def create_product(data: schemas.CreateProduct,
 
 @router.post("/{product_id}/images", response_model=schemas.ProductDetailResponse)
 async def add_product_images(product_id: int, images: List[UploadFile],
-                             db:Session=Depends(get_db),
+                             db: AsyncSession = Depends(get_db),
 current_user: dict = Depends(get_current_user),
                              ):
 	repo = repository.ProductRepository(db, current_user)
 	return await repo.add_images(id=product_id, images=images)
 
 @router.delete("/{product_id}/images", response_model=schemas.ProductDetailResponse)
-async def delete_product_images(product_id: int, images: List[int], db:Session=Depends(get_db),
+async def delete_product_images(product_id: int, images: List[int], db: AsyncSession = Depends(get_db),
                                 current_user: dict = Depends(get_current_user),):
 	repo = repository.ProductRepository(db, current_user)
 	product = await repo.delete_images(id=product_id, image_ids=images)
 	return product
 
 @router.put("/{product_id}", response_model=schemas.CreateProductResponse)
-async def update_product(data: schemas.CreateProduct, product_id: int, db: Session = Depends(get_db),
+async def update_product(data: schemas.CreateProduct, product_id: int, db: AsyncSession = Depends(get_db),
                          current_user: dict = Depends(get_current_user),
                          ):
 	repo = repository.ProductRepository(db, current_user)
@@ -70,7 +87,7 @@ async def update_product(data: schemas.CreateProduct, product_id: int, db: Sessi
 
 
 @router.delete("/{product_id}", response_model=schemas.ProductResponse)
-async def delete_product(product_id: int, db: Session = Depends(get_db),
+async def delete_product(product_id: int, db: AsyncSession = Depends(get_db),
                          current_user: dict = Depends(get_current_user),
                          ):
 	repo = repository.ProductRepository(db, current_user)
@@ -2,7 +2,7 @@ from typing import List
 
 from fastapi import APIRouter
 from fastapi import Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from schemas.helpers import SuccessResponse
 import schemas.sales as schemas
 from helpers.response import pagination_params
@@ -14,7 +14,7 @@ router = APIRouter(prefix="/sales", tags=['sales'])
 
 
 @router.get("/" , response_model=schemas.SaleListResponse)
-async def fetch_sales(db: Session = Depends(get_db),
+async def fetch_sales(db: AsyncSession = Depends(get_db),
                          current_user: dict = Depends(get_current_user),
                          pagination: dict = Depends(pagination_params),
                          query: dict = Depends(repository.SaleRepository.query_parameters)
@@ -23,13 +23,15 @@ async def fetch_sales(db: Session = Depends(get_db),
 	per_page = pagination['per_page']
 	repo = repository.SaleRepository(db, current_user)
 	products = await repo.get_all(skip=((page - 1) * per_page),
-	                              limit=per_page, **query)
+	                              limit=per_page, after=pagination['after'],
+	                              include_count=pagination['include_count'],
+	                              count_strategy=pagination['count_strategy'], **query)
 	return products
 
 
 
 @router.get("/{sale_id}", response_model=schemas.SalesDetailResponse)
-async def get_sale_details(sale_id: int, db: Session = Depends(get_db),
+async def get_sale_details(sale_id: int, db: AsyncSession = Depends(get_db),
                        current_user: dict = Depends(get_current_user),
                        ):
 	repo = repository.SaleRepository(db, current_user)
@@ -37,7 +39,7 @@ async def get_sale_details(sale_id: int, db: Session = Depends(get_db),
 
 @router.post("/", response_model=SuccessResponse)
 async def create_sale(data: schemas.CreateSale,
-                         db: Session = Depends(get_db),
+                         db: AsyncSession = Depends(get_db),
                          current_user: dict = Depends(get_current_user),
 
                          ):
@@ -46,7 +48,7 @@ async def create_sale(data: schemas.CreateSale,
 
 
 @router.delete("/{sale_id}", responses={204: {"model": None}})
-async def delete_sale(sale_id: int, db: Session = Depends(get_db),
+async def delete_sale(sale_id: int, db: AsyncSession = Depends(get_db),
                          current_user: dict = Depends(get_current_user),
                          ):
 	repo = repository.SaleRepository(db, current_user)
@@ -54,7 +56,7 @@ async def delete_sale(sale_id: int, db: Session = Depends(get_db),
 
 
 @router.post("/{sale_id}/orders", response_model=SuccessResponse)
-async def add_orders(sale_id:int, data: List[schemas.OrderItem], db:Session = Depends(get_db),
+async def add_orders(sale_id:int, data: List[schemas.OrderItem], db: AsyncSession = Depends(get_db),
                     current_user: dict=Depends(get_current_user)
                      ):
 	repo = repository.SaleRepository(db, current_user)
@@ -62,7 +64,7 @@ async def add_orders(sale_id:int, data: List[schemas.OrderItem], db:Session = De
 
 
 @router.delete("/{sale_id}/orders", response_model=SuccessResponse)
-async def remove_orders(sale_id:int, data: List[int], db:Session=Depends(get_db),
+async def remove_orders(sale_id:int, data: List[int], db: AsyncSession = Depends(get_db),
                         current_user: dict=Depends(get_current_user)
                         ):
 	repo = repository.SaleRepository(db, current_user)
@@ -70,7 +72,7 @@ async def remove_orders(sale_id:int, data: List[int], db:Session=Depends(get_db)
 
 
 @router.patch("/{sale_id}", response_model=SuccessResponse)
-async def mark_sale_paid(sale_id:int, db:Session=Depends(get_db),
+async def mark_sale_paid(sale_id:int, db: AsyncSession = Depends(get_db),
                         current_user: dict=Depends(get_current_user)
                          ):
 	repo = repository.SaleRepository(db, current_user)
@@ -79,7 +81,7 @@ async def mark_sale_paid(sale_id:int, db:Session=Depends(get_db),
 
 @router.post("/staff/{staff_id}/orders", response_model=SuccessResponse)
 async def assign_staff_to_orders(staff_id:int, data: List[int],
-                                 db:Session=Depends(get_db),
+                                 db: AsyncSession = Depends(get_db),
                         current_user: dict=Depends(get_current_user)
                                  ):
 	repo = repository.SaleRepository(db, current_user)
@@ -87,7 +89,7 @@ async def assign_staff_to_orders(staff_id:int, data: List[int],
 
 @router.delete("/staff/{staff_id}/orders", response_model=SuccessResponse)
 async def remove_staff_to_orders(staff_id:int, data:List[int],
-                                 db:Session=Depends(get_db),
+                                 db: AsyncSession = Depends(get_db),
                         current_user: dict=Depends(get_current_user)
                                  ):
 	repo = repository.SaleRepository(db, current_user)
@@ -96,7 +98,7 @@ async def remove_staff_to_orders(staff_id:int, data:List[int],
 
 @router.patch("/orders/{order_id}", response_model=SuccessResponse)
 async def mark_order_as_delivered(order_id:int,
-                                 db:Session=Depends(get_db),
+                                 db: AsyncSession = Depends(get_db),
                         current_user: dict=Depends(get_current_user)
                                   ):
 	repo = repository.SaleRepository(db, current_user)